@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module provides a benchmark suite for the hot paths of the detection, recognition and evaluation code,
+with the possibility to compare the results against a previous run in order to spot performance regressions.
+
+Authors:
+    Pg96, dsforza96
+"""
+
+from argparse import ArgumentParser
+import contextlib
+import cv2.cv2 as cv
+import datetime
+import glob
+import io
+import json
+import numpy as np
+import os
+from os import path
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import Detector
+import Eyes_Recognizer
+import preprocessing
+import profiling
+import Recognition_Tests
+import Recognizer
+import utils
+
+groups = ['detect', 'align', 'csv', 'train', 'predict', 'evaluate', 'eyes', 'startup']
+
+# modules run as command line tools (or imported by the workers), whose import time is the start up latency
+entry_points = ['Detector', 'Recognizer', 'Eyes_Recognizer', 'Recognition_Tests', 'Service', 'Ingest']
+
+# models to benchmark, alongside the thresholds to evaluate them with
+models = {
+    'Eigen': (lambda: cv.face.EigenFaceRecognizer_create(num_components=10), np.linspace(1000, 5000, 100)),
+    'Fisher': (lambda: cv.face.FisherFaceRecognizer_create(num_components=80), np.linspace(100, 1500, 100)),
+    'LBPH': (lambda: cv.face.LBPHFaceRecognizer_create(radius=2, neighbors=8), np.linspace(1, 200, 100))
+}
+
+unprocessed_images_dir = '../images/dataset/unprocessed'
+
+
+def _quiet(fn):
+    """
+    :return: a function calling fn with its standard output suppressed.
+    """
+    def wrapper():
+        with contextlib.redirect_stdout(io.StringIO()):
+            return fn()
+
+    return wrapper
+
+
+def _warm(fn):
+    """
+    Marks a benchmark to be timed with the memo of the preprocessed images filled by the previous calls.
+    """
+    fn.warm = True
+    return fn
+
+
+def time_function(fn, repeat, setup=None):
+    """
+    Times a function, after a warm-up call.
+
+    :param fn: function to time.
+    :param repeat: number of timed calls.
+    :param setup: if not None, function called (untimed) before each call, e.g. to empty the caches.
+    :return: dictionary with the statistics (in seconds) of the timed calls.
+    """
+    if setup is not None:
+        setup()
+    fn()
+
+    times = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    return dict([("repeat", repeat), ("min", min(times)), ("median", statistics.median(times)),
+                 ("mean", statistics.mean(times)), ("max", max(times))])
+
+
+class _Context:
+    """
+    Data shared by the benchmarks, created on first use.
+    """
+
+    def __init__(self, dataset_csv, sizes, work_dir):
+        self.dataset_csv = dataset_csv
+        self.sizes = sizes
+        self.work_dir = work_dir
+        self._synthetic = None
+        self._split = None
+        self._trained = dict()
+
+    def synthetic_images(self):
+        """
+        :return: (size, file name) couples of random BGR images, one for each size.
+        """
+        if self._synthetic is None:
+            rng = np.random.RandomState(0)
+            self._synthetic = []
+
+            for size in self.sizes:
+                file_name = path.join(self.work_dir, "synthetic_{}.png".format(size))
+                cv.imwrite(file_name, rng.randint(0, 256, (size, size, 3), dtype=np.uint8))
+                self._synthetic.append((size, file_name))
+
+        return self._synthetic
+
+    def split(self):
+        """
+        :return: training and testing csv files of a k-fold split of the dataset.
+        """
+        if self._split is None:
+            random.seed(0)
+            train, test = Recognition_Tests.k_fold_cross_validation(self.dataset_csv, k=5, n_impostors=1)[0]
+
+            train_fn = path.join(self.work_dir, "train.csv")
+            with open(train_fn, 'w+') as fi:
+                fi.writelines("\n".join(train))
+
+            test_fn = path.join(self.work_dir, "test.csv")
+            with open(test_fn, 'w+') as fi:
+                fi.writelines("\n".join(test))
+
+            self._split = (train_fn, test_fn)
+
+        return self._split
+
+    def probe(self):
+        """
+        :return: the first image of the dataset.
+        """
+        with open(self.dataset_csv, "r") as fl:
+            return fl.readline().split(";")[0]
+
+    def trained(self, model_name):
+        """
+        :return: the model trained on the whole dataset, alongside the height of its images.
+        """
+        if model_name not in self._trained:
+            self._trained[model_name] = Recognizer.train_recongizer(models[model_name][0](), self.dataset_csv)
+
+        return self._trained[model_name]
+
+
+def _detect_benchmarks(ctx):
+    images = [("real", img) for img in sorted(glob.glob(path.join(unprocessed_images_dir, '*', '*')))[:1]]
+    images += [("{0}x{0}".format(size), img) for size, img in ctx.synthetic_images()]
+
+    for classifier, cascade in enumerate(Detector.cat_cascades):
+        for name, img in images:
+            yield ("detect/{}/{}".format(path.splitext(cascade)[0], name),
+                   _quiet(lambda c=classifier, i=img: Detector.detect_cat_face(i, c)))
+
+
+def _align_benchmarks(ctx):
+    from PIL import Image
+
+    for size, img in ctx.synthetic_images():
+        im_pil = Image.open(img)
+        eye_left = (int(size * 0.3), int(size * 0.4))
+        eye_right = (int(size * 0.7), int(size * 0.42))
+
+        yield ("align/{0}x{0}".format(size),
+               lambda i=im_pil, l=eye_left, r=eye_right: Detector.AlignFace(i, eye_left=l, eye_right=r))
+
+
+def _csv_benchmarks(ctx):
+    yield "csv/read_csv", lambda: utils.read_csv(ctx.dataset_csv, resize=True)
+    yield "csv/read_csv_warm", _warm(lambda: utils.read_csv(ctx.dataset_csv, resize=True))
+    yield "csv/read_csv_mapping", lambda: utils.read_csv(ctx.dataset_csv, mapping=True)
+
+
+def _train_benchmarks(ctx):
+    for model_name, (create, _) in models.items():
+        yield "train/{}".format(model_name), lambda c=create: Recognizer.train_recongizer(c(), ctx.dataset_csv)
+
+    yield "train/Eigen/randomized", lambda: Recognizer.train_recongizer(models['Eigen'][0](), ctx.dataset_csv,
+                                                                        randomized=True)
+
+
+def _predict_benchmarks(ctx):
+    probe = ctx.probe()
+
+    for model_name in models:
+        def fn(m=model_name):
+            model, height = ctx.trained(m)
+            Recognizer.predict(model, height, probe)
+
+        yield "predict/{}".format(model_name), fn
+
+
+def _evaluate_benchmarks(ctx):
+    for model_name, (create, thresholds) in models.items():
+        def distance_matrix(c=create):
+            train_fn, test_fn = ctx.split()
+            model, height = Recognizer.train_recongizer(c(), train_fn)
+            Recognition_Tests.compute_distance_matrix(test_fn, True, model, height)
+
+        def evaluate(c=create, t=thresholds):
+            train_fn, test_fn = ctx.split()
+            Recognition_Tests.evaluate_performances(c(), t, train_fn, test_fn)
+
+        yield "evaluate/compute_distance_matrix/{}".format(model_name), distance_matrix
+        yield "evaluate/evaluate_performances/{}".format(model_name), evaluate
+
+
+def _eyes_benchmarks(ctx):
+    rng = np.random.RandomState(0)
+
+    for size in ctx.sizes:
+        eyes = [rng.randint(0, 256, (size, size, 3), dtype=np.uint8) for _ in range(2)]
+        yield ("eyes/analysis_color_eyes/{0}x{0}".format(size),
+               _quiet(lambda e=eyes: Eyes_Recognizer.analysis_color_eyes(e)))
+
+
+def _startup_benchmarks(ctx):
+    code_dir = path.dirname(path.abspath(__file__))
+
+    def run(statement):
+        subprocess.run([sys.executable, '-c', statement], cwd=code_dir, check=True)
+
+    # the interpreter alone, as a reference
+    yield "startup/python", lambda: run("pass")
+
+    for module in entry_points:
+        yield "startup/{}".format(module), lambda m=module: run("import {}".format(m))
+
+
+def run_benchmarks(dataset_csv, sizes, selected_groups, repeat, name_filter=None):
+    """
+    Runs the benchmarks.
+
+    :param dataset_csv: csv file with the dataset images to use.
+    :param sizes: sizes of the synthetic images to use.
+    :param selected_groups: groups of benchmarks to run.
+    :param repeat: number of timed runs of each benchmark.
+    :param name_filter: if not None, only the benchmarks whose name contains this string are run.
+    :return: dictionary "benchmark name: timing statistics".
+    """
+    results = dict()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        ctx = _Context(dataset_csv, sizes, work_dir)
+
+        for group in selected_groups:
+            for name, fn in globals()["_{}_benchmarks".format(group)](ctx):
+                if name_filter is not None and name_filter not in name:
+                    continue
+
+                # the images are decoded at each call (as before the memo), unless the benchmark is a warm one
+                results[name] = time_function(fn, repeat, None if getattr(fn, 'warm', False) else preprocessing.clear)
+                print("{:<60} median {:10.3f} ms".format(name, results[name]["median"] * 1000))
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Compares the results of a run with the ones of a baseline run.
+
+    :param results: results of the current run.
+    :param baseline: results of the baseline run.
+    :param tolerance: maximum allowed relative slow down of the median time.
+    :return: the names of the benchmarks whose median time got worse than the tolerance.
+    """
+    regressions = []
+
+    for name, res in results.items():
+        if name not in baseline:
+            print("{:<60} {:>10}".format(name, "NEW"))
+            continue
+
+        change = res["median"] / baseline[name]["median"] - 1
+
+        if change > tolerance:
+            regressions.append(name)
+            outcome = "REGRESSION"
+        elif change < -tolerance:
+            outcome = "improvement"
+        else:
+            outcome = "ok"
+
+        print("{:<60} {:+9.1%} {}".format(name, change, outcome))
+
+    return regressions
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('-d', '--dataset', help='The csv file of the dataset to use',
+                        default='../dataset_info/best.csv')
+    parser.add_argument('-o', '--output', help='The JSON file where to save the results '
+                        '(the default directory is ignored by git)', default='../test/benchmark/results.json')
+    parser.add_argument('-b', '--baseline', help='The JSON file of a previous run to compare against', default=None)
+    parser.add_argument('-t', '--tolerance', help='The relative slow down that is considered a regression',
+                        type=float, default=0.1)
+    parser.add_argument('-n', '--repeat', help='The number of timed runs of each benchmark', type=int, default=5)
+    parser.add_argument('-s', '--sizes', help='The sizes of the synthetic images', type=int, nargs='+',
+                        default=[256, 512, 1024])
+    parser.add_argument('-g', '--groups', help='The groups of benchmarks to run', nargs='+', choices=groups,
+                        default=groups)
+    parser.add_argument('-f', '--filter', help='Run only the benchmarks whose name contains this string',
+                        default=None)
+    profiling.add_argument(parser, '../test/profile/benchmark')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    profiling.start(args.profile)
+
+    res = run_benchmarks(args.dataset, args.sizes, args.groups, args.repeat, args.filter)
+
+    report = dict([("meta", dict([("date", datetime.datetime.now().isoformat()),
+                                  ("python", platform.python_version()),
+                                  ("opencv", cv.__version__),
+                                  ("numpy", np.__version__),
+                                  ("machine", platform.machine()),
+                                  ("args", vars(args))])),
+                   ("results", res)])
+
+    if path.dirname(args.output):
+        os.makedirs(path.dirname(args.output), exist_ok=True)
+
+    with open(args.output, "w+") as fl:
+        json.dump(report, fl, indent=2)
+
+    print("Results saved to", args.output)
+
+    if args.baseline is not None:
+        with open(args.baseline, "r") as fl:
+            base = json.load(fl)["results"]
+
+        print('\n' + '-' * 80)
+        print('Comparison against', args.baseline)
+        print('-' * 80)
+
+        regr = compare(res, base, args.tolerance)
+
+        if len(regr) != 0:
+            print("\n{} regression(s) beyond a {:.0%} tolerance".format(len(regr), args.tolerance))
+            sys.exit(1)
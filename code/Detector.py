@@ -12,14 +12,63 @@ import cv2.cv2 as cv
 import utils
 import math
 import numpy as np
+import os
 from os import path
-from PIL import Image
+
+import profiling
 
 cascade_models_dir = '../models/detection/'
 cat_cascades = ['haarcascade_frontalcatface.xml', 'haarcascade_frontalcatface_extended.xml',
                 'lbpcascade_frontalcatface.xml']
 eye_cascade_model = path.join(cascade_models_dir, 'haarcascade_eye.xml')
 
+# cascade classifiers already loaded, by file name
+_loaded_cascades = dict()
+
+
+def load_cascade(file_name):
+    """
+    Loads a cascade classifier, reusing the already loaded ones.
+
+    :param file_name: file of the cascade model.
+    :return: the cascade classifier (empty if it could not be loaded).
+    """
+    if file_name not in _loaded_cascades:
+        cascade = cv.CascadeClassifier(file_name)
+
+        if cascade.empty():
+            return cascade
+
+        _loaded_cascades[file_name] = cascade
+
+    return _loaded_cascades[file_name]
+
+
+def crop_cat_face(gray, classifier, scaleFactor=1.05, minNeighbors=2):
+    """
+    Detects the biggest cat face in an image and crops it.
+
+    :param gray: grayscale image.
+    :param classifier: index of the detector model to be used, as in detect_cat_face.
+    :param scaleFactor: scale factor value the detector should use.
+    :param minNeighbors: min neighbors value the detector should use.
+    :return: the cropped face, None if no face is detected.
+    """
+    cat_cascade = load_cascade(path.join(cascade_models_dir, cat_cascades[classifier]))
+
+    if cat_cascade.empty():
+        raise RuntimeError('The face classifier was not loaded correctly!')
+
+    with profiling.stage('detect/face_cascade'):
+        faces = cat_cascade.detectMultiScale(gray, scaleFactor=scaleFactor, minNeighbors=minNeighbors)
+
+    if len(faces) == 0:
+        return None
+
+    x, y, w, h = max(faces, key=lambda f: f[2] * f[3])
+
+    return gray[y:y + h, x:x + w]
+
 
 def detect_cat_face(image_file, classifier, show=False, scaleFactor=1.05, minNeighbors=2,
                     eyes_ScaleFactor=1.08, eyes_minNeighbors=3, eyes_minSize=(40, 40)):
@@ -52,8 +101,9 @@ def detect_cat_face(image_file, classifier, show=False, scaleFactor=1.05, minNei
     print("Chosen classifier: " + face_detector)
     print("SF={0}, minN={1}".format(scaleFactor, minNeighbors))
 
-    cat_cascade = cv.CascadeClassifier(path.join(cascade_models_dir, face_detector))
-    eye_cascade = cv.CascadeClassifier(eye_cascade_model)
+    with profiling.stage('detect/load_cascades'):
+        cat_cascade = load_cascade(path.join(cascade_models_dir, face_detector))
+        eye_cascade = load_cascade(eye_cascade_model)
 
     if cat_cascade.empty():
         raise RuntimeError('The face classifier was not loaded correctly!')
@@ -61,13 +111,17 @@ def detect_cat_face(image_file, classifier, show=False, scaleFactor=1.05, minNei
     if eye_cascade.empty():
         raise RuntimeError('The eye classifier was not loaded correctly!')
 
-    img = cv.imread(image_file)
+    with profiling.stage('detect/decode'):
+        img = cv.imread(image_file)
+
+        img_orig = cv.imread(image_file)
 
-    img_orig = cv.imread(image_file)
+    with profiling.stage('detect/face_cascade'):
+        gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
 
-    gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+        faces = cat_cascade.detectMultiScale(gray, scaleFactor=scaleFactor, minNeighbors=minNeighbors)
 
-    faces = cat_cascade.detectMultiScale(gray, scaleFactor=scaleFactor, minNeighbors=minNeighbors)
+    profiling.count('detect/faces', len(faces))
 
     if classifier == 0:
         col = (255, 0, 0)
@@ -82,10 +136,11 @@ def detect_cat_face(image_file, classifier, show=False, scaleFactor=1.05, minNei
         img = cv.rectangle(img, (x, y), (x + w, y + h), col, 2)
         roi_gray = gray[y:y + h, x:x + w]
         roi_color = img[y:y + h, x:x + w]
-        eyes = eye_cascade.detectMultiScale(roi_gray,
-                                            scaleFactor=eyes_ScaleFactor,
-                                            minNeighbors=eyes_minNeighbors,
-                                            minSize=eyes_minSize)
+        with profiling.stage('detect/eye_cascade'):
+            eyes = eye_cascade.detectMultiScale(roi_gray,
+                                                scaleFactor=eyes_ScaleFactor,
+                                                minNeighbors=eyes_minNeighbors,
+                                                minSize=eyes_minSize)
 
         for (ex, ey, ew, eh) in eyes:
             cv.rectangle(roi_color, (ex, ey), (ex + ew, ey + eh), (255, 255, 0), 2)
@@ -111,7 +166,7 @@ def detect_cat_face(image_file, classifier, show=False, scaleFactor=1.05, minNei
     return cropped
 
 
-def ScaleRotateTranslate(img, angle, center=None, new_center=None, scale=None, resample=Image.BICUBIC):
+def ScaleRotateTranslate(img, angle, center=None, new_center=None, scale=None, resample=None):
     # Copyright (c) 2012, Philipp Wagner
     # All rights reserved.
     #
@@ -142,6 +197,12 @@ def ScaleRotateTranslate(img, angle, center=None, new_center=None, scale=None, r
     # ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
     # POSSIBILITY OF SUCH DAMAGE.
 
+    # PIL is imported on first use, to keep the start up of the entry points fast
+    from PIL import Image
+
+    if resample is None:
+        resample = Image.BICUBIC
+
     if (scale is None) and (center is None):
         return img.rotate(angle=angle, resample=resample)
     nx, ny = x, y = center
@@ -249,10 +310,80 @@ def AlignFace(img, eye_left=(0, 0), eye_right=(0, 0), offset_pct=(0.3, 0.3), des
     # img = img.crop(
     #     (int(crop_xy[0]), int(crop_xy[1]), int(crop_xy[0] + crop_size[0]), int(crop_xy[1] + crop_size[1])))
     # resize it
+    from PIL import Image
     img = img.resize(dest_sz, Image.ANTIALIAS)
     return img
 
 
+def crop_and_align(image_file, save_dir, classifier=0, show=False, scaleFactor=1.05, minNeighbors=2,
+                   eyes_ScaleFactor=1.08, eyes_minNeighbors=3, eyes_minSize=(40, 40), keep_unaligned=False):
+    """
+    Detects the cat face in an image, aligns it according to the eyes
+    and saves both the cropped and the aligned faces.
+
+    :param image_file: the name of the image file to detect the face from.
+    :param save_dir: directory where to save the faces.
+    :param classifier: detector model to be used, as in detect_cat_face.
+    :param show: set to True to see the detections.
+    :param scaleFactor: scale factor value the detector should use.
+    :param minNeighbors: min neighbors value the detector should use.
+    :param eyes_ScaleFactor: scaleFactor value the eyes detector should use.
+    :param eyes_minNeighbors: minNeighbors value the eyes detector should use.
+    :param eyes_minSize: minSize value the eyes detector should use.
+    :param keep_unaligned: if True, the cropped face is saved even if the eyes are not both detected.
+    :return: the list of the saved files.
+    """
+    file_name, file_extension = path.splitext(path.basename(image_file))
+
+    out = detect_cat_face(image_file, classifier=classifier, show=show, scaleFactor=scaleFactor,
+                          minNeighbors=minNeighbors, eyes_ScaleFactor=eyes_ScaleFactor,
+                          eyes_minNeighbors=eyes_minNeighbors, eyes_minSize=eyes_minSize)
+
+    if out is None:
+        return []
+
+    os.makedirs(save_dir, exist_ok=True)
+    cropped_file = path.join(save_dir, file_name + "_cropped" + file_extension)
+
+    if not isinstance(out, list):
+        if keep_unaligned:
+            cv.imwrite(cropped_file, out)
+            return [cropped_file]
+
+        return []
+
+    face = out[0]
+    # show_image(img)
+
+    # transform image into a PIL Image (for face Alignment)
+    from PIL import Image
+    trans = cv.cvtColor(face, cv.COLOR_BGR2RGB)
+    im_pil = Image.fromarray(trans)
+
+    eye1 = out[1][0]
+    eye2 = out[1][1]
+    # print("eye1 = {0} -- eye2 = {1}".format(eye1, eye2))
+    left_eye = np.minimum(eye1, eye2)
+    right_eye = eye2 if np.array_equal(left_eye, eye1) else eye1
+    # print(left_eye)
+    # print(right_eye)
+
+    with profiling.stage('detect/align'):
+        im = AlignFace(im_pil,
+                       eye_left=(int(left_eye[0]), int(left_eye[1])),
+                       eye_right=(int(right_eye[0]), int(right_eye[1])))
+
+    # im.show()
+    # show_image(face)
+
+    aligned_file = path.join(save_dir, file_name + "_cropped_aligned" + file_extension)
+
+    cv.imwrite(cropped_file, face)
+    im.save(aligned_file)
+
+    return [cropped_file, aligned_file]
+
+
 def parse_args():
     parser = ArgumentParser()
     parser.add_argument('input_image', help='The path of the input image')
@@ -263,6 +394,7 @@ def parse_args():
     parser.add_argument('-es', '--eyes-scalefactor', default=1.08, type=float)
     parser.add_argument('-en', '--eyes-minneighbors', default=3, type=int)
     parser.add_argument('-em', '--eyes-minsize', default=40, type=int)
+    profiling.add_argument(parser, '../test/profile/detector')
 
     return parser.parse_args()
 
@@ -271,48 +403,16 @@ if __name__ == '__main__':
     """Main for image cropping & testing purposes"""
     args = parse_args()
 
+    profiling.start(args.profile)
+
     out_dir = args.output
     image = args.input_image
 
     directory, file = path.split(image)
     dir_name = path.basename(directory)
-    file_name, file_extension = path.splitext(file)
 
     save_dir = path.join(out_dir, dir_name)
 
-    detector = args.detector
-    sf = args.scalefactor
-    n = args.minneighbors
-    eyes_sf = args.eyes_scalefactor
-    eyes_n = args.eyes_minneighbors
-    eyes_ms = (args.eyes_minsize, args.eyes_minsize)
-
-    out = detect_cat_face(image, classifier=detector, show=True, scaleFactor=sf, minNeighbors=n,
-                          eyes_ScaleFactor=eyes_sf, eyes_minNeighbors=eyes_n, eyes_minSize=eyes_ms)
-    if len(out) == 2:
-        face = out[0]
-        # show_image(img)
-
-        # transform image into a PIL Image (for face Alignment)
-        trans = cv.cvtColor(face, cv.COLOR_BGR2RGB)
-        im_pil = Image.fromarray(trans)
-
-        eye1 = out[1][0]
-        eye2 = out[1][1]
-        # print("eye1 = {0} -- eye2 = {1}".format(eye1, eye2))
-        left_eye = np.minimum(eye1, eye2)
-        right_eye = eye2 if np.array_equal(left_eye, eye1) else eye1
-        # print(left_eye)
-        # print(right_eye)
-
-        im = AlignFace(im_pil,
-                       eye_left=(int(left_eye[0]), int(left_eye[1])),
-                       eye_right=(int(right_eye[0]), int(right_eye[1])))
-
-        # im.show()
-        # show_image(face)
-
-        im_np = np.asarray(im_pil)
-
-        cv.imwrite(path.join(save_dir, file_name + "_cropped" + file_extension), face)
-        im.save(path.join(save_dir, file_name + "_cropped_aligned" + file_extension))
+    crop_and_align(image, save_dir, classifier=args.detector, show=True, scaleFactor=args.scalefactor,
+                   minNeighbors=args.minneighbors, eyes_ScaleFactor=args.eyes_scalefactor,
+                   eyes_minNeighbors=args.eyes_minneighbors, eyes_minSize=(args.eyes_minsize, args.eyes_minsize))
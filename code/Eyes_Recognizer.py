@@ -12,13 +12,18 @@ Authors:
 from argparse import ArgumentParser
 import cv2.cv2 as cv
 import glob
+import hashlib
+import json
 import numpy as np
 import os
 from os import path
-from PIL import Image
+import shutil
 
-from Detector import eye_cascade_model
-import Recognition_Tests
+from Detector import eye_cascade_model, load_cascade
+import cache
+import Gallery
+import preprocessing
+import profiling
 import utils
 
 class_name = ["Blue", "Green", "Yellow", "Brown", "Gray"]
@@ -32,69 +37,339 @@ eyes_color = {
     class_name[4]: [(128, 128, 128), (90, 85, 79)]  # tigro
 }
 
+# upper and lower rgb bounds of each class, ordered as class_name
+_color_upper = np.array([eyes_color[c][0] for c in class_name], dtype=np.int16)
+_color_lower = np.array([eyes_color[c][1] for c in class_name], dtype=np.int16)
+
+gallery_eyes_color_file = '../dataset_info/gallery_eyes_color.txt'
+gallery_eyes_index = None
+
+
+class EyesColorIndex:
+    """
+    Inverted index from eye colors to the gallery subjects having them.
+
+    Each color is mapped to a bitset of subject labels (an int whose i-th bit is set if subject i has that color),
+    so that sets of colors are merged with a few bitwise operations. When the index is backed by a file,
+    it is reloaded as soon as the file changes.
+    """
+
+    def __init__(self, file_name=None):
+        """
+        :param file_name: file with a "name  sN  color" line per subject, None for an empty in-memory index.
+        """
+        self.file_name = file_name
+        self._stamp = None
+        self._changes = 0
+        self._colors = dict()  # color -> bitset of labels
+        self._subjects = dict()  # label -> (name, color)
+
+        if file_name is not None:
+            self.reload()
+
+    def _file_stamp(self):
+        st = os.stat(self.file_name)
+        return st.st_mtime_ns, st.st_size
+
+    def reload(self, force=False):
+        """
+        Reloads the index from its file, if it has been modified since the last load (or if force is True).
+        """
+        if self.file_name is None:
+            return
+
+        stamp = self._file_stamp()
+        if not force and stamp == self._stamp:
+            return
+
+        self._colors = dict()
+        self._subjects = dict()
+
+        with open(self.file_name, "r") as fl:
+            for line in fl:
+                line = line.rstrip("\n")
+                if not line.strip():
+                    continue
+
+                name, subject, color = line.split("  ")
+                self._add(int(subject.replace('s', '')), name, color)
+
+        self._stamp = stamp
+
+    @property
+    def version(self):
+        """
+        :return: the state of the index (stamp of its file and number of changes), for cache.fingerprint().
+        """
+        self.reload()
+        return self._stamp, self._changes
+
+    def _add(self, label, name, color):
+        self._changes += 1
+
+        if label in self._subjects:
+            old_color = self._subjects[label][1]
+            self._colors[old_color] &= ~(1 << label)
+
+        self._subjects[label] = (name, color)
+        self._colors[color] = self._colors.get(color, 0) | (1 << label)
+
+    def enroll(self, label, name, color, save=False):
+        """
+        Adds a subject to the index (or updates its eye color, if already there).
+
+        :param label: label of the subject.
+        :param name: name of the subject.
+        :param color: eye color of the subject.
+        :param save: if True, the change is also written to the index file.
+        """
+        self.reload()
+        self._add(label, name, color)
+
+        if save and self.file_name is not None:
+            lines = ["{}  s{}  {}".format(n, lb, c) for lb, (n, c) in self._subjects.items()]
+
+            tmp_file = self.file_name + ".tmp"
+            with open(tmp_file, "w") as fl:
+                fl.write("\n".join(lines))
+            os.replace(tmp_file, self.file_name)
+
+            self._stamp = self._file_stamp()
+
+    def union(self, colors):
+        """
+        :return: the bitset of the subjects having any of the given eye colors.
+        """
+        self.reload()
+
+        bits = 0
+        for color in colors:
+            bits |= self._colors.get(color, 0)
+        return bits
+
+    def intersection(self, colors):
+        """
+        :return: the bitset of the subjects included in the sets of all the given eye colors.
+        """
+        self.reload()
+
+        bits = ~0
+        for color in colors:
+            bits &= self._colors.get(color, 0)
+        return bits if bits != ~0 else 0
+
+    def subjects(self, colors):
+        """
+        :return: the sorted labels of the subjects having any of the given eye colors.
+        """
+        return self.labels(self.union(colors))
+
+    def all_subjects(self):
+        """
+        :return: the sorted labels of all the subjects in the index.
+        """
+        self.reload()
+        return sorted(self._subjects.keys())
+
+    def color(self, label):
+        """
+        :return: the eye color of the subject with the given label, None if it is not in the index.
+        """
+        self.reload()
+        return self._subjects[label][1] if label in self._subjects else None
+
+    @staticmethod
+    def labels(bits):
+        """
+        :return: the sorted labels in a bitset.
+        """
+        return [i for i in range(bits.bit_length()) if bits >> i & 1]
+
+
+def get_gallery_eyes_index():
+    """
+    :return: the eye color index of the gallery, loaded from gallery_eyes_color_file.
+    """
+    global gallery_eyes_index
+
+    if gallery_eyes_index is None:
+        gallery_eyes_index = EyesColorIndex(gallery_eyes_color_file)
+
+    return gallery_eyes_index
+
+
+# directory where eye crops are cached, when caching is enabled
 cache_dir = '../images/eyes/'
 
+# eye colors of the already analyzed images
+eyes_memo = dict()
+# JSON lines file where eyes_memo is also stored, when set
+eyes_memo_file = None
+_eyes_memo_loaded = None
 
-def detect_cat_eyes(file, eyes_ScaleFactor=1.08, eyes_minNeighbors=3, eyes_minSize=(40, 40)):
+
+def _eyes_cache_path(img, *params):
     """
-    Cat eyes detection utility.
+    :return: the cache directory of the eye crops of an image, keyed by the hash of its content
+    and of the detection parameters.
+    """
+    key = hashlib.sha1(img.tobytes())
+    key.update(repr((img.shape, params)).encode())
+
+    return path.join(cache_dir, key.hexdigest())
 
-    :param file : str
-        The name of the image file to detect the face from.
+
+def _load_cached_eyes(save_dir):
+    """
+    :return: the eye crops stored in save_dir, None if they were never cached.
+    """
+    if not path.isdir(save_dir):
+        return None
+
+    return [cv.imread(filename, cv.IMREAD_COLOR) for filename in sorted(glob.glob(path.join(save_dir, '*.png')))]
+
+
+def _save_cached_eyes(save_dir, eyes):
+    """
+    Stores the eye crops in save_dir (also when there are none, so that the detection is not repeated).
+    """
+    tmp_dir = "{}.{}.tmp".format(save_dir, os.getpid())
+    os.makedirs(tmp_dir, exist_ok=True)
+
+    for i, eye in enumerate(eyes):
+        # lossless format, in order to get back exactly the same pixels
+        cv.imwrite(path.join(tmp_dir, "{}.png".format(i + 1)), eye)
+
+    try:
+        os.replace(tmp_dir, save_dir)
+    except OSError:
+        # already cached by someone else
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def crop_cat_eyes(img, eyes_ScaleFactor=1.08, eyes_minNeighbors=3, eyes_minSize=(40, 40), cache=False):
+    """
+    Detects the eyes of a cat and crops them.
+
+    :param img: BGR image to detect the eyes from.
     :param eyes_ScaleFactor: float
         scaleFactor value the eyes detector should use
     :param eyes_minNeighbors:
         minNeighbors value the eyes detector should use
     :param eyes_minSize:
         minSize value the eyes detector should use
-    :return the cropped face and the location of the eyes, if detected, else None.
+    :param cache: if True, the crops are read from (or written to) cache_dir.
+    :return: a list with the BGR images of the eyes, empty if no eyes or more than 2 are detected.
     """
-    eye_cascade = cv.CascadeClassifier(eye_cascade_model)
+    if cache:
+        save_dir = _eyes_cache_path(img, eyes_ScaleFactor, eyes_minNeighbors, tuple(eyes_minSize))
+        eyes = _load_cached_eyes(save_dir)
+
+        if eyes is not None:
+            return eyes
+
+    eye_cascade = load_cascade(eye_cascade_model)
 
     if eye_cascade.empty():
         raise RuntimeError('The eye classifier was not loaded correctly!')
 
-    d, f = path.split(file)
-    dir_name = path.basename(d)
-    file_name, file_extension = path.splitext(f)
-    save_dir = path.join(cache_dir, dir_name, file_name)
-
-    img = cv.imread(file)
-
-    gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
-
-    eyes = eye_cascade.detectMultiScale(gray, scaleFactor=eyes_ScaleFactor,
-                                        minNeighbors=eyes_minNeighbors,
-                                        minSize=eyes_minSize)
-    cont = 0
-
-    for (ex, ey, ew, eh) in eyes:
-        cont += 1
-        eye = cv.rectangle(img, (ex, ey), (ex + ew, ey + eh), (255, 255, 0), 2)
-        if len(eyes) == 2:
-            crop_eyes = eye[ey + 2:ey + eh - 1, ex + 2: ex + ew - 1]
-            # print('Saving eye image...')
-            if not os.path.exists(save_dir):
-                os.makedirs(save_dir, exist_ok=True)
-            cv.imwrite(path.join(save_dir, file_name + "_" + str(cont) + file_extension), crop_eyes)
-
-        elif len(eyes) == 1:
-            crop_eyes = eye[ey + 2:ey + eh - 1, ex + 2: ex + ew - 1]
-            # print('Saving eye image...')
-            if not os.path.exists(save_dir):
-                os.makedirs(save_dir, exist_ok=True)
-            cv.imwrite(path.join(save_dir, file_name + "_" + str(cont) + file_extension), crop_eyes)
-
-    num_eyes = []
-    for filename in glob.glob(save_dir + '/*'):
-        img = cv.imread(filename, cv.IMREAD_COLOR)
-        num_eyes.append(img)
-    # print(len(num_eyes))
-
-    if len(eyes) == 2 or len(num_eyes) == 2:
+    with profiling.stage('eyes/eye_cascade'):
+        gray = cv.cvtColor(img, cv.COLOR_BGR2GRAY)
+
+        eyes = eye_cascade.detectMultiScale(gray, scaleFactor=eyes_ScaleFactor,
+                                            minNeighbors=eyes_minNeighbors,
+                                            minSize=eyes_minSize)
+
+    crops = []
+    if len(eyes) <= 2:
+        crops = [img[ey + 2:ey + eh - 1, ex + 2: ex + ew - 1].copy() for (ex, ey, ew, eh) in eyes]
+
+    if cache:
+        _save_cached_eyes(save_dir, crops)
+
+    return crops
+
+
+def _eyes_memo_key(file, *params):
+    """
+    :return: the memo key of an image (a file name or a BGR image), based on its content and on the
+    detection parameters.
+    """
+    if isinstance(file, str):
+        with open(file, "rb") as fl:
+            key = hashlib.sha1(fl.read())
+    else:
+        key = hashlib.sha1(file.tobytes())
+        key.update(repr(file.shape).encode())
+
+    key.update(repr(params).encode())
+
+    return key.hexdigest()
+
+
+def _load_eyes_memo():
+    """
+    Loads into eyes_memo the eye colors stored in eyes_memo_file (only the first time it is called for that file).
+    """
+    global _eyes_memo_loaded
+
+    if eyes_memo_file is None or _eyes_memo_loaded == eyes_memo_file:
+        return
+
+    if path.exists(eyes_memo_file):
+        with open(eyes_memo_file, "r") as fl:
+            for line in fl:
+                if line.strip():
+                    entry = json.loads(line)
+                    eyes_memo[entry["key"]] = entry["colors"]
+
+    _eyes_memo_loaded = eyes_memo_file
+
+
+def _store_eyes_memo(key, color_eyes):
+    eyes_memo[key] = color_eyes
+
+    if eyes_memo_file is not None:
+        os.makedirs(path.dirname(path.abspath(eyes_memo_file)), exist_ok=True)
+
+        with open(eyes_memo_file, "a") as fl:
+            fl.write(json.dumps({"key": key, "colors": color_eyes}) + "\n")
+
+
+def get_eyes_color(file, eyes_ScaleFactor=1.08, eyes_minNeighbors=3, eyes_minSize=(40, 40), cache=False):
+    """
+    Cat eyes color recognition utility. Results are memoized in eyes_memo (and in eyes_memo_file, if set),
+    so each image is analyzed just once.
+
+    :param file : str or np.ndarray
+        The name of the image file (or the BGR image itself) to detect the eyes from.
+    :param eyes_ScaleFactor: float
+        scaleFactor value the eyes detector should use
+    :param eyes_minNeighbors:
+        minNeighbors value the eyes detector should use
+    :param eyes_minSize:
+        minSize value the eyes detector should use
+    :param cache: if True, the eye crops are cached in cache_dir.
+    :return the sorted list of the possible eye colors, None if no eyes are detected.
+    """
+    _load_eyes_memo()
+
+    key = _eyes_memo_key(file, eyes_ScaleFactor, eyes_minNeighbors, tuple(eyes_minSize))
+    if key in eyes_memo:
+        profiling.count('eyes/memo_hits')
+        return eyes_memo[key]
+
+    profiling.count('eyes/memo_misses')
+
+    with profiling.stage('eyes/decode'):
+        img = cv.imread(file) if isinstance(file, str) else file
+
+    eyes = crop_cat_eyes(img, eyes_ScaleFactor, eyes_minNeighbors, eyes_minSize, cache=cache)
+
+    if len(eyes) == 2:
         print("2 eyes detected!")
 
-        pixel_count_1, pixel_count_2 = analysis_color_eyes(save_dir)
+        pixel_count_1, pixel_count_2 = analysis_color_eyes(eyes)
 
         possible_classes_1 = left_eye_color(pixel_count_1)
         possible_classes_2 = right_eye_color(pixel_count_2)
@@ -104,133 +379,109 @@ def detect_cat_eyes(file, eyes_ScaleFactor=1.08, eyes_minNeighbors=3, eyes_minSi
         color_eyes = final_eyes_color(possible_classes_1, possible_classes_2)
         print(color_eyes)
 
-        subj_list = []
-        subj_list = find_subject_from_eyes_color(color_eyes, subj_list)
-
-        return subj_list
-
-    elif len(eyes) == 1 or len(num_eyes) == 1:
+    elif len(eyes) == 1:
         print("Only 1 eye detected!")
 
-        pixel_count_1, pixel_count_2 = analysis_color_eyes(save_dir)
+        pixel_count_1, pixel_count_2 = analysis_color_eyes(eyes)
         possible_classes_1 = left_eye_color(pixel_count_1)
         print('CLASSI 1', possible_classes_1)
 
-        subj_list = []
-        subj_list = find_subject_from_eyes_color(possible_classes_1, subj_list)
-
-        return subj_list
+        color_eyes = possible_classes_1
 
     else:
         print("No eyes detected!")
-        file_eyes = open('../dataset_info/gallery_eyes_color.txt')
-        lines = []
-        for line in file_eyes:
-            l = line.split('\n')[0]
-            lines.append(l)
-        # print(lines)
-
-        cats = []
-        for cat in lines:
-            s = cat.split('  ')
-            cats.append(s)
-
-        return cats
-
-
-def analysis_color_eyes(save_dir):
-    # Eyes color recognition
-    eyes_pixel_list = []
-
-    for filename in glob.glob(save_dir + "/*"):
-        img = cv.imread(filename, cv.IMREAD_COLOR)
-        im = Image.open(filename)
-        pix = im.load()
-        height, width = img.shape[:2]
-
-        # print(height,width)
-        height = height - 1
-        width = width - 1
-
-        color_pixel_list = []
-        for eh in range(height):
-            for ew in range(width):
-                r, g, b = pix[ew, eh]
-                # print(r,g,b)
-                if r <= 30 and g <= 50 and b <= 114:
-                    # print(eh,ew)
-                    cv.circle(img, (ew, eh), 1, (0, 255, 0), 1)
-                else:
-                    triple = (r, g, b)
-                    color_pixel_list.append(triple)
-        eyes_pixel_list.append(color_pixel_list)
-
-    if len(eyes_pixel_list) == 2:
-
-        pixel_class_1 = {}
-        pixel_class_2 = {}
-        cont_1 = 0
-        cont_2 = 0
-        for i in range(len(class_name)):
-            pixel_class_1[class_name[i]] = 0
-            pixel_class_2[class_name[i]] = 0
-
-        for lista in eyes_pixel_list:
-            for triple in lista:
-                # print(triple)
-                r, g, b = triple
-                for i in range(len(class_name)):
-                    color = eyes_color[class_name[i]]
-                    if (triple[0] <= color[0][0] and (triple[0] >= color[1][0]) and (triple[1] <= color[0][1]) and
-                            triple[1] >= color[1][1] and (triple[2] <= color[0][2]) and (triple[2] >= color[1][2])):
-                        if eyes_pixel_list.index(lista) == 0:
-                            cont_1 += 1
-                            pixel_class_1[class_name[i]] = cont_1
-                        else:
-                            cont_2 += 1
-                            pixel_class_2[class_name[i]] = cont_2
-                    # probe_eye_class = class_name[i]
-                    # print(class_name[i])
-                    # print(triple)
-
-        print(pixel_class_1)
-        print('-------')
-        print(pixel_class_2)
 
-        pixel_count_1 = []
-        pixel_count_2 = []
-        for c in range(len(class_name)):
-            pixel_count_1.append(pixel_class_1[class_name[c]])
-            pixel_count_2.append(pixel_class_2[class_name[c]])
+        color_eyes = None
+
+    if color_eyes is not None:
+        color_eyes = sorted(color_eyes)
+
+    _store_eyes_memo(key, color_eyes)
+
+    return color_eyes
+
+
+def detect_cat_eyes(file, eyes_ScaleFactor=1.08, eyes_minNeighbors=3, eyes_minSize=(40, 40), cache=False):
+    """
+    Cat eyes detection utility.
+
+    :param file : str or np.ndarray
+        The name of the image file (or the BGR image itself) to detect the eyes from.
+    :param eyes_ScaleFactor: float
+        scaleFactor value the eyes detector should use
+    :param eyes_minNeighbors:
+        minNeighbors value the eyes detector should use
+    :param eyes_minSize:
+        minSize value the eyes detector should use
+    :param cache: if True, the eye crops are cached in cache_dir.
+    :return the list of subjects whose eye color matches the detected one (all of them, if no eyes are detected).
+    """
+    color_eyes = get_eyes_color(file, eyes_ScaleFactor, eyes_minNeighbors, eyes_minSize, cache=cache)
+
+    if color_eyes is None:
+        return get_gallery_eyes_index().all_subjects()
+
+    subj_list = []
+    subj_list = find_subject_from_eyes_color(color_eyes, subj_list)
+
+    return subj_list
+
+
+def _count_eye_pixels(eye):
+    """
+    Counts the pixels of an eye crop falling into each eye color class.
+
+    :param eye: RGB image of the eye.
+    :return: list with a pixel count for each class in class_name.
+    """
+    # the last row and column of the crop are not taken into account
+    pixels = eye[:-1, :-1].reshape(-1, 3).astype(np.int16)
+
+    # discard the darkest pixels (pupil)
+    pixels = pixels[~((pixels[:, 0] <= 30) & (pixels[:, 1] <= 50) & (pixels[:, 2] <= 114))]
+
+    if len(pixels) == 0:
+        return [0] * len(class_name)
+
+    # pixels x classes membership mask
+    matches = np.all((pixels[:, np.newaxis, :] <= _color_upper) & (pixels[:, np.newaxis, :] >= _color_lower), axis=2)
+
+    # A single counter is shared by all the classes: each class gets the value the counter had
+    # when its last matching pixel was found (scanning pixels row by row, classes in order)
+    running = np.cumsum(matches.ravel()).reshape(matches.shape)
+    last = matches.shape[0] - 1 - np.argmax(matches[::-1], axis=0)
+    counts = np.where(matches.any(axis=0), running[last, np.arange(len(class_name))], 0)
+
+    return counts.tolist()
+
+
+def analysis_color_eyes(eyes):
+    """
+    Eyes color recognition.
+
+    :param eyes: BGR images of the eyes.
+    :return: the pixel counts per color class of the first and second eye (an empty list if only one eye is
+    available), None if there are no eyes or more than 2.
+    """
+    eyes_pixel_counts = []
+
+    with profiling.stage('eyes/color_analysis'):
+        for eye in eyes:
+            eyes_pixel_counts.append(_count_eye_pixels(cv.cvtColor(eye, cv.COLOR_BGR2RGB)))
+
+    if len(eyes_pixel_counts) == 2:
+        pixel_count_1, pixel_count_2 = eyes_pixel_counts
+
+        print(dict(zip(class_name, pixel_count_1)))
+        print('-------')
+        print(dict(zip(class_name, pixel_count_2)))
 
         return pixel_count_1, pixel_count_2
 
-    if len(eyes_pixel_list) == 1:
-        pixel_class_1 = {}
-        cont_1 = 0
-        for i in range(len(class_name)):
-            pixel_class_1[class_name[i]] = 0
-
-        for lista in eyes_pixel_list:
-            for triple in lista:
-                # print(triple)
-                r, g, b = triple
-                for i in range(len(class_name)):
-                    color = eyes_color[class_name[i]]
-                    if (triple[0] <= color[0][0] and (triple[0] >= color[1][0]) and (triple[1] <= color[0][1]) and
-                            triple[1] >= color[1][1] and (triple[2] <= color[0][2]) and (triple[2] >= color[1][2])):
-                        if eyes_pixel_list.index(lista) == 0:
-                            cont_1 += 1
-                            pixel_class_1[class_name[i]] = cont_1
-                    # probe_eye_class = class_name[i]
-                    # print(class_name[i])
-                    # print(triple)
-
-        print(pixel_class_1)
-
-        pixel_count_1 = []
-        for c in range(len(class_name)):
-            pixel_count_1.append(pixel_class_1[class_name[c]])
+    if len(eyes_pixel_counts) == 1:
+        pixel_count_1 = eyes_pixel_counts[0]
+
+        print(dict(zip(class_name, pixel_count_1)))
 
         return pixel_count_1, []
 
@@ -281,66 +532,71 @@ def final_eyes_color(possible_classes_1, possible_classes_2):
 
 
 def find_subject_from_eyes_color(color_eyes, subj_list):
-    file_eyes = open('../dataset_info/gallery_eyes_color.txt')
-    lines = []
-    for line in file_eyes:
-        l = line.split('\n')[0]
-        lines.append(l)
-    # print(lines)
-
-    cats = []
-    for cat in lines:
-        s = cat.split('  ')
-        cats.append(s)
-    # print(cats)
-
-    for cat in cats:
-        for col in color_eyes:
-            if col == cat[2]:
-                subj_list.append(int(cat[1][1:]))
+    """
+    Appends to subj_list the labels of the gallery subjects having any of the given eye colors.
+    """
+    subj_list.extend(get_gallery_eyes_index().subjects(color_eyes))
     return subj_list
 
 
 def predict(model: cv.face_BasicFaceRecognizer, height, probe_image, probe_label=None, resize=True,
-            identification=True):
+            identification=True, cache_eyes=False, gallery=None, result_cache=None):
+    """
+    Performs a face recognition operation, matching the probe only against the subjects with its same eye color.
+
+    :param model: face recognizer.
+    :param height: height of the images used to train the model.
+    :param probe_image: path to the image of the probe.
+    :param probe_label: label of the probe.
+    :param resize: flag to specify whether the probe image should be resized.
+    :param identification: flag to specify the recognition operation
+                           to carry out (True: identification, False: verification)
+    :param cache_eyes: if True, the eye crops are cached in cache_dir.
+    :param gallery: Gallery of the model; it should be passed when predicting several probes
+                    with the same model, otherwise it is rebuilt at each call.
+    :param result_cache: cache.ResultCache of the identification results, which are reused
+                         for the same (or a nearly identical) probe face.
+    :return: the result of the prediction.
+    """
     if not path.exists(probe_image):
         raise RuntimeError("File {} does not exist!".format(probe_image))
 
-    input_face = cv.imread(probe_image, 0)
+    profiling.count('eyes_predict/probes')
 
-    if resize:
-        input_face = utils.resize_image(input_face, 100, 100)
+    with profiling.stage('eyes_predict/preprocess'):
+        input_face = preprocessing.default.load([probe_image], height if resize else None)[0]
 
-    subj_list = detect_cat_eyes(probe_image)
+    if identification and result_cache is not None:
+        # the candidates also depend on the eye colors of the gallery subjects
+        version = cache.fingerprint('eyes', gallery if gallery is not None else model, get_gallery_eyes_index(),
+                                    preprocessing.default.config, height if resize else None)
 
-    if identification:
-        coll: cv.face_StandardCollector = cv.face.StandardCollector_create()
-        pred = model.predict_collect(input_face, coll)
+        with profiling.stage('eyes_predict/cache'):
+            results, face_hash = result_cache.get(input_face, version)
 
-        results = sorted(coll.getResults(), key=lambda x: x[1])
+        if results is not None:
+            return results
+
+    with profiling.stage('eyes_predict/eyes'):
+        subj_list = detect_cat_eyes(probe_image, cache=cache_eyes)
 
-        # for elem in results:
-        #     print(elem)
-        # print('LISTA SOGGETTI', len(subj_list))
+    if identification:
+        if gallery is None:
+            gallery = Gallery.Gallery(model)
 
-        if len(subj_list) != 23:
-            limited_subjects_list = []
-            for t in results:
-                sub, sco = t
-                for i in subj_list:
-                    if i == sub:
-                        limited_subjects_list.append(t)
+        with profiling.stage('eyes_predict/match'):
+            # distances are computed only against the templates of the candidate subjects
+            results = gallery.predict(input_face, subj_list)
 
-            # print(limited_subjects_list)
+            if len(results) == 0:
+                # none of the candidates is in the gallery
+                profiling.count('eyes_predict/fallbacks')
+                results = gallery.predict(input_face)
 
-            # if probe_label is not None: print("Predicted class = {0} ({1}) with confidence = {2}; Actual class = {
-            # 3} ({4}).\n\t Outcome: {5}" .format(limited_subjects_list[0][0], get_subject_name(
-            # limited_subjects_list[0][0]), limited_subjects_list[0][1], probe_label, get_subject_name(probe_label),
-            # "Success!" if limited_subjects_list[0][0] == probe_label else "Failure!"))
+        if result_cache is not None:
+            result_cache.put(face_hash, results, version)
 
-            return limited_subjects_list if len(limited_subjects_list) > 0 else results
-        else:
-            return results
+        return results
 
     else:
         prediction = model.predict(input_face)
@@ -360,6 +616,16 @@ def parse_args():
     parser.add_argument('-k', '--subsets', help='The number of subsets in which to divide the dataset', type=int,
                         default=5)
     parser.add_argument('-i', '--impostors', help='The number of impostors to use', type=int, default=5)
+    parser.add_argument('-m', '--eyes-memo', help='The file where to store the eye colors of the probes, '
+                                                  'to reuse them across runs', default=None)
+    parser.add_argument('--auto-thresholds', help='Choose the thresholds from the range of the scores '
+                        'instead of the predefined ones', action='store_true')
+    parser.add_argument('--report-dir', help='Save the figures and a JSON report to this directory '
+                        'instead of showing them (for headless runs)', default=None)
+    parser.add_argument('--exact', help='Also compute the rates at every score and report the exact EER of each '
+                        'model', action='store_true')
+    preprocessing.add_arguments(parser)
+    profiling.add_argument(parser, '../test/profile/eyes_recognizer')
     # parser.add_argument('-es', '--eyes-scalefactor', default=1.08, type=float)
     # parser.add_argument('-en', '--eyes-minneighbors', default=3, type=int)
     # parser.add_argument('-em', '--eyes-minsize', default=40, type=int)
@@ -370,6 +636,18 @@ def parse_args():
 if __name__ == '__main__':
     args = parse_args()
 
+    profiling.start(args.profile)
+    preprocessing.configure(args)
+
+    # imported here, as they are needed just to evaluate the performances
+    import Recognition_Tests
+    import reports
+
+    report = reports.Report(args.report_dir) if args.report_dir is not None else None
+
+    # the evaluation goes through the imported module, not through __main__
+    Recognition_Tests.Eyes_Recognizer.eyes_memo_file = args.eyes_memo
+
     # eyes_sf = args.eyes_scalefactor
     # eyes_n = args.eyes_minneighbors
     # eyes_ms = (args.eyes_minsize, args.eyes_minsize)
@@ -418,13 +696,31 @@ if __name__ == '__main__':
         test_thresholds = np.linspace(150, 200, 100)
         model_name = 'LBPH'
 
-    avgs = Recognition_Tests.evaluate_avg_performances(model, test_thresholds, k_fold_files)
-    eye_avgs = Recognition_Tests.evaluate_avg_performances(model, test_thresholds, k_fold_files, use_eyes=True)
+    if args.auto_thresholds:
+        test_thresholds = None
+
+    # the folds are trained and matched once for both the evaluations
+    folds = Recognition_Tests.compute_folds(model, k_fold_files)
+    eye_folds = Recognition_Tests.compute_folds(model, k_fold_files, use_eyes=True)
+
+    avgs = Recognition_Tests.evaluate_avg_performances(model, test_thresholds, k_fold_files, folds=folds)
+    eye_avgs = Recognition_Tests.evaluate_avg_performances(model, test_thresholds, k_fold_files, folds=eye_folds)
+
+    if args.exact:
+        for mode_folds, name in [(folds, ' without eye color detection'), (eye_folds, ' with eye color detection')]:
+            Recognition_Tests.print_exact_performances(
+                Recognition_Tests.evaluate_exact_performances(model, k_fold_files, folds=mode_folds),
+                model_name + name, report, model_name.lower().rstrip('.'))
 
     utils.plot_error_rates([avgs, eye_avgs], [model_name + ' without eye color detection', model_name + 'with eye '
                                                                                                         'color '
-                                                                                                        'detection'])
+                                                                                                        'detection'],
+                           report=report, name=model_name.lower().rstrip('.'))
     utils.plot_rocs([avgs, eye_avgs], [model_name + ' without eye color detection', model_name + 'with eye color '
-                                                                                                 'detection'])
+                                                                                                 'detection'],
+                    report=report, name=model_name.lower().rstrip('.'))
+
+    if report is not None:
+        report.close()
 
     # test(model, image)
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module provides a fusion recognizer, which trains Eigenfaces, Fisherfaces and LBPH on the same decoded and
+resized faces and fuses their distances into a single ranked list.
+
+All the engines are trained on the same images, so each training image has a distance for each engine: for every
+probe, the distances of each engine are normalized (min-max or z-score, over the templates) and the weighted mean
+of the normalized distances ranks the templates, in the same (label, distance) format of Recognizer.predict.
+
+Authors:
+    Pg96, dsforza96
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import cv2.cv2 as cv
+import numpy as np
+import time
+
+import Gallery
+import preprocessing
+import profiling
+import utils
+
+# name and factory of each engine, with the parameters the other mains use
+engines = [("eigenfaces", lambda: cv.face.EigenFaceRecognizer_create(num_components=10)),
+           ("fisherfaces", lambda: cv.face.FisherFaceRecognizer_create(num_components=80)),
+           ("lbph", lambda: cv.face.LBPHFaceRecognizer_create(radius=2, neighbors=16))]
+
+normalizations = ['minmax', 'z']
+
+
+def normalize(dists, normalization='minmax'):
+    """
+    Normalizes the distances of a probe from the templates of an engine.
+
+    :param dists: distances from the templates.
+    :param normalization: 'minmax' (to [0, 1]) or 'z' (zero mean, unit standard deviation).
+    :return: the normalized distances.
+    """
+    if normalization == 'minmax':
+        spread = dists.max() - dists.min()
+        return (dists - dists.min()) / spread if spread > 0 else np.zeros_like(dists)
+
+    if normalization == 'z':
+        std = dists.std()
+        return (dists - dists.mean()) / std if std > 0 else np.zeros_like(dists)
+
+    raise ValueError('Unknown normalization {}, choose one of {}'.format(normalization, normalizations))
+
+
+class FusionRecognizer:
+    """
+    Eigenfaces, Fisherfaces and LBPH trained on a shared face stack, whose distances are fused.
+    """
+
+    def __init__(self, weights=None, normalization='z', names=None):
+        """
+        :param weights: dictionary engine name -> fusion weight (missing engines weigh 1).
+        :param normalization: normalization of the distances of each engine, one of normalizations.
+        :param names: names of the engines to use (default: all the engines).
+        """
+        if normalization not in normalizations:
+            raise ValueError('Unknown normalization {}, choose one of {}'.format(normalization, normalizations))
+
+        self.names = names or [name for name, _ in engines]
+        self.weights = dict((name, (weights or dict()).get(name, 1.0)) for name in self.names)
+        self.normalization = normalization
+        self.height = None
+        self.galleries = dict()
+
+        self._timings = dict((name, [0, 0.0]) for name in self.names)  # name -> calls, total seconds
+        self._executor = ThreadPoolExecutor(max_workers=len(self.names))
+
+    def train(self, csv_filename, resize=True):
+        """
+        Decodes and resizes the training images once and trains all the engines on them.
+
+        :param csv_filename: file containing the images to be used for the training process.
+        :param resize: flag to specify whether images should be resized.
+        :return: the labels of the subjects the engines were trained with.
+        """
+        with profiling.stage('fusion/read_csv'):
+            faces, labels = utils.read_csv(csv_filename, resize)
+
+        # a single stack, whose views are shared by all the engines
+        stack = np.stack(faces)
+        faces = list(stack)
+        labels = np.array(labels)
+        self.height = stack.shape[1]
+
+        def fit(name):
+            recognizer = dict(engines)[name]()
+
+            with profiling.stage('fusion/train/' + name):
+                recognizer.train(faces, labels)
+                self.galleries[name] = Gallery.Gallery(recognizer)
+
+        list(self._executor.map(fit, self.names))
+
+        return set(labels.tolist())
+
+    def _score(self, name, face):
+        """
+        :return: the distances of a probe from the templates of an engine.
+        """
+        start = time.perf_counter()
+
+        with profiling.stage('fusion/score/' + name):
+            gallery = self.galleries[name]
+            dists = gallery.distances(gallery.project(face), gallery.rows())
+
+        timing = self._timings[name]
+        timing[0] += 1
+        timing[1] += time.perf_counter() - start
+
+        return dists
+
+    def scores(self, face):
+        """
+        Scores a probe with all the engines concurrently.
+
+        :param face: grayscale probe image, with the same size of the training ones.
+        :return: dictionary engine name -> distances from the templates (in gallery order).
+        """
+        futures = [(name, self._executor.submit(self._score, name, face)) for name in self.names]
+
+        return dict((name, future.result()) for name, future in futures)
+
+    def fuse(self, scores):
+        """
+        :param scores: distances of each engine, as returned by scores().
+        :return: the fused (label, distance) couples, sorted by distance.
+        """
+        fused = sum(self.weights[name] * normalize(dists, self.normalization) for name, dists in scores.items())
+        fused /= sum(self.weights[name] for name in scores)
+
+        gallery = self.galleries[self.names[0]]
+
+        return gallery._ranking(gallery.rows(), fused)
+
+    def predict(self, face):
+        """
+        :param face: grayscale probe image, with the same size of the training ones.
+        :return: the fused (label, distance) couples, sorted by distance, as Recognizer.predict.
+        """
+        with profiling.stage('fusion/fuse'):
+            return self.fuse(self.scores(face))
+
+    def timings(self):
+        """
+        :return: dictionary engine name -> number of scored probes, total and mean time (in ms).
+        """
+        return dict((name, dict([("probes", calls), ("total_ms", total * 1000),
+                                 ("mean_ms", total * 1000 / calls if calls else None)]))
+                    for name, (calls, total) in self._timings.items())
+
+    def close(self):
+        self._executor.shutdown()
+
+
+def parse_weights(weights):
+    """
+    :param weights: strings name=weight.
+    :return: dictionary engine name -> weight.
+    """
+    ret = dict()
+
+    for weight in weights or []:
+        name, _, value = weight.partition('=')
+        if name not in dict(engines):
+            raise ValueError('Unknown engine {}'.format(name))
+        ret[name] = float(value)
+
+    return ret
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('-t', '--train', help='The csv file of the images to train the engines with',
+                        default='../test/k_fold/complete/csv/1_train.csv')
+    parser.add_argument('-e', '--test', help='The csv file of the probe images',
+                        default='../test/k_fold/complete/csv/1_test.csv')
+    parser.add_argument('-w', '--weights', help='Fusion weights, as name=weight (e.g. lbph=2)', nargs='*')
+    parser.add_argument('-n', '--normalization', default='z', choices=normalizations)
+    parser.add_argument('--engines', help='The engines to fuse', nargs='+', choices=[name for name, _ in engines],
+                        default=None)
+    preprocessing.add_arguments(parser)
+    profiling.add_argument(parser, '../test/profile/fusion')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    import Recognition_Tests
+
+    args = parse_args()
+
+    profiling.start(args.profile)
+    preprocessing.configure(args)
+
+    fusion = FusionRecognizer(parse_weights(args.weights), args.normalization, args.engines)
+    gallery_labels = fusion.train(args.train)
+
+    _, files = utils.read_csv(args.test, mapping=True)
+    probes = [(file, utils.get_label(file)) for file in files]
+    faces = preprocessing.default.load(files, fusion.height)
+
+    # each engine on its own and the fusion, from the same scores
+    matrices = dict((name, dict()) for name in fusion.names + ['fusion'])
+
+    for (file, label), face in zip(probes, faces):
+        probe_scores = fusion.scores(face)
+
+        for name, dists in probe_scores.items():
+            gallery = fusion.galleries[name]
+            matrices[name][(file, label)] = gallery._ranking(gallery.rows(), dists)
+
+        matrices['fusion'][(file, label)] = fusion.fuse(probe_scores)
+
+    for name, matrix in matrices.items():
+        genuine, impostor = Recognition_Tests.rank1_scores(matrix, gallery_labels)
+        rates = Recognition_Tests.exact_rates(genuine, impostor)
+        _, err = utils.equal_error_rate(rates["thresholds"], rates["FAR"], rates["FRR"])
+
+        print("{}: rank-1 identification rate = {:.4f}, EER = {}".format(
+            name, np.isfinite(genuine).mean(), "{:.4f}".format(err[0]) if len(err) != 0 else None))
+
+    for name, timing in fusion.timings().items():
+        print("{}: {} probes scored in {:.1f} ms ({:.2f} ms per probe)".format(
+            name, timing["probes"], timing["total_ms"], timing["mean_ms"]))
+
+    fusion.close()
@@ -0,0 +1,936 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module provides a NumPy view of the gallery of a trained face recognizer,
+which allows to match a probe against just a subset of the enrolled subjects.
+
+The gallery can be kept (and saved) in reduced precision, to save memory and bandwidth with large galleries:
+float32, float16 or int8 (with a scale for each projection and eigenvector; LBPH histograms keep their exact bin
+counts in 8 bits). The main compares the reduced precisions with float64.
+
+Authors:
+    Pg96, dsforza96
+"""
+
+from argparse import ArgumentParser
+import cv2.cv2 as cv
+import json
+import math
+import numpy as np
+
+import cache
+import preprocessing
+import profiling
+
+precisions = ['float64', 'float32', 'float16', 'int8']
+
+
+def quantize(matrix, precision, axis=1):
+    """
+    Converts a matrix to a given precision.
+
+    :param matrix: matrix to convert.
+    :param precision: one of precisions.
+    :param axis: axis along which the vectors lie (1: rows, 0: columns); int8 vectors get a scale each.
+    :return: the converted matrix and the scales of its vectors (None if the precision is not int8).
+    """
+    if precision not in precisions:
+        raise ValueError('Unknown precision {}, choose one of {}'.format(precision, precisions))
+
+    if precision != 'int8':
+        return matrix.astype(precision), None
+
+    scales = np.abs(matrix).max(axis=axis, keepdims=True).astype(np.float32) / 127
+    scales[scales == 0] = 1
+
+    return np.rint(matrix / scales).astype(np.int8), scales.ravel()
+
+
+def dequantize(matrix, scales, axis=1):
+    """
+    :return: the matrix in float32 (float64 if it is already so), its vectors multiplied by their scales.
+    """
+    if scales is None:
+        return matrix if matrix.dtype == np.float64 else matrix.astype(np.float32)
+
+    return matrix.astype(np.float32) * (scales.reshape(-1, 1) if axis == 1 else scales.reshape(1, -1))
+
+
+def elbp(src, radius, neighbors):
+    """
+    Computes the extended local binary patterns of an image, exactly as the OpenCV LBPH recognizer does.
+
+    :param src: grayscale image.
+    :param radius: radius of the circular neighborhood.
+    :param neighbors: number of sample points of the neighborhood.
+    :return: the LBP image, smaller than src by radius pixels on each side.
+    """
+    src = np.asarray(src)
+    rows, cols = src.shape
+    center = src[radius:rows - radius, radius:cols - radius].astype(np.float32)
+    dst = np.zeros(center.shape, dtype=np.int64)
+
+    def window(dy, dx):
+        return src[radius + dy:rows - radius + dy, radius + dx:cols - radius + dx]
+
+    eps = np.finfo(np.float32).eps
+
+    for n in range(neighbors):
+        # sample points
+        x = np.float32(radius * math.cos(2.0 * math.pi * n / float(np.float32(neighbors))))
+        y = np.float32(-radius * math.sin(2.0 * math.pi * n / float(np.float32(neighbors))))
+        # relative indices
+        fx, fy = int(math.floor(x)), int(math.floor(y))
+        cx, cy = int(math.ceil(x)), int(math.ceil(y))
+        # fractional part
+        ty = y - np.float32(fy)
+        tx = x - np.float32(fx)
+        # interpolation weights
+        w1 = (np.float32(1) - tx) * (np.float32(1) - ty)
+        w2 = tx * (np.float32(1) - ty)
+        w3 = (np.float32(1) - tx) * ty
+        w4 = tx * ty
+
+        t = w1 * window(fy, fx) + w2 * window(fy, cx) + w3 * window(cy, fx) + w4 * window(cy, cx)
+
+        dst += ((t > center) | (np.abs(t - center) < eps)).astype(np.int64) << n
+
+    return dst
+
+
+def spatial_histogram(lbp, num_patterns, grid_x, grid_y):
+    """
+    Computes the normalized spatial histogram of an LBP image, as a sparse vector.
+
+    :param lbp: LBP image.
+    :param num_patterns: number of possible patterns (bins of each cell histogram).
+    :param grid_x: number of cells along the x axis.
+    :param grid_y: number of cells along the y axis.
+    :return: the sorted indices of the non-zero bins of the whole histogram and their values.
+    """
+    height = lbp.shape[0] // grid_y
+    width = lbp.shape[1] // grid_x
+
+    # (grid_y, height, grid_x, width) -> (grid_y, grid_x, height * width)
+    cells = lbp[:grid_y * height, :grid_x * width].reshape(grid_y, height, grid_x, width).swapaxes(1, 2)
+    cells = cells.reshape(grid_y * grid_x, height * width)
+
+    bins = (np.arange(grid_y * grid_x, dtype=np.int64)[:, np.newaxis] * num_patterns + cells).ravel()
+    indices, counts = np.unique(bins, return_counts=True)
+
+    return indices, counts.astype(np.float32) * np.float32(1.0 / (height * width))
+
+
+class Gallery:
+    """
+    Templates of the images a face recognizer was trained with, grouped by subject.
+
+    Eigenfaces and Fisherfaces templates are the projections of the training images, compared to the probe ones
+    through the euclidean distance; LBPH templates are the (sparse) spatial histograms of the training images,
+    compared to the probe one through the chi-square distance. The distances are the same the recognizer computes
+    in float64 precision (LBPH histograms are float32 in the recognizer too, so float64 and float32 coincide).
+    """
+
+    def __init__(self, recognizer: cv.face_BasicFaceRecognizer, precision='float64'):
+        """
+        :param recognizer: trained face recognizer.
+        :param precision: precision of the stored templates (and eigenvectors), one of precisions.
+        """
+        labels = recognizer.getLabels().ravel()
+
+        # the samples of each subject are stored contiguously
+        self._order = np.argsort(labels, kind='stable')
+        self.labels = labels[self._order]
+        self._init_slices()
+
+        self.lbph = type(recognizer) is cv.face_LBPHFaceRecognizer
+        self.precision = precision
+        # templates never change after being built, so a token identifies them (e.g. for cache.ResultCache)
+        self.version = cache.new_version()
+
+        if self.lbph:
+            self._radius = recognizer.getRadius()
+            self._neighbors = recognizer.getNeighbors()
+            self._grid_x = recognizer.getGridX()
+            self._grid_y = recognizer.getGridY()
+
+            histograms = recognizer.getHistograms()
+            indices = []
+            values = []
+
+            for i in self._order:
+                hist = histograms[i].ravel()
+                nz = np.flatnonzero(hist)
+                indices.append(nz)
+                values.append(hist[nz])
+
+            self._store_histograms(indices, values)
+
+        else:
+            mean = recognizer.getMean().reshape(1, -1)
+            self._mean = mean if precision == 'float64' else mean.astype(np.float32)
+            # a scale for each eigenvector (column)
+            self._eigenvectors, self._eigen_scales = quantize(recognizer.getEigenVectors(), precision, axis=0)
+
+            self._store_templates(np.vstack([p.reshape(1, -1) for p in recognizer.getProjections()])[self._order])
+
+    def _store_histograms(self, indices, values):
+        """
+        Stores the LBPH templates, in the precision of the gallery.
+
+        :param indices: non-zero bins of each histogram.
+        :param values: float32 values of the non-zero bins of each histogram.
+        """
+        self._ptr = np.zeros(len(indices) + 1, dtype=np.int64)
+        self._ptr[1:] = np.cumsum([len(x) for x in indices])
+        # bins are fewer than 2^31 for any practical grid and number of neighbors
+        self._indices = np.concatenate(indices).astype(np.int32)
+
+        if self.precision in ('float64', 'float32'):
+            self._values, self._value_scales = np.concatenate(values), None
+        elif self.precision == 'float16':
+            self._values, self._value_scales = np.concatenate(values).astype(np.float16), None
+        else:
+            self._store_int8_values(np.concatenate(values).astype(np.float32),
+                                    np.repeat(np.arange(len(values)), [len(v) for v in values]))
+
+        # sums of the stored values, so that the chi-square is consistent with them
+        self._sums = np.array([self._stored_values(np.arange(self._ptr[i], self._ptr[i + 1]), i)
+                              .sum(dtype=np.float64) for i in range(len(values))])
+
+    def _store_int8_values(self, values, owners):
+        """
+        Stores the LBPH values in 8 bits.
+
+        The values of the recognizer's histograms are the bin counts of each cell divided by its number of pixels:
+        for cells of at most 255 pixels, the counts are stored exactly (as uint8) with a single scale. Otherwise
+        (e.g. averaged histograms), the values are quantized to int8 with a scale for each cell of each histogram.
+
+        :param values: float32 values of the non-zero bins of all the histograms.
+        :param owners: histogram each value belongs to.
+        """
+        unit = values.min() if len(values) != 0 else np.float32(1)
+        counts = np.rint(values / unit)
+
+        if counts.max(initial=0) <= 255 and np.array_equal(counts.astype(np.float32) * unit, values):
+            self._values = counts.astype(np.uint8)
+            self._value_scales = np.array(unit, dtype=np.float32)
+            return
+
+        n_cells = self._grid_x * self._grid_y
+        cells = owners * n_cells + self._indices // 2 ** self._neighbors
+
+        scales = np.zeros((len(self._ptr) - 1) * n_cells, dtype=np.float32)
+        np.maximum.at(scales, cells, np.abs(values) / 127)
+        scales[scales == 0] = 1
+
+        self._values = np.rint(values / scales[cells]).astype(np.int8)
+        self._value_scales = scales.reshape(-1, n_cells)
+
+    def _store_templates(self, templates):
+        """
+        Stores the Eigenfaces/Fisherfaces templates (float64 projections, one per row), in the precision of the gallery.
+        """
+        self.templates, self._template_scales = quantize(templates, self.precision)
+        self._sq_norms = (dequantize(self.templates, self._template_scales).astype(np.float64) ** 2).sum(axis=1)
+
+    def _template(self, row):
+        """
+        :return: a stored template, in the form project() returns.
+        """
+        if self.lbph:
+            entries = np.arange(self._ptr[row], self._ptr[row + 1])
+            return self._indices[entries], self._stored_values(entries, row)
+
+        return dequantize(self.templates[row:row + 1], None if self._template_scales is None else
+                          self._template_scales[row:row + 1]).astype(np.float64)
+
+    def compacted(self, per_subject=1, method='centroids', iterations=20):
+        """
+        Builds a gallery with a few representative templates per subject.
+
+        The templates of each subject are clustered through k-medoids on their distances (euclidean or chi-square),
+        and each cluster is represented by its medoid or by its centroid (the mean projection or histogram).
+
+        :param per_subject: maximum number of templates to keep for each subject.
+        :param method: 'centroids' or 'medoids'.
+        :param iterations: maximum number of k-medoids iterations.
+        :return: the compact gallery, sharing the projection (or the LBP parameters) with this one.
+        """
+        if method not in ('centroids', 'medoids'):
+            raise ValueError('Unknown compaction method {}'.format(method))
+
+        compact = Gallery.__new__(Gallery)
+        compact.lbph = self.lbph
+        compact.precision = self.precision
+        compact.version = cache.new_version()
+
+        if self.lbph:
+            compact._radius, compact._neighbors = self._radius, self._neighbors
+            compact._grid_x, compact._grid_y = self._grid_x, self._grid_y
+        else:
+            compact._mean, compact._eigenvectors, compact._eigen_scales = \
+                self._mean, self._eigenvectors, self._eigen_scales
+
+        labels = []
+        representatives = []
+
+        for subject in self.subjects():
+            rows = self.rows([subject])
+            templates = [self._template(row) for row in rows]
+
+            with profiling.stage('gallery/compact'):
+                dists = np.vstack([self.distances(template, rows) for template in templates])
+                clusters = _k_medoids(dists, min(per_subject, len(rows)), iterations)
+
+            for medoid, members in clusters:
+                if method == 'medoids':
+                    representatives.append(templates[medoid])
+                elif self.lbph:
+                    indices = np.concatenate([templates[m][0] for m in members])
+                    values = np.concatenate([templates[m][1] for m in members])
+                    bins, inverse = np.unique(indices, return_inverse=True)
+                    representatives.append((bins, (np.bincount(inverse, weights=values) / len(members))
+                                            .astype(np.float32)))
+                else:
+                    representatives.append(np.mean([templates[m] for m in members], axis=0))
+
+                labels.append(subject)
+
+        compact.labels = np.array(labels, dtype=self.labels.dtype)
+        compact._order = np.arange(len(labels))
+        compact._init_slices()
+
+        if self.lbph:
+            compact._store_histograms([r[0] for r in representatives], [r[1] for r in representatives])
+        else:
+            compact._store_templates(np.vstack(representatives))
+
+        return compact
+
+    def _init_slices(self):
+        subjects, starts = np.unique(self.labels, return_index=True)
+        stops = np.append(starts[1:], len(self.labels))
+        self._slices = dict(zip(subjects.tolist(), zip(starts.tolist(), stops.tolist())))
+
+    def _stored_values(self, entries, owners=None):
+        """
+        :param entries: indices of the LBPH values to read.
+        :param owners: rows of the templates the entries belong to (needed for int8 values).
+        :return: the values as float32.
+        """
+        if self._value_scales is None:
+            return self._values[entries].astype(np.float32)
+
+        # bin counts, with a single scale
+        if self._value_scales.ndim == 0:
+            return self._values[entries].astype(np.float32) * self._value_scales
+
+        if owners is None:
+            owners = np.searchsorted(self._ptr, entries, side='right') - 1
+
+        cells = self._indices[entries] // 2 ** self._neighbors
+
+        return self._values[entries].astype(np.float32) * self._value_scales[owners, cells]
+
+    def __len__(self):
+        return len(self.labels)
+
+    def nbytes(self):
+        """
+        :return: the memory taken by the stored templates (and eigenvectors), in bytes.
+        """
+        if self.lbph:
+            arrays = [self._ptr, self._indices, self._values, self._value_scales, self._sums]
+        else:
+            arrays = [self._mean, self._eigenvectors, self._eigen_scales, self.templates, self._template_scales]
+
+        return sum(a.nbytes for a in arrays if a is not None)
+
+    def save(self, file_name, **metadata):
+        """
+        Saves the gallery to a .npz file.
+
+        :param file_name: the file where to save the gallery.
+        :param metadata: additional integer values to save (e.g. the height of the images).
+        """
+        names = ['_ptr', '_indices', '_values', '_value_scales', '_sums', '_radius', '_neighbors', '_grid_x',
+                 '_grid_y'] if self.lbph else ['_mean', '_eigenvectors', '_eigen_scales', 'templates',
+                                               '_template_scales', '_sq_norms']
+        arrays = dict((name, getattr(self, name)) for name in names if getattr(self, name) is not None)
+
+        np.savez(file_name, labels=self.labels, order=self._order, lbph=self.lbph, precision=self.precision,
+                 metadata=np.array([list(metadata.keys()), [str(v) for v in metadata.values()]]), **arrays)
+
+    @classmethod
+    def load(cls, file_name):
+        """
+        Loads a gallery saved by save().
+
+        :return: the gallery and the dictionary of the saved metadata.
+        """
+        gallery = cls.__new__(cls)
+
+        with np.load(file_name) as data:
+            gallery.labels = data['labels']
+            gallery._order = data['order']
+            gallery.lbph = bool(data['lbph'])
+            gallery.precision = str(data['precision'])
+            gallery.version = cache.new_version()
+            metadata = dict((key, int(value)) for key, value in zip(*data['metadata'].tolist()))
+
+            if gallery.lbph:
+                for name in ['_ptr', '_indices', '_values', '_sums']:
+                    setattr(gallery, name, data[name])
+                for name in ['_radius', '_neighbors', '_grid_x', '_grid_y']:
+                    setattr(gallery, name, int(data[name]))
+                gallery._value_scales = data['_value_scales'] if '_value_scales' in data.files else None
+            else:
+                for name in ['_mean', '_eigenvectors', 'templates', '_sq_norms']:
+                    setattr(gallery, name, data[name])
+                gallery._eigen_scales = data['_eigen_scales'] if '_eigen_scales' in data.files else None
+                gallery._template_scales = data['_template_scales'] if '_template_scales' in data.files else None
+
+        gallery._init_slices()
+
+        return gallery, metadata
+
+    def subjects(self):
+        """
+        :return: the sorted labels of the subjects in the gallery.
+        """
+        return list(self._slices.keys())
+
+    def rows(self, subjects=None):
+        """
+        :param subjects: labels of the subjects to select, None to select the whole gallery.
+        :return: the indices of the templates belonging to the given subjects.
+        """
+        if subjects is None:
+            return np.arange(len(self.labels))
+
+        ranges = [self._slices[s] for s in sorted(set(subjects)) if s in self._slices]
+        if len(ranges) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        return np.concatenate([np.arange(start, stop) for start, stop in ranges])
+
+    def project(self, face):
+        """
+        :param face: grayscale probe image, with the same size of the training ones.
+        :return: the template of the probe.
+        """
+        if self.lbph:
+            lbp = elbp(face, self._radius, self._neighbors)
+            return spatial_histogram(lbp, 2 ** self._neighbors, self._grid_x, self._grid_y)
+
+        return self._project(face.reshape(1, -1))
+
+    def _project(self, x):
+        """
+        :param x: probe images, one per row.
+        :return: the projections of the probes.
+        """
+        x = x.astype(self._mean.dtype) - self._mean
+
+        if self._eigen_scales is None:
+            return x @ (self._eigenvectors if self._eigenvectors.dtype == x.dtype else
+                        self._eigenvectors.astype(x.dtype))
+
+        # the scale of each eigenvector applies to the corresponding projection coordinate
+        return (x @ self._eigenvectors.astype(np.float32)) * self._eigen_scales.reshape(1, -1)
+
+    def _euclidean(self, probes, rows):
+        """
+        :param probes: projections of the probes, one per row.
+        :param rows: indices of the gallery templates to compare the probes to.
+        :return: probes x rows matrix of the euclidean distances.
+        """
+        if self._template_scales is None:
+            templates = self.templates[rows]
+            if templates.dtype != probes.dtype:
+                templates = templates.astype(probes.dtype)
+
+            return np.linalg.norm(templates[np.newaxis, :, :] - probes[:, np.newaxis, :], axis=2)
+
+        # int8: |p - s q|^2 = |p|^2 - 2 s (p . q) + |s q|^2
+        dots = (probes @ self.templates[rows].astype(np.float32).T) * self._template_scales[rows].reshape(1, -1)
+        squared = (probes.astype(np.float64) ** 2).sum(axis=1).reshape(-1, 1) - 2 * dots + self._sq_norms[rows]
+
+        return np.sqrt(np.maximum(squared, 0))
+
+    def distances(self, probe, rows):
+        """
+        :param probe: template of the probe.
+        :param rows: indices of the gallery templates to compare the probe to.
+        :return: the distances between the probe and the selected templates.
+        """
+        if not self.lbph:
+            return self._euclidean(probe, rows)[0]
+
+        q_indices, q_values = probe
+
+        # entries of the selected templates
+        starts = self._ptr[rows]
+        lengths = self._ptr[rows + 1] - starts
+        entries = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        owners = np.repeat(np.arange(len(rows)), lengths)
+
+        # probe values at the non-zero bins of the templates
+        q_dense = np.zeros(self._grid_x * self._grid_y * 2 ** self._neighbors, dtype=np.float32)
+        q_dense[q_indices] = q_values
+
+        a = self._stored_values(entries, rows[owners])
+        b = q_dense[self._indices[entries]]
+
+        # chi-square: 2 * sum((a - b)^2 / (a + b)) = 2 * sum(a) + 2 * sum(b) - 8 * sum(a * b / (a + b)),
+        # where the last sum only involves the bins that are non-zero in both histograms
+        common = b > 0
+        a = a[common].astype(np.float64)
+        b = b[common].astype(np.float64)
+        shared = np.bincount(owners[common], weights=a * b / (a + b), minlength=len(rows))
+
+        return 2 * self._sums[rows] + 2 * q_values.sum(dtype=np.float64) - 8 * shared
+
+    def predict(self, face, subjects=None):
+        """
+        Matches a probe against the templates of the given subjects.
+
+        :param face: grayscale probe image, with the same size of the training ones.
+        :param subjects: labels of the subjects to match the probe against, None to use the whole gallery.
+        :return: (label, distance) couples, sorted by distance, as the recognizers' StandardCollector results.
+        """
+        rows = self.rows(subjects)
+
+        with profiling.stage('gallery/project'):
+            probe = self.project(face)
+
+        with profiling.stage('gallery/distances'):
+            dists = self.distances(probe, rows)
+
+        profiling.count('gallery/comparisons', len(rows))
+
+        return self._ranking(rows, dists)
+
+    def predict_many(self, faces, subjects=None):
+        """
+        Matches a batch of probes against the templates of the given subjects.
+
+        :param faces: grayscale probe images, with the same size of the training ones.
+        :param subjects: labels of the subjects to match the probes against, None to use the whole gallery.
+        :return: the results of predict() for each probe.
+        """
+        if self.lbph or len(faces) == 0:
+            return [self.predict(face, subjects) for face in faces]
+
+        rows = self.rows(subjects)
+
+        with profiling.stage('gallery/project'):
+            probes = self._project(np.vstack([face.reshape(1, -1) for face in faces]))
+
+        with profiling.stage('gallery/distances'):
+            dists = self._euclidean(probes, rows)
+
+        profiling.count('gallery/comparisons', len(rows) * len(faces))
+
+        return [self._ranking(rows, d) for d in dists]
+
+    def _ranking(self, rows, dists):
+        """
+        :return: (label, distance) couples of the given templates, sorted by distance (ties in training order).
+        """
+        ranking = np.lexsort((self._order[rows], dists))
+
+        return list(zip(self.labels[rows][ranking].tolist(), dists[ranking].tolist()))
+
+
+def _k_medoids(dists, k, iterations=20):
+    """
+    Clusters some templates through k-medoids (alternating assignment and medoid update).
+
+    :param dists: matrix of the distances between the templates.
+    :param k: maximum number of clusters (at most one per distinct template).
+    :param iterations: maximum number of iterations.
+    :return: (medoid, members) couples, as indices of the templates; no cluster is empty.
+    """
+    # identical templates (e.g. duplicated images) are at a zero (up to rounding) distance from each other:
+    # just the first of each group of duplicates can be chosen as an initial medoid
+    symmetric = np.maximum(dists, dists.T)
+    same = symmetric <= 1e-9 * max(float(symmetric.max()), 1.0)
+    distinct = np.flatnonzero(~np.tril(same, k=-1).any(axis=1))
+
+    # deterministic initialization: the most central template, then the farthest ones from the chosen medoids
+    medoids = [int(distinct[dists[distinct].sum(axis=1).argmin()])]
+    while len(medoids) < min(k, len(distinct)):
+        medoids.append(int(distinct[dists[np.ix_(medoids, distinct)].min(axis=0).argmax()]))
+
+    for _ in range(iterations):
+        assignment = dists[medoids].argmin(axis=0)
+        updated = []
+
+        for c in range(len(medoids)):
+            members = np.flatnonzero(assignment == c)
+
+            # a cluster left without members (its medoid is a duplicate of another one) is dropped
+            if len(members) != 0:
+                updated.append(int(members[dists[np.ix_(members, members)].sum(axis=1).argmin()]))
+
+        if updated == medoids:
+            break
+        medoids = updated
+
+    assignment = dists[medoids].argmin(axis=0)
+    clusters = [(medoid, np.flatnonzero(assignment == c)) for c, medoid in enumerate(medoids)]
+
+    return [(medoid, members) for medoid, members in clusters if len(members) != 0]
+
+
+def top_subjects(results, n):
+    """
+    :return: the first n distinct labels of some (label, distance) results.
+    """
+    top = []
+    for label, _ in results:
+        if label not in top:
+            top.append(label)
+            if len(top) == n:
+                break
+
+    return top
+
+
+class CompactGallery:
+    """
+    Two-stage matcher: probes are matched against a few representative templates per subject first,
+    then the top subjects are optionally re-ranked against all their templates.
+    """
+
+    def __init__(self, gallery: Gallery, per_subject=1, method='centroids', rerank=0):
+        """
+        :param gallery: full gallery.
+        :param per_subject: maximum number of representative templates per subject.
+        :param method: 'centroids' or 'medoids', as in Gallery.compacted().
+        :param rerank: number of top subjects to re-rank against the full templates (0: no re-ranking).
+        """
+        self.gallery = gallery
+        self.compact = gallery.compacted(per_subject, method)
+        self.rerank = rerank
+        self.version = cache.new_version()
+
+    def __len__(self):
+        return len(self.compact)
+
+    def subjects(self):
+        return self.compact.subjects()
+
+    def _rerank(self, coarse, full_dists):
+        """
+        :param coarse: (label, distance) results against the representative templates.
+        :param full_dists: function returning the distances from the full templates of the given rows.
+        :return: the results of the re-ranked subjects (against all their templates), then the other coarse ones.
+        """
+        if self.rerank == 0:
+            return coarse
+
+        top = top_subjects(coarse, self.rerank)
+        rows = self.gallery.rows(top)
+        profiling.count('gallery/comparisons', len(rows))
+
+        return self.gallery._ranking(rows, full_dists(rows)) + [(label, d) for label, d in coarse if label not in top]
+
+    def predict(self, face, subjects=None):
+        """
+        Matches a probe against the representative templates, then re-ranks the top subjects.
+
+        :param face: grayscale probe image, with the same size of the training ones.
+        :param subjects: labels of the subjects to match the probe against, None to use the whole gallery.
+        :return: (label, distance) couples, as Gallery.predict(); the re-ranked subjects come first.
+        """
+        with profiling.stage('gallery/project'):
+            probe = self.compact.project(face)
+
+        with profiling.stage('gallery/distances'):
+            rows = self.compact.rows(subjects)
+            coarse = self.compact._ranking(rows, self.compact.distances(probe, rows))
+            profiling.count('gallery/comparisons', len(rows))
+
+            return self._rerank(coarse, lambda full_rows: self.gallery.distances(probe, full_rows))
+
+    def predict_many(self, faces, subjects=None):
+        """
+        :return: the results of predict() for each probe.
+        """
+        if self.compact.lbph or len(faces) == 0:
+            return [self.predict(face, subjects) for face in faces]
+
+        with profiling.stage('gallery/project'):
+            probes = self.compact._project(np.vstack([face.reshape(1, -1) for face in faces]))
+
+        with profiling.stage('gallery/distances'):
+            rows = self.compact.rows(subjects)
+            dists = self.compact._euclidean(probes, rows)
+            profiling.count('gallery/comparisons', len(rows) * len(faces))
+
+            return [self._rerank(self.compact._ranking(rows, d),
+                                 lambda full_rows, p=p: self.gallery._euclidean(p.reshape(1, -1), full_rows)[0])
+                    for p, d in zip(probes, dists)]
+
+
+class CoarseToFineGallery:
+    """
+    Two-resolution matcher: probes are downsampled and matched against a low-resolution gallery (e.g. of 32 x 32
+    faces, with few components) to shortlist the candidate subjects, then only the shortlisted subjects are
+    re-ranked by the full-resolution gallery.
+
+    The results keep every subject, so that the ranks beyond the shortlist can still be read, but only the
+    shortlisted ones have a (full-resolution) distance: the other subjects follow them in the coarse order
+    with an infinite distance, as the low-resolution distances are on another scale.
+    """
+
+    def __init__(self, coarse: Gallery, gallery: Gallery, coarse_size=32, shortlist=5):
+        """
+        :param coarse: gallery of the recognizer trained with the downsampled faces.
+        :param gallery: gallery of the full-resolution recognizer.
+        :param coarse_size: side of the (square) downsampled faces.
+        :param shortlist: number of candidate subjects re-ranked at full resolution.
+        """
+        self.coarse = coarse
+        self.gallery = gallery
+        self.coarse_size = coarse_size
+        self.shortlist = shortlist
+        self.version = cache.new_version()
+
+    @classmethod
+    def train(cls, recognizer, coarse_recognizer, faces, labels, coarse_size=32, shortlist=5):
+        """
+        Trains the full-resolution recognizer with some faces and the low-resolution one with their downsampled
+        copies.
+
+        :param recognizer: face recognizer to train with the faces.
+        :param coarse_recognizer: face recognizer to train with the downsampled faces.
+        :param faces: training faces.
+        :param labels: labels of the faces.
+        :param coarse_size: side of the (square) downsampled faces.
+        :param shortlist: number of candidate subjects re-ranked at full resolution.
+        :return: the matcher.
+        """
+        labels = np.array(labels)
+
+        recognizer.train(faces, labels)
+        coarse_recognizer.train([downsample(face, coarse_size) for face in faces], labels)
+
+        return cls(Gallery(coarse_recognizer), Gallery(recognizer), coarse_size, shortlist)
+
+    def __len__(self):
+        return len(self.gallery)
+
+    def subjects(self):
+        return self.gallery.subjects()
+
+    def _refine(self, face, coarse):
+        """
+        :return: the results of the shortlisted subjects (at full resolution), then the other coarse ones,
+        in the coarse order and with an infinite distance.
+        """
+        top = top_subjects(coarse, self.shortlist)
+
+        with profiling.stage('gallery/fine'):
+            fine = self.gallery.predict(face, top)
+
+        return fine + [(label, float('inf')) for label, _ in coarse if label not in top]
+
+    def predict(self, face, subjects=None):
+        """
+        Shortlists the candidate subjects at low resolution, then re-ranks them at full resolution.
+
+        :param face: grayscale probe image, with the same size of the (full-resolution) training ones.
+        :param subjects: labels of the subjects to match the probe against, None to use the whole gallery.
+        :return: (label, distance) couples, as Gallery.predict(); the shortlisted subjects come first, the other
+        ones have an infinite distance.
+        """
+        with profiling.stage('gallery/coarse'):
+            coarse = self.coarse.predict(downsample(face, self.coarse_size), subjects)
+
+        return self._refine(face, coarse)
+
+    def predict_many(self, faces, subjects=None):
+        """
+        :return: the results of predict() for each probe.
+        """
+        with profiling.stage('gallery/coarse'):
+            coarse = self.coarse.predict_many([downsample(face, self.coarse_size) for face in faces], subjects)
+
+        return [self._refine(face, c) for face, c in zip(faces, coarse)]
+
+
+def downsample(face, size):
+    """
+    :return: the face resized to size x size, as the low-resolution stage of CoarseToFineGallery matches it.
+    """
+    return cv.resize(face, (size, size), interpolation=cv.INTER_AREA)
+
+
+class Cohort:
+    """
+    Impostor statistics of each gallery subject, for the z-norm of the distances: the distance d of a probe from
+    a template of subject s becomes (d - mean_s) / std_s, where mean_s and std_s are those of the distances between
+    the templates of s and the ones of the other subjects. The statistics are computed once, at enrollment,
+    so normalizing a result is just a lookup.
+    """
+
+    def __init__(self, statistics):
+        """
+        :param statistics: dictionary subject label -> (mean, standard deviation) of its impostor distances.
+        """
+        self.statistics = statistics
+        self.version = cache.new_version()
+
+    @classmethod
+    def from_gallery(cls, gallery: Gallery, chunk_size=256):
+        """
+        Computes the impostor statistics of the subjects of a gallery from its own templates.
+
+        :param gallery: the gallery (with at least two subjects).
+        :param chunk_size: number of templates compared to the whole gallery at once (Eigenfaces and Fisherfaces).
+        :return: the cohort.
+        """
+        subjects = np.array(gallery.subjects())
+        owners = np.searchsorted(subjects, gallery.labels)
+        rows = gallery.rows()
+
+        # count, sum and sum of squares of the impostor distances of each subject
+        moments = np.zeros((3, len(subjects)))
+        step = 1 if gallery.lbph else chunk_size
+
+        with profiling.stage('gallery/cohort'):
+            for start in range(0, len(rows), step):
+                chunk = rows[start:start + step]
+
+                if gallery.lbph:
+                    dists = gallery.distances(gallery._template(chunk[0]), rows).reshape(1, -1)
+                else:
+                    templates = np.vstack([gallery._template(row) for row in chunk])
+                    dists = gallery._euclidean(templates.astype(gallery._mean.dtype), rows)
+
+                impostor = owners[chunk].reshape(-1, 1) != owners.reshape(1, -1)
+                for m, values in enumerate([impostor, np.where(impostor, dists, 0), np.where(impostor, dists, 0) ** 2]):
+                    moments[m] += np.bincount(owners[chunk], weights=values.sum(axis=1), minlength=len(subjects))
+
+        count, total, squares = moments
+        means = total / count
+        stds = np.sqrt(np.maximum(squares / count - means ** 2, 0))
+        stds[~(stds > 0)] = 1
+
+        return cls(dict(zip(subjects.tolist(), zip(means.tolist(), stds.tolist()))))
+
+    def normalize(self, results):
+        """
+        :param results: (label, distance) couples, as Gallery.predict() or Recognizer.predict() return them.
+        :return: the (label, normalized distance) couples, sorted by normalized distance.
+        """
+        normalized = [(label, (dist - self.statistics[label][0]) / self.statistics[label][1])
+                      for label, dist in results]
+
+        return sorted(normalized, key=lambda x: x[1])
+
+    def save(self, file_name):
+        """
+        Saves the statistics to a JSON file.
+        """
+        with open(file_name, 'w+') as fl:
+            json.dump([[label, mean, std] for label, (mean, std) in self.statistics.items()], fl)
+
+    @classmethod
+    def load(cls, file_name):
+        """
+        :return: the cohort saved by save().
+        """
+        with open(file_name, 'r') as fl:
+            return cls(dict((label, (mean, std)) for label, mean, std in json.load(fl)))
+
+
+def compare_precisions(recognizer, folds, precisions_to_compare=None):
+    """
+    Evaluates the k-fold with the gallery in each precision and compares the results with the float64 ones.
+
+    :param recognizer: face recognizer to train.
+    :param folds: couples of training and testing csv files.
+    :param precisions_to_compare: precisions to compare with float64 (default: all the reduced ones).
+    :return: dictionary precision -> memory, rank-1 disagreements with float64, EER and EER difference.
+    """
+    import Recognition_Tests
+    import Recognizer
+    import utils
+
+    precisions_to_compare = precisions_to_compare or precisions[1:]
+    names = ['float64'] + [p for p in precisions_to_compare if p != 'float64']
+
+    nbytes = dict((name, 0) for name in names)
+    labels = dict((name, []) for name in names)  # rank-1 labels
+    scores = dict((name, ([], [])) for name in names)  # genuine and impostor rank-1 scores
+
+    for train_csv, test_csv in folds:
+        model, height, gallery_labels = Recognizer.train_recongizer(recognizer, train_csv, ret_labels=True)
+        _, files = utils.read_csv(test_csv, mapping=True)
+        faces = preprocessing.default.load(files, height)
+
+        for name in names:
+            gallery = Gallery(model, name)
+            nbytes[name] += gallery.nbytes()
+
+            matrix = dict(zip([(file, utils.get_label(file)) for file in files], gallery.predict_many(faces)))
+            labels[name].extend(results[0][0] for results in matrix.values())
+
+            for collected, fold_scores in zip(scores[name], Recognition_Tests.rank1_scores(matrix, gallery_labels)):
+                collected.append(fold_scores)
+
+    comparison = dict()
+
+    for name in names:
+        rates = Recognition_Tests.exact_rates(*[np.concatenate(s) for s in scores[name]])
+        _, err = utils.equal_error_rate(rates["thresholds"], rates["FAR"], rates["FRR"])
+        err = float(err[0]) if len(err) != 0 else float('nan')
+
+        disagreements = int(np.sum(np.array(labels[name]) != np.array(labels['float64'])))
+        reference = comparison['float64']["EER"] if name != 'float64' else err
+
+        comparison[name] = dict([("bytes", nbytes[name]), ("probes", len(labels[name])),
+                                 ("rank1_disagreements", disagreements), ("EER", err),
+                                 ("EER_difference", err - reference)])
+
+    return comparison
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('-r', '--recognizer', help='The recognizer to use', type=int, choices=range(3), required=True)
+    parser.add_argument('-f', '--folds', help='The directory of the k-fold csv files',
+                        default='../test/k_fold/complete/csv')
+    parser.add_argument('-p', '--precisions', help='The precisions to compare with float64', nargs='+',
+                        choices=precisions[1:], default=precisions[1:])
+    preprocessing.add_arguments(parser)
+    profiling.add_argument(parser, '../test/profile/gallery')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    import bootstrap
+
+    args = parse_args()
+
+    profiling.start(args.profile)
+    preprocessing.configure(args)
+
+    if args.recognizer == 0:
+        model: cv.face_BasicFaceRecognizer = cv.face.EigenFaceRecognizer_create(num_components=10)
+
+    elif args.recognizer == 1:
+        model: cv.face_BasicFaceRecognizer = cv.face.FisherFaceRecognizer_create(num_components=80)
+
+    elif args.recognizer == 2:
+        model: cv.face_BasicFaceRecognizer = cv.face.LBPHFaceRecognizer_create(radius=2, neighbors=16)
+
+    for prec, values in compare_precisions(model, bootstrap.k_fold_files(args.folds), args.precisions).items():
+        print("{}: {:.1f} KiB, {} rank-1 disagreements out of {} probes, EER = {:.4f} ({:+.4f})".format(
+            prec, values["bytes"] / 1024, values["rank1_disagreements"], values["probes"], values["EER"],
+            values["EER_difference"]))
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module provides an incremental ingestion pipeline for a drop directory where new photos keep landing.
+
+The directory is polled (no OS-specific notifier is needed) and only new or modified files go through detection,
+alignment and, optionally, enrollment into a dataset csv file. Every processed file is appended to a checkpoint
+manifest, so a restarted ingestion resumes where it stopped; files whose processing failed are retried at the next
+full scans, up to max_attempts times. Directories whose modification time did not change are not listed again
+(but for a periodic full scan): their subdirectories are remembered, so that each poll costs the same as the archive
+grows.
+
+Photos are expected as <drop dir>/<subject dir>/<file> (e.g. .../s3/12.jpg) and faces are saved
+to <output dir>/<subject dir>/, as done by the Detector main.
+
+Authors:
+    Pg96, dsforza96
+"""
+
+from argparse import ArgumentParser
+import json
+import os
+from os import path
+import re
+import time
+
+import Detector
+import profiling
+
+manifest_name = '.ingest_manifest.jsonl'
+image_extensions = {'.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff'}
+
+# number of times a file whose processing fails is tried
+max_attempts = 3
+
+
+class Manifest:
+    """
+    Checkpoint of the ingested files, stored as an append-only JSON lines journal.
+    """
+
+    def __init__(self, file_name):
+        """
+        :param file_name: journal file; it is created if it does not exist.
+        """
+        self.file_name = file_name
+        self.entries = dict()  # relative path -> entry
+
+        lines = 0
+        if path.exists(file_name):
+            with open(file_name, "r") as fl:
+                for line in fl:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # truncated by an interrupted write
+                        continue
+
+                    self.entries[entry["path"]] = entry
+                    lines += 1
+
+        if lines > 2 * len(self.entries) + 1000:
+            self.compact()
+
+    def is_current(self, rel_path, st):
+        """
+        :return: True if the file has already been ingested (or it failed max_attempts times)
+        and it did not change since then.
+        """
+        entry = self.entries.get(rel_path)
+
+        if entry is None or entry["size"] != st.st_size or entry["mtime_ns"] != st.st_mtime_ns:
+            return False
+
+        return "error" not in entry or entry.get("attempts", 1) >= max_attempts
+
+    def attempts(self, rel_path, st):
+        """
+        :return: the number of failed attempts to process the current version of a file.
+        """
+        entry = self.entries.get(rel_path)
+
+        if entry is None or "error" not in entry or entry["size"] != st.st_size or entry["mtime_ns"] != st.st_mtime_ns:
+            return 0
+
+        return entry.get("attempts", 1)
+
+    def add(self, entry):
+        """
+        Records an ingested file.
+        """
+        self.entries[entry["path"]] = entry
+
+        with open(self.file_name, "a") as fl:
+            fl.write(json.dumps(entry) + "\n")
+
+    def compact(self):
+        """
+        Rewrites the journal keeping just the last entry of each file.
+        """
+        tmp_file = self.file_name + ".tmp"
+
+        with open(tmp_file, "w") as fl:
+            for entry in self.entries.values():
+                fl.write(json.dumps(entry) + "\n")
+
+        os.replace(tmp_file, self.file_name)
+
+
+class DropScanner:
+    """
+    Lists the images of the drop directory, skipping the directories that did not change since the last scan.
+    """
+
+    def __init__(self, drop_dir):
+        self.drop_dir = drop_dir
+        self._dirs = dict()  # directory -> (mtime, subdirectories) at the last complete listing
+
+    def scan(self, full=False):
+        """
+        :param full: if True, all the subdirectories are listed (files modified in place are found only this way).
+        :return: (relative path, path, stat) of the listed images.
+        """
+        found = []
+        stack = [self.drop_dir]
+
+        while len(stack) != 0:
+            directory = stack.pop()
+
+            try:
+                dir_mtime = os.stat(directory).st_mtime_ns
+            except FileNotFoundError:
+                self._dirs.pop(directory, None)
+                continue
+
+            # adding, removing or renaming an entry changes the mtime of a directory: if it did not change,
+            # the directory is not listed again and just its known subdirectories are visited
+            cached = self._dirs.get(directory)
+            if not full and cached is not None and cached[0] == dir_mtime:
+                stack.extend(cached[1])
+                continue
+
+            subdirs = []
+
+            with profiling.stage('ingest/scandir'):
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            subdirs.append(entry.path)
+
+                        elif entry.name.startswith('.'):
+                            continue
+
+                        elif path.splitext(entry.name)[1].lower() in image_extensions:
+                            found.append((path.relpath(entry.path, self.drop_dir), entry.path, entry.stat()))
+
+            stack.extend(subdirs)
+            self._dirs[directory] = (dir_mtime, subdirs)
+
+        return found
+
+    def forget(self, rel_path):
+        """
+        Makes the next scan list again the directory of a file (e.g. because it was not ready yet).
+        """
+        self._dirs.pop(path.dirname(path.join(self.drop_dir, rel_path)) or self.drop_dir, None)
+
+
+def _subject_label(rel_path):
+    """
+    :return: the label of the subject directory of a file (e.g. 3 for s3/12.jpg), None if it is not a subject one.
+    """
+    match = re.fullmatch(r's(\d+)', path.basename(path.dirname(rel_path)))
+    return int(match.group(1)) if match else None
+
+
+def ingest(drop_dir, out_dir, manifest, scanner, full_scan=False, settle=2.0, enroll_csv=None, detector_args=None):
+    """
+    Ingests the new or modified images of the drop directory.
+
+    :param drop_dir: the drop directory.
+    :param out_dir: directory where to save the faces.
+    :param manifest: Manifest of the already ingested files.
+    :param scanner: DropScanner of the drop directory.
+    :param full_scan: if True, all the subdirectories are listed.
+    :param settle: files modified less than these seconds ago are left for the next poll (they may be being written).
+    :param enroll_csv: if not None, the aligned faces of the subject directories are appended to this csv file.
+    :param detector_args: additional keyword arguments for Detector.crop_and_align.
+    :return: the number of ingested files.
+    """
+    detector_args = detector_args or dict()
+    now = time.time()
+    ingested = 0
+
+    for rel_path, file, st in scanner.scan(full_scan):
+        if manifest.is_current(rel_path, st):
+            continue
+
+        if now - st.st_mtime < settle:
+            scanner.forget(rel_path)
+            continue
+
+        save_dir = path.join(out_dir, path.dirname(rel_path))
+        entry = dict([("path", rel_path), ("size", st.st_size), ("mtime_ns", st.st_mtime_ns), ("outputs", [])])
+
+        with profiling.stage('ingest/process'):
+            try:
+                entry["outputs"] = Detector.crop_and_align(file, save_dir, **detector_args)
+            except Exception as e:
+                entry["error"] = repr(e)
+                # retried at the next full scans
+                entry["attempts"] = manifest.attempts(rel_path, st) + 1
+
+        label = _subject_label(rel_path)
+
+        # crop_and_align returns the cropped and the aligned faces (just the cropped one if the eyes are not found)
+        if enroll_csv is not None and label is not None and len(entry["outputs"]) == 2:
+            with open(enroll_csv, "a") as fl:
+                fl.write("{};{}\n".format(entry["outputs"][1], label))
+            entry["enrolled"] = label
+
+        manifest.add(entry)
+        profiling.count('ingest/files')
+        ingested += 1
+
+        print("{}: {}".format(rel_path, entry.get("error", "{} face(s) saved".format(len(entry["outputs"])))))
+
+    return ingested
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('drop_dir', help='The directory where new photos land')
+    parser.add_argument('-o', '--output', help='The path of the output directory', default='../images/dataset/cropped/')
+    parser.add_argument('-m', '--manifest', help='The checkpoint manifest (default: <output>/{})'.format(manifest_name),
+                        default=None)
+    parser.add_argument('-e', '--enroll', help='The csv file where to enroll the new faces', default=None)
+    parser.add_argument('-p', '--interval', help='Seconds between two polls', default=5.0, type=float)
+    parser.add_argument('-f', '--full-scan-every', help='Number of polls between two full scans', default=12, type=int)
+    parser.add_argument('--settle', help='Seconds a file must be left untouched before being ingested', default=2.0,
+                        type=float)
+    parser.add_argument('--once', help='Ingest what is there and exit', action='store_true')
+    parser.add_argument('--keep-unaligned', help='Save the cropped face even if its eyes are not detected',
+                        action='store_true')
+    parser.add_argument('-d', '--detector', default=0, type=int)
+    parser.add_argument('-s', '--scalefactor', default=1.05, type=float)
+    parser.add_argument('-n', '--minneighbors', default=2, type=int)
+    parser.add_argument('-es', '--eyes-scalefactor', default=1.08, type=float)
+    parser.add_argument('-en', '--eyes-minneighbors', default=3, type=int)
+    parser.add_argument('-em', '--eyes-minsize', default=40, type=int)
+    profiling.add_argument(parser, '../test/profile/ingest')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    profiling.start(args.profile)
+
+    os.makedirs(args.output, exist_ok=True)
+
+    manifest_file = args.manifest if args.manifest is not None else path.join(args.output, manifest_name)
+    checkpoint = Manifest(manifest_file)
+    drop_scanner = DropScanner(args.drop_dir)
+
+    print("Resuming with {} already ingested files".format(len(checkpoint.entries)))
+
+    det_args = dict([("classifier", args.detector), ("scaleFactor", args.scalefactor),
+                     ("minNeighbors", args.minneighbors), ("eyes_ScaleFactor", args.eyes_scalefactor),
+                     ("eyes_minNeighbors", args.eyes_minneighbors),
+                     ("eyes_minSize", (args.eyes_minsize, args.eyes_minsize)),
+                     ("keep_unaligned", args.keep_unaligned)])
+
+    polls = 0
+    try:
+        while True:
+            # the first poll is always a full one
+            full = polls % args.full_scan_every == 0
+            n_ingested = ingest(args.drop_dir, args.output, checkpoint, drop_scanner, full_scan=full,
+                                settle=0 if args.once else args.settle, enroll_csv=args.enroll,
+                                detector_args=det_args)
+
+            if n_ingested != 0:
+                print("Ingested {} file(s)".format(n_ingested))
+
+            if args.once:
+                break
+
+            polls += 1
+            time.sleep(args.interval)
+
+    except KeyboardInterrupt:
+        pass
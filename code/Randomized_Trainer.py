@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module provides a faster training of Eigenfaces, for when the number of components is far below the number
+of images and pixels: instead of a full eigen decomposition, the principal components are found through a
+randomized SVD (N. Halko et al., Finding structure with randomness, 2011).
+
+The range of the data matrix is sampled with (number of components + oversampling) random vectors and refined by
+a few power iterations; only the SVD of the resulting small matrix is then computed. The trained model is loaded
+into an ordinary cv.face_EigenFaceRecognizer, so it can be used, shown and saved as any other one.
+
+The comparison with the OpenCV trainer (training time, agreement of the eigenvalues and of the eigenfaces,
+rank-1 decisions and EER on the k-fold) at several gallery sizes is run with:
+    python Randomized_Trainer.py -s 64 128 256 1024
+
+Authors:
+    Pg96, dsforza96
+"""
+
+from argparse import ArgumentParser
+import cv2.cv2 as cv
+import numpy as np
+import time
+
+import cache
+import preprocessing
+import profiling
+import Streaming_Trainer
+import utils
+
+# default number of additional random vectors sampling the range of the data matrix
+default_oversampling = 10
+
+# default number of power iterations
+default_power_iterations = 2
+
+
+def randomized_svd(x, n_components, oversampling=default_oversampling, power_iterations=default_power_iterations,
+                   seed=0):
+    """
+    Computes the first singular values and right singular vectors of a matrix.
+
+    :param x: matrix (e.g. the centered data matrix, one sample per row).
+    :param n_components: number of singular values to compute.
+    :param oversampling: number of additional random vectors; the more, the more accurate the last components.
+    :param power_iterations: number of power iterations; the more, the more accurate the components
+                             when the singular values decay slowly.
+    :param seed: seed of the random generator.
+    :return: the singular values and the right singular vectors (one per row), by decreasing singular value.
+    """
+    n_random = min(n_components + oversampling, min(x.shape))
+    rng = np.random.default_rng(seed)
+
+    with profiling.stage('randomized/range'):
+        q, _ = np.linalg.qr(x @ rng.standard_normal((x.shape[1], n_random)))
+
+        # the QR decompositions keep the powers of x from collapsing onto the first singular vectors
+        for _ in range(power_iterations):
+            q, _ = np.linalg.qr(x.T @ q)
+            q, _ = np.linalg.qr(x @ q)
+
+    with profiling.stage('randomized/svd'):
+        _, s, vt = np.linalg.svd(q.T @ x, full_matrices=False)
+
+    return s[:n_components], vt[:n_components]
+
+
+def fit(recognizer: cv.face_EigenFaceRecognizer, faces, labels, oversampling=default_oversampling,
+        power_iterations=default_power_iterations, seed=0):
+    """
+    Trains an Eigenfaces recognizer through a randomized SVD.
+
+    :param recognizer: Eigenfaces recognizer to be trained (its number of components is the requested one).
+    :param faces: training faces, all of the same size.
+    :param labels: labels of the faces.
+    :param oversampling: number of additional random vectors of the randomized SVD.
+    :param power_iterations: number of power iterations of the randomized SVD.
+    :param seed: seed of the random generator.
+    :return: the trained recognizer.
+    """
+    if type(recognizer) is not cv.face_EigenFaceRecognizer:
+        raise ValueError('The randomized SVD trains Eigenfaces only, not {}'.format(type(recognizer).__name__))
+
+    x = np.stack(faces).reshape(len(faces), -1).astype(np.float64)
+
+    # as cv.face.EigenFaceRecognizer: all the components if they are not set or more than the faces
+    requested = recognizer.getNumComponents()
+    n_components = requested if 0 < requested <= len(x) else len(x)
+
+    mean = x.mean(axis=0)
+    x -= mean
+
+    s, components = randomized_svd(x, n_components, oversampling, power_iterations, seed)
+    projections = x @ components.T
+
+    Streaming_Trainer.read_model(recognizer, 'opencv_eigenfaces', len(components), mean,
+                                 (s ** 2 / len(x)).reshape(-1, 1), components.T, projections,
+                                 np.asarray(labels, dtype=np.int32))
+    cache.invalidate_model(recognizer)
+
+    return recognizer
+
+
+def train_randomized(recognizer: cv.face_EigenFaceRecognizer, csv_filename, resize=True, ret_labels=False,
+                     oversampling=default_oversampling, power_iterations=default_power_iterations, pipeline=None):
+    """
+    Trains an Eigenfaces recognizer on the images of a csv file through a randomized SVD.
+
+    :return: the trained model and the height of the images used for the training, as Recognizer.train_recongizer.
+    """
+    faces, labels = utils.read_csv(csv_filename, resize, pipeline=pipeline)
+    height = faces[0].shape[0]
+
+    fit(recognizer, faces, labels, oversampling, power_iterations)
+
+    if ret_labels:
+        return recognizer, height, set(labels)
+
+    return recognizer, height
+
+
+def gallery_of_size(faces, labels, size, rng):
+    """
+    Draws a gallery of a given size from the training faces; beyond their number, the gallery is filled
+    with jittered (randomly flipped and noisy) copies of them, to time the trainers on larger galleries.
+
+    :return: the faces and the labels of the gallery.
+    """
+    if size <= len(faces):
+        chosen = np.sort(rng.permutation(len(faces))[:size])
+        return [faces[i] for i in chosen], [labels[i] for i in chosen]
+
+    extra = rng.integers(0, len(faces), size - len(faces))
+    copies = []
+
+    for i in extra:
+        face = faces[i][:, ::-1] if rng.random() < 0.5 else faces[i]
+        noise = rng.integers(-8, 9, face.shape)
+        copies.append(np.clip(face.astype(np.int16) + noise, 0, 255).astype(np.uint8))
+
+    return list(faces) + copies, list(labels) + [labels[i] for i in extra]
+
+
+def _best_time(fn, repeat):
+    best = float('inf')
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+
+    return best
+
+
+def compare_trainers(n_components, folds, sizes, oversampling=default_oversampling,
+                     power_iterations=default_power_iterations, repeat=3, seed=0):
+    """
+    Compares the randomized SVD with the OpenCV trainer of Eigenfaces on the k-fold, at several gallery sizes.
+
+    :param n_components: number of components of the Eigenfaces.
+    :param folds: couples of training and testing csv files.
+    :param sizes: sizes of the galleries drawn from the training faces of each fold (see gallery_of_size()).
+    :param oversampling: number of additional random vectors of the randomized SVD.
+    :param power_iterations: number of power iterations of the randomized SVD.
+    :param repeat: number of timed trainings (the best time is kept).
+    :param seed: seed of the random generator drawing the galleries.
+    :return: dictionary size -> training times of both trainers, maximum relative error of the eigenvalues,
+    similarity of the eigenfaces subspaces (1: same subspace), rank-1 disagreements and EER of both trainers.
+    """
+    import Recognition_Tests
+
+    comparison = dict()
+
+    for size in sizes:
+        rng = np.random.default_rng(seed)
+        times = dict([("opencv", 0.0), ("randomized", 0.0)])
+        scores = dict([("opencv", ([], [])), ("randomized", ([], []))])
+        errors, similarities = [], []
+        disagreements, probes = 0, 0
+
+        for train_csv, test_csv in folds:
+            faces, labels = gallery_of_size(*utils.read_csv(train_csv, resize=True), size, rng)
+            height = faces[0].shape[0]
+
+            opencv = cv.face.EigenFaceRecognizer_create(num_components=n_components)
+            randomized = cv.face.EigenFaceRecognizer_create(num_components=n_components)
+
+            with profiling.stage('randomized/compare/opencv'):
+                times["opencv"] += _best_time(lambda: opencv.train(faces, np.array(labels)), repeat)
+
+            with profiling.stage('randomized/compare/randomized'):
+                times["randomized"] += _best_time(lambda: fit(randomized, faces, labels, oversampling,
+                                                              power_iterations), repeat)
+
+            reference = opencv.getEigenValues().ravel()
+            errors.append(np.max(np.abs(randomized.getEigenValues().ravel() - reference) / reference))
+
+            # mean squared cosine of the principal angles between the two subspaces
+            overlap = opencv.getEigenVectors().T @ randomized.getEigenVectors()
+            similarities.append(np.sum(overlap ** 2) / overlap.shape[0])
+
+            matrices = dict()
+            for name, model in [("opencv", opencv), ("randomized", randomized)]:
+                matrices[name] = Recognition_Tests.compute_distance_matrix(test_csv, True, model, height)
+
+                for collected, fold_scores in zip(scores[name],
+                                                  Recognition_Tests.rank1_scores(matrices[name], set(labels))):
+                    collected.append(fold_scores)
+
+            disagreements += sum(matrices["opencv"][probe][0][0] != matrices["randomized"][probe][0][0]
+                                 for probe in matrices["opencv"])
+            probes += len(matrices["opencv"])
+
+        eers = dict()
+        for name in scores:
+            rates = Recognition_Tests.exact_rates(*[np.concatenate(s) for s in scores[name]])
+            _, err = utils.equal_error_rate(rates["thresholds"], rates["FAR"], rates["FRR"])
+            eers[name] = float(err[0]) if len(err) != 0 else float('nan')
+
+        comparison[size] = dict([("opencv_time", times["opencv"]), ("randomized_time", times["randomized"]),
+                                 ("eigenvalues_error", float(max(errors))),
+                                 ("subspace_similarity", float(min(similarities))),
+                                 ("rank1_disagreements", int(disagreements)), ("probes", probes),
+                                 ("opencv_EER", eers["opencv"]), ("randomized_EER", eers["randomized"])])
+
+    return comparison
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('-c', '--components', help='The number of components of the Eigenfaces', type=int,
+                        default=10)
+    parser.add_argument('-f', '--folds', help='The directory of the k-fold csv files',
+                        default='../test/k_fold/complete/csv')
+    parser.add_argument('-s', '--sizes', help='The gallery sizes to compare the trainers at', type=int, nargs='+',
+                        default=[64, 128, 256, 1024])
+    parser.add_argument('-o', '--oversampling', help='The number of additional random vectors', type=int,
+                        default=default_oversampling)
+    parser.add_argument('-q', '--power-iterations', help='The number of power iterations', type=int,
+                        default=default_power_iterations)
+    parser.add_argument('-n', '--repeat', help='The number of timed trainings', type=int, default=3)
+    preprocessing.add_arguments(parser)
+    profiling.add_argument(parser, '../test/profile/randomized_trainer')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    import bootstrap
+
+    args = parse_args()
+
+    profiling.start(args.profile)
+    preprocessing.configure(args)
+
+    results = compare_trainers(args.components, bootstrap.k_fold_files(args.folds), args.sizes, args.oversampling,
+                               args.power_iterations, args.repeat)
+
+    for gallery_size, values in results.items():
+        print("{} faces: OpenCV {:.3f} s, randomized {:.3f} s ({:.1f}x); eigenvalues error {:.2e}, "
+              "subspace similarity {:.6f}; {} rank-1 disagreements out of {} probes; "
+              "EER = {:.4f} (OpenCV {:.4f})".format(
+                gallery_size, values["opencv_time"], values["randomized_time"],
+                values["opencv_time"] / values["randomized_time"], values["eigenvalues_error"],
+                values["subspace_similarity"], values["rank1_disagreements"], values["probes"],
+                values["randomized_EER"], values["opencv_EER"]))
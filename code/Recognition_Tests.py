@@ -14,11 +14,16 @@ from itertools import product
 import numpy as np
 import random
 import os
+import time
 # import json
 # import datetime
 
 import Recognizer
 import Eyes_Recognizer
+import Gallery
+import preprocessing
+import profiling
+import reports
 import utils
 
 
@@ -91,7 +96,7 @@ def k_fold_cross_validation(dataset_path, k=5, n_impostors=1):
     return ret
 
 
-def compute_distance_matrix(test_csv, resize, model, height, use_eyes=False):
+def compute_distance_matrix(test_csv, resize, model, height, use_eyes=False, gallery=None, cohort=None):
     """
     Creates an all-against-all (probes vs  gallery)
     distance matrix for identification.
@@ -102,6 +107,9 @@ def compute_distance_matrix(test_csv, resize, model, height, use_eyes=False):
     :param height: height of each photo
     :param use_eyes: flag to specify whether to use the eyes
     recognition routine for the prediction
+    :param gallery: gallery to match the probes against (e.g. a Gallery.CompactGallery),
+    None to use the model (or a full Gallery of it, with the eyes routine)
+    :param cohort: Gallery.Cohort to z-normalize the distances with (not used by the eyes routine)
     :return: generated distance matrix
     """
 
@@ -112,6 +120,10 @@ def compute_distance_matrix(test_csv, resize, model, height, use_eyes=False):
 
     label_to_file, files = utils.read_csv(test_csv, resize=resize, mapping=True)
 
+    if use_eyes and gallery is None:
+        with profiling.stage('evaluate/gallery'):
+            gallery = Gallery.Gallery(model)
+
     probe_labels = set()
     for file in files:
         label = utils.get_label(file)
@@ -119,10 +131,12 @@ def compute_distance_matrix(test_csv, resize, model, height, use_eyes=False):
 
         if not use_eyes:
             prediction = Recognizer.predict(recognizer=model, height=height, resize=resize,
-                                            probe_label=label, probe_image=file, identification=True)
+                                            probe_label=label, probe_image=file, identification=True,
+                                            gallery=gallery, cohort=cohort)
         else:
             prediction = Eyes_Recognizer.predict(model=model, height=height, resize=resize,
-                                                 probe_label=label, probe_image=file, identification=True)
+                                                 probe_label=label, probe_image=file, identification=True,
+                                                 gallery=gallery)
 
         matrix[(file, label)] = prediction
 
@@ -134,13 +148,110 @@ def compute_distance_matrix(test_csv, resize, model, height, use_eyes=False):
     return matrix  # , probe_labels
 
 
+def rank1_scores(distance_matrix, gallery_labels):
+    """
+    Collects the rank-1 scores (distances) of the genuine and of the impostor probes.
+
+    :param distance_matrix: distance matrix, as returned by compute_distance_matrix()
+    :param gallery_labels: labels of the subjects the recognizer was trained with
+    :return: genuine and impostor scores; genuine probes not correctly identified at rank 1 get an infinite score,
+    as they are rejected at any threshold
+    """
+    genuine = list()
+    impostor = list()
+
+    for (_, probe_label), results in distance_matrix.items():
+        fr_label, fr_distance = results[0]
+
+        if probe_label not in gallery_labels:
+            impostor.append(fr_distance)
+        elif fr_label == probe_label:
+            genuine.append(fr_distance)
+        else:
+            genuine.append(np.inf)
+
+    return np.array(genuine, dtype=np.float64), np.array(impostor, dtype=np.float64)
+
+
+def exact_rates(genuine, impostor):
+    """
+    Computes the FAR, FRR and GRR at every distinct score, i.e. the exact ROC and DET (FAR vs FRR) curves,
+    by sorting the scores once and counting the accepted attempts through cumulative sums.
+
+    :param genuine: genuine scores, as returned by rank1_scores()
+    :param impostor: impostor scores, as returned by rank1_scores()
+    :return: dictionary with the thresholds (the distinct finite scores) and the rates at each of them
+    """
+    scores = np.concatenate([genuine, impostor])
+    is_genuine = np.concatenate([np.ones(len(genuine), dtype=np.int64), np.zeros(len(impostor), dtype=np.int64)])
+
+    order = np.argsort(scores, kind='stable')
+    scores = scores[order]
+    accepted_genuine = np.cumsum(is_genuine[order])
+    accepted_impostor = np.arange(1, len(scores) + 1) - accepted_genuine
+
+    # last occurrence of each distinct score: a probe is accepted if its score is <= the threshold
+    last = np.flatnonzero(np.append(scores[1:] != scores[:-1], True) & np.isfinite(scores))
+
+    far = accepted_impostor[last] / len(impostor)
+    frr = 1 - accepted_genuine[last] / len(genuine)
+
+    return dict([("thresholds", scores[last]), ("FAR", far), ("FRR", frr), ("GRR", 1 - far)])
+
+
+def rates_at(genuine, impostor, thresholds):
+    """
+    :return: dictionary with the FAR, FRR and GRR at the given thresholds, as arrays
+    """
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+
+    far = np.searchsorted(np.sort(impostor), thresholds, side='right') / len(impostor)
+    frr = 1 - np.searchsorted(np.sort(genuine), thresholds, side='right') / len(genuine)
+
+    return dict([("thresholds", thresholds), ("FAR", far), ("FRR", frr), ("GRR", 1 - far)])
+
+
+def automatic_thresholds(genuine, impostor, n=100):
+    """
+    :return: n thresholds evenly spanning the range of the finite scores
+    """
+    scores = np.concatenate([genuine, impostor])
+    scores = scores[np.isfinite(scores)]
+
+    return np.linspace(scores.min(), scores.max(), n)
+
+
+def compute_fold(model, train_csv, test_csv, resize=True, use_eyes=False, coarse_to_fine=None):
+    """
+    Trains a model and matches the probes against it.
+
+    :param coarse_to_fine: if given, dictionary of the arguments of Recognizer.train_coarse_to_fine()
+    (e.g. coarse_size and shortlist): the probes are then matched coarse-to-fine
+    :return: the distance matrix of the probes and the labels of the subjects the model was trained with
+    """
+    gallery = None
+
+    with profiling.stage('evaluate/train'):
+        if coarse_to_fine is None:
+            model, height, gallery_labels = Recognizer.train_recongizer(model, train_csv, resize, ret_labels=True)
+        else:
+            gallery, height, gallery_labels = Recognizer.train_coarse_to_fine(model, train_csv, resize=resize,
+                                                                              ret_labels=True, **coarse_to_fine)
+
+    with profiling.stage('evaluate/distance_matrix'):
+        distance_matrix = compute_distance_matrix(test_csv, resize, model=model, height=height, use_eyes=use_eyes,
+                                                  gallery=gallery)
+
+    return distance_matrix, gallery_labels
+
+
 def evaluate_performances(model, thresholds, train_csv, test_csv, resize=True, use_eyes=False):
     """
     Compute FAR, FRR, GRR and DIR(k) for each threshold passed in input
     based on the couple of training and testing files provided.
 
     :param model: model to be used
-    :param thresholds: thresholds to test
+    :param thresholds: thresholds to test, None to choose them automatically from the scores
     :param train_csv: file containing the images to be used for training
     :param test_csv: file containing the images to be used for testing
     :param resize: flag to resize the images
@@ -150,80 +261,213 @@ def evaluate_performances(model, thresholds, train_csv, test_csv, resize=True, u
 
     # print("Evaluating performances for files {} {}...\n".format(train_csv, test_csv))
 
-    model, height, gallery_labels = Recognizer.train_recongizer(model, train_csv, resize, ret_labels=True)
-    # print(gallery_labels)
+    distance_matrix, gallery_labels = compute_fold(model, train_csv, test_csv, resize, use_eyes)
 
-    distance_matrix = compute_distance_matrix(test_csv, resize, model=model, height=height, use_eyes=use_eyes)
+    if thresholds is None:
+        thresholds = automatic_thresholds(*rank1_scores(distance_matrix, gallery_labels))
 
-    # print("\nStarting performances computation...")
-    all_probes = list(distance_matrix.keys())
+    return compute_rates(distance_matrix, gallery_labels, thresholds)
+
+
+def genuine_ranks(distance_matrix, gallery_labels):
+    """
+    Finds, for each genuine probe, where its first correct match is in the ranked results.
+
+    :param distance_matrix: distance matrix, as returned by compute_distance_matrix()
+    :param gallery_labels: labels of the subjects the recognizer was trained with
+    :return: the (0-based) positions of the first correct matches (-1 if the results do not contain the subject)
+    and the rank-1 distances of the genuine probes
+    """
+    probes = [(label, results) for (_, label), results in distance_matrix.items() if label in gallery_labels]
+    n_results = max((len(results) for _, results in probes), default=0)
+
+    # probe-by-gallery matrix of the ranked labels (padded, as the results of the eyes routine vary in length)
+    ranked = np.full((len(probes), n_results), -1, dtype=np.int64)
+    for i, (_, results) in enumerate(probes):
+        ranked[i, :len(results)] = [label for label, _ in results]
+
+    correct = ranked == np.array([label for label, _ in probes], dtype=np.int64).reshape(-1, 1)
+    positions = np.where(correct.any(axis=1), correct.argmax(axis=1), -1)
+    distances = np.array([results[0][1] for _, results in probes], dtype=np.float64)
+
+    return positions, distances
+
+
+def cumulative_match_characteristic(positions, max_rank=None):
+    """
+    :param positions: positions of the first correct matches, as returned by genuine_ranks()
+    :param max_rank: highest rank to compute, None to compute up to the worst rank of the probes
+    :return: the array of the identification rates at ranks 1, 2, ..., i.e. the fraction of the genuine probes
+    whose first correct match is within each rank
+    """
+    found = positions[positions >= 0]
+    length = max_rank if max_rank is not None else (found.max() + 1 if len(found) != 0 else 1)
+
+    return np.cumsum(np.bincount(found, minlength=length)[:length]) / len(positions)
+
+
+def coarse_to_fine_recall(recognizer, files, shortlists, coarse_recognizer=None, coarse_size=32, resize=True):
+    """
+    Measures how many genuine probes each stage of the coarse-to-fine matching loses, at several shortlist sizes.
+
+    :param recognizer: (full-resolution) model to be used
+    :param files: iterable containing couples of training and testing files
+    :param shortlists: numbers of subjects shortlisted by the low-resolution stage
+    :param coarse_recognizer: low-resolution model, as in Recognizer.train_coarse_to_fine()
+    :param coarse_size: side of the downsampled images
+    :param resize: flag to resize the images
+    :return: dictionary shortlist -> rates over the genuine probes of all the folds: rank-1 identification rate
+    of the full-resolution model alone ("full_rank1") and of the coarse-to-fine matching ("rank1"), probes whose
+    subject is shortlisted ("shortlist_recall"), probes identified by the full-resolution model alone but whose
+    subject is not shortlisted ("shortlist_loss"), probes whose subject is shortlisted but not ranked first
+    at full resolution ("rerank_loss"); alongside the average fraction of the gallery matched at full resolution
+    ("fine_fraction") and the matching times of the genuine probes ("full_time" and "time", in seconds)
+    """
+    counts = dict((n, dict([("rank1", 0), ("shortlisted", 0), ("shortlist_loss", 0), ("rerank_loss", 0),
+                            ("fine_rows", 0), ("time", 0.0)])) for n in shortlists)
+    full_correct = 0
+    full_time = 0.0
+    probes = 0
+
+    for train_f, test_f in files:
+        gallery, height, gallery_labels = Recognizer.train_coarse_to_fine(recognizer, train_f, coarse_recognizer,
+                                                                          coarse_size, resize=resize,
+                                                                          ret_labels=True)
+
+        _, test_files = utils.read_csv(test_f, mapping=True)
+        genuine = [file for file in test_files if utils.get_label(file) in gallery_labels]
+        labels = [utils.get_label(file) for file in genuine]
+        faces = preprocessing.default.load(genuine, height if resize else None)
+
+        start = time.perf_counter()
+        full = gallery.gallery.predict_many(faces)
+        full_time += time.perf_counter() - start
 
-    genuine_labels = [x[1] for x in all_probes if x[1] in gallery_labels]
-    genuine_attempts = len(genuine_labels)
-    impostors_labels = [x[1] for x in all_probes if x[1] not in gallery_labels]
-    impostor_attempts = len(impostors_labels)
+        full_hits = [results[0][0] == label for results, label in zip(full, labels)]
+        full_correct += sum(full_hits)
+        probes += len(labels)
 
-    # print('Impostors: ', impostor_attempts, impostors_labels, set(impostors_labels))
-    # print('Genuines: ', genuine_attempts, genuine_labels, set(genuine_labels))
+        for n in shortlists:
+            gallery.shortlist = n
 
+            start = time.perf_counter()
+            cascade = gallery.predict_many(faces)
+            counts[n]["time"] += time.perf_counter() - start
+
+            for results, label, full_hit in zip(cascade, labels, full_hits):
+                # the shortlisted subjects are the first ones of the results
+                top = Gallery.top_subjects(results, n)
+                shortlisted = label in top
+                hit = results[0][0] == label
+
+                counts[n]["rank1"] += hit
+                counts[n]["shortlisted"] += shortlisted
+                counts[n]["shortlist_loss"] += full_hit and not shortlisted
+                counts[n]["rerank_loss"] += shortlisted and not hit
+                counts[n]["fine_rows"] += len(gallery.gallery.rows(top)) / len(gallery.gallery)
+
+    recall = dict()
+
+    for n in shortlists:
+        recall[n] = dict([("probes", probes), ("full_rank1", full_correct / probes),
+                          ("shortlist_recall", counts[n]["shortlisted"] / probes),
+                          ("shortlist_loss", counts[n]["shortlist_loss"] / probes),
+                          ("rerank_loss", counts[n]["rerank_loss"] / probes), ("rank1", counts[n]["rank1"] / probes),
+                          ("fine_fraction", counts[n]["fine_rows"] / probes), ("full_time", full_time),
+                          ("time", counts[n]["time"])])
+
+    return recall
+
+
+def print_exact_performances(exact, model_name, report=None, name=None):
+    """
+    Prints the EER returned by evaluate_exact_performances() and, if a report is given, records it.
+    """
+    if exact["EER"] is None:
+        print("{}: exact EER not reached".format(model_name))
+    else:
+        print("{}: exact EER {:.4f} reached at threshold {:.4f}, rank-1 {:.4f}".format(
+            model_name, exact["EER"], exact["EER_threshold"], exact["CMC"][0]))
+
+    if report is not None:
+        report.exact(exact, model_name, name)
+
+
+def print_coarse_to_fine_recall(recall, title):
+    """
+    Prints the rates returned by coarse_to_fine_recall().
+    """
+    print(title)
+
+    for n, rates in recall.items():
+        print("\tshortlist {:>3}: recall {:.3f} (lost {:.3f} of the full-resolution hits), re-ranking lost {:.3f}, "
+              "rank-1 {:.3f} (full resolution {:.3f}); {:.1%} of the gallery at full resolution, "
+              "{:.3f} s (full resolution {:.3f} s)".format(
+                n, rates["shortlist_recall"], rates["shortlist_loss"], rates["rerank_loss"], rates["rank1"],
+                rates["full_rank1"], rates["fine_fraction"], rates["time"], rates["full_time"]))
+
+
+def compute_rates(distance_matrix, gallery_labels, thresholds):
+    """
+    Compute FAR, FRR, GRR and DIR(k) for each threshold passed in input.
+
+    The positions of the first correct matches are found once, then the rates at all the thresholds
+    come from a bincount and a cumulative sum.
+
+    :param distance_matrix: distance matrix, as returned by compute_distance_matrix()
+    :param gallery_labels: labels of the subjects the recognizer was trained with
+    :param thresholds: thresholds to test
+    :return: dictionary containing the computed rates; "DIR" maps ranks k to DIR(k), as historically computed
+    (a first correct match at position p >= 1 counts at rank p), "CMC" holds DIR(k) of every rank up to the worst one
+    as an array (DIR(k) at index k - 1), where a genuine probe counts at rank k if it is accepted (its rank-1 distance
+    is within the threshold) and its first correct match is within the first k results
+    """
+
+    # print("\nStarting performances computation...")
     performances = dict()
 
-    for t in thresholds:
-        fa = 0  # False accepts counter
-        fr = 0  # False rejects counter -- Not used but still kept track of
-        gr = 0  # Genuine rejects counter
-        di = dict()  # Correct detect and identification @ rank k counter
-        di[1] = 0
-        for probe in all_probes:
-            probe_label = probe[1]
-
-            results = distance_matrix[probe]
-
-            first_result = results[0]
-            fr_label = first_result[0]
-            fr_distance = first_result[1]
-
-            # Impostor attempt
-            if probe_label in impostors_labels:
-                if fr_distance <= t:
-                    fa += 1
-                else:
-                    gr += 1
+    with profiling.stage('evaluate/rates'):
+        positions, distances = genuine_ranks(distance_matrix, gallery_labels)
+        genuine_attempts = len(positions)
 
-            # Check if a correct identification @ rank 1 happened
-            elif fr_label == probe_label:
-                # Check if distance is less than the threshold
-                if fr_distance <= t:
-                    di[1] += 1
-                else:
-                    fr += 1
+        impostor_distances = np.sort([results[0][1] for (_, label), results in distance_matrix.items()
+                                      if label not in gallery_labels])
+        impostor_attempts = len(impostor_distances)
+
+        thresholds = list(thresholds)
+
+        # False accepts and correct identifications at rank 1, for each threshold
+        fa = np.searchsorted(impostor_distances, thresholds, side='right')
+        accepted = np.searchsorted(np.sort(distances[positions == 0]), thresholds, side='right')
 
-            # Find the first index (rank) in results where a correct match happens
-            else:
-                for res in results:
-                    if res[0] == probe_label:
-                        ind = results.index(res)
-                        di[ind] = di[ind] + 1 if ind in di.keys() else 1
+        # Correct detect and identification @ rank k counter, for each threshold: as in the original per-probe scan,
+        # a first correct match at position p >= 1 counts at rank p (regardless of the threshold)
+        di = np.tile(np.bincount(positions[positions >= 1], minlength=2)[1:], (len(thresholds), 1))
+        di[:, 0] += accepted
 
-                        break
+        # Correct detect & identify rate @ rank k (cumulative, with the same order of the additions)
+        legacy_cmc = np.cumsum(di / genuine_attempts, axis=1)
 
-        # write_scores(dir1scores)
+        # the DIR dictionary has the first rank, the ranks where some probe counts and the ones right before them
+        counted = np.flatnonzero(di[0, 1:]) + 2
+        ranks = sorted(set([1]) | set(counted.tolist()) | set((counted - 1).tolist()))
 
-        # Compute rates
-        dir_k = dict()  # Correct detect & identify rate @ rank k
-        dir_k[1] = di[1] / genuine_attempts
-        frr = 1 - dir_k[1]
-        far = fa / impostor_attempts
-        grr = gr / impostor_attempts
+        # accepted probes whose first correct match is at each position, for each threshold: a match at position p
+        # counts from rank p + 1 on
+        found = positions[positions >= 0]
+        identified = np.zeros((len(thresholds), found.max() + 1 if len(found) != 0 else 1), dtype=np.int64)
+        for p in np.unique(found):
+            identified[:, p] = np.searchsorted(np.sort(distances[positions == p]), thresholds, side='right')
 
-        higher_ranks = sorted(list(di.keys()))
-        higher_ranks.remove(1)  # remove first rank, as here we're interested in the higher ones
-        for k in higher_ranks:
-            if k - 1 not in dir_k.keys():
-                dir_k[k - 1] = dir_k[max(dir_k.keys())]
-            dir_k[k] = (di[k] / genuine_attempts) + dir_k[k - 1]
+        cmc = np.cumsum(identified, axis=1) / genuine_attempts
 
-        performances[t] = dict([("FRR", frr), ("FAR", far), ("GRR", grr), ("DIR", dir_k)])
+        for i, t in enumerate(thresholds):
+            dir_k = dict((k, float(legacy_cmc[i, k - 1])) for k in ranks)
+            frr = 1 - dir_k[1]
+            far = int(fa[i]) / impostor_attempts
+            grr = (impostor_attempts - int(fa[i])) / impostor_attempts
+
+            performances[t] = dict([("FRR", frr), ("FAR", far), ("GRR", grr), ("DIR", dir_k), ("CMC", cmc[i])])
 
     # print(performances)
     # print("Done\n--\n")
@@ -242,29 +486,91 @@ def evaluate_performances(model, thresholds, train_csv, test_csv, resize=True, u
 #         return json.loads(fi.read())
 
 
-def evaluate_avg_performances(recognizer, thresholds, files, use_eyes=False):
+def compute_folds(recognizer, files, use_eyes=False, coarse_to_fine=None):
+    """
+    Trains a model and matches the probes against it on each fold, as compute_fold().
+
+    :return: the distance matrix and the gallery labels of each fold, which evaluate_avg_performances() and
+    evaluate_exact_performances() can share
+    """
+    return [compute_fold(recognizer, train_f, test_f, use_eyes=use_eyes, coarse_to_fine=coarse_to_fine)
+            for train_f, test_f in files]
+
+
+def evaluate_exact_performances(recognizer, files, use_eyes=False, coarse_to_fine=None, folds=None):
+    """
+    Computes the exact FAR, FRR and GRR curves, averaged over the folds, and the EER.
+
+    :param recognizer: model to be used
+    :param files: iterable containing couples of training and testing files
+    :param use_eyes: flag to specify whether to employ the eyes recognition routine
+    :param coarse_to_fine: arguments of the coarse-to-fine matching, as in compute_fold()
+    :param folds: results of compute_folds() to evaluate, None to compute them
+    :return: dictionary with the thresholds (every distinct score of any fold), the average rates at each of them,
+    the EER and the threshold where it is reached, and the average CMC (identification rate at ranks 1, 2, ...)
+    """
+    if folds is None:
+        folds = compute_folds(recognizer, files, use_eyes, coarse_to_fine)
+
+    scores = [rank1_scores(*fold) for fold in folds]
+
+    # every distinct finite score: the rates of each fold only change there
+    thresholds = np.concatenate([np.concatenate(s) for s in scores])
+    thresholds = np.unique(thresholds[np.isfinite(thresholds)])
+
+    avg = dict([("thresholds", thresholds)])
+    for genuine, impostor in scores:
+        for key, value in rates_at(genuine, impostor, thresholds).items():
+            if key != "thresholds":
+                avg[key] = avg.get(key, 0) + value / len(scores)
+
+    err_t, err = utils.equal_error_rate(thresholds, avg["FAR"], avg["FRR"])
+    avg["EER"] = float(err[0]) if len(err) != 0 else None
+    avg["EER_threshold"] = float(err_t[0]) if len(err) != 0 else None
+
+    positions = [genuine_ranks(*fold)[0] for fold in folds]
+    max_rank = max([p.max() + 1 for p in positions if len(p) != 0] + [1])
+    avg["CMC"] = sum(cumulative_match_characteristic(p, max_rank) for p in positions) / len(folds)
+
+    return avg
+
+
+def evaluate_avg_performances(recognizer, thresholds, files, use_eyes=False, coarse_to_fine=None, folds=None):
     """
     Computes averages of what is generated
     by the evaluate_performances() function.
 
     :param recognizer: model to be used
-    :param thresholds: chosen thresholds
+    :param thresholds: chosen thresholds, None to choose them automatically from the scores of all the folds
     :param files: iterable containing couples of training and testing files
     :param use_eyes: flag to specify whether to employ the eyes recognition routine
-    :return: dictionary with average rates
+    :param coarse_to_fine: arguments of the coarse-to-fine matching, as in compute_fold()
+    :param folds: results of compute_folds() to evaluate, None to compute them
+    :return: dictionary with average rates; "AVG_CMC" holds the average DIR(k) of each rank as an array
+    (DIR(k) at index k - 1), where the ranks missing from a fold count with that fold's last DIR
     """
     # print("Starting to compute performances...")
 
+    if folds is None:
+        folds = compute_folds(recognizer, files, use_eyes, coarse_to_fine)
+
+    if thresholds is None:
+        scores = [rank1_scores(*fold) for fold in folds]
+        thresholds = automatic_thresholds(np.concatenate([g for g, _ in scores]),
+                                          np.concatenate([i for _, i in scores]))
+
     avg_performances_per_threshold = dict()
 
     for threshold in thresholds:
         avg_performances_per_threshold[threshold] = dict([("AVG_FRR", 0), ("AVG_FAR", 0), ("AVG_GRR", 0),
                                                           ("AVG_DIR", dict())])
 
-    for train_f, test_f in files:
+    fold_cmcs = list()
+
+    for distance_matrix, gallery_labels in folds:
         # Returns a dictionary "Threshold: rates for the threshold" based on the 'train' & 'test' files
-        perf = evaluate_performances(model=recognizer, thresholds=thresholds, train_csv=train_f, test_csv=test_f,
-                                     use_eyes=use_eyes)
+        perf = compute_rates(distance_matrix, gallery_labels, thresholds)
+        fold_cmcs.append(np.array([perf[threshold]["CMC"] for threshold in thresholds]))
 
         for threshold in thresholds:
             avg_performances_per_threshold[threshold]["AVG_FRR"] += perf[threshold]["FRR"]
@@ -279,13 +585,18 @@ def evaluate_avg_performances(recognizer, thresholds, files, use_eyes=False):
 
     # print("Finishing averages computation...")
 
-    for threshold in thresholds:
-        avg_performances_per_threshold[threshold]["AVG_FRR"] /= len(files)
-        avg_performances_per_threshold[threshold]["AVG_FAR"] /= len(files)
-        avg_performances_per_threshold[threshold]["AVG_GRR"] /= len(files)
+    # the CMC of each fold is extended up to the worst rank of all the folds with its last (cumulative) value
+    max_rank = max(cmc.shape[1] for cmc in fold_cmcs)
+    avg_cmc = sum(np.pad(cmc, ((0, 0), (0, max_rank - cmc.shape[1])), mode='edge') for cmc in fold_cmcs) / len(folds)
+
+    for i, threshold in enumerate(thresholds):
+        avg_performances_per_threshold[threshold]["AVG_CMC"] = avg_cmc[i]
+        avg_performances_per_threshold[threshold]["AVG_FRR"] /= len(folds)
+        avg_performances_per_threshold[threshold]["AVG_FAR"] /= len(folds)
+        avg_performances_per_threshold[threshold]["AVG_GRR"] /= len(folds)
 
         for k in avg_performances_per_threshold[threshold]["AVG_DIR"].keys():
-            avg_performances_per_threshold[threshold]["AVG_DIR"][k] /= len(files)
+            avg_performances_per_threshold[threshold]["AVG_DIR"][k] /= len(folds)
 
     # print("Averages:\n\t")
     # print(avg_performances_per_threshold)
@@ -309,12 +620,29 @@ def parse_args():
     parser.add_argument('-k', '--subsets', help='The number of subsets in which to divide the dataset', type=int,
                         default=5)
     parser.add_argument('-i', '--impostors', help='The number of impostors to use', type=int, default=5)
+    parser.add_argument('--auto-thresholds', help='Choose the thresholds from the range of the scores '
+                        'instead of the predefined ones', action='store_true')
+    parser.add_argument('--report-dir', help='Save the figures and a JSON report to this directory '
+                        'instead of showing them (for headless runs)', default=None)
+    parser.add_argument('--exact', help='Also compute the rates at every score and report the exact EER of each '
+                        'model', action='store_true')
+    parser.add_argument('--shortlist', help='Match the probes coarse-to-fine, re-ranking this many subjects '
+                        'shortlisted at low resolution', type=int, default=None)
+    parser.add_argument('--coarse-size', help='The side of the low-resolution images of the coarse-to-fine matching',
+                        type=int, default=32)
+    preprocessing.add_arguments(parser)
+    profiling.add_argument(parser, '../test/profile/recognition_tests')
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     args = parse_args()
 
+    profiling.start(args.profile)
+    preprocessing.configure(args)
+
+    report = reports.Report(args.report_dir) if args.report_dir is not None else None
+
     subsets_no = args.subsets
     test_files_folder = os.path.join(args.output, 'csv')
     k_fold_files = list()
@@ -347,6 +675,22 @@ if __name__ == '__main__':
     print('K fold cross validation using k = {} subsets and {} impostors'.format(subsets_no, args.impostors))
     print('=' * 80)
 
+    coarse_to_fine = None
+
+    if args.shortlist is not None:
+        coarse_to_fine = dict([("coarse_size", args.coarse_size), ("shortlist", args.shortlist)])
+        shortlist_sizes = sorted(set([1, args.shortlist, 2 * args.shortlist]))
+
+        print('\n' + '-' * 80)
+        print('Coarse-to-fine matching at {0}x{0}: recall of each stage'.format(args.coarse_size))
+        print('-' * 80)
+
+        for name, face_recognizer in [('Eigenfaces', cv.face.EigenFaceRecognizer_create(num_components=10)),
+                                      ('Fisherfaces', cv.face.FisherFaceRecognizer_create(num_components=80)),
+                                      ('LBPH', cv.face.LBPHFaceRecognizer_create(radius=2, neighbors=16))]:
+            print_coarse_to_fine_recall(coarse_to_fine_recall(face_recognizer, k_fold_files, shortlist_sizes,
+                                                              coarse_size=args.coarse_size), name)
+
     print('\n' + '-' * 80)
     print('Eigenfaces')
     print('-' * 80)
@@ -354,7 +698,7 @@ if __name__ == '__main__':
     default_components = 10000  # h * w
     n_components = [10, 80, default_components // 10, default_components]
 
-    test_thresholds = np.linspace(1000, 5000, 100)
+    test_thresholds = np.linspace(1000, 5000, 100) if not args.auto_thresholds else None
 
     avgs = list()
     model_names = list()
@@ -365,18 +709,24 @@ if __name__ == '__main__':
         face_recognizer = cv.face.EigenFaceRecognizer_create(num_components=nc)
         model_names.append('Eig. with {} comp'.format(nc))
 
-        avgs.append(evaluate_avg_performances(face_recognizer, test_thresholds, k_fold_files))
+        # the folds are trained and matched once for both the evaluations
+        folds = compute_folds(face_recognizer, k_fold_files, coarse_to_fine=coarse_to_fine)
+        avgs.append(evaluate_avg_performances(face_recognizer, test_thresholds, k_fold_files, folds=folds))
+
+        if args.exact:
+            print_exact_performances(evaluate_exact_performances(face_recognizer, k_fold_files, folds=folds),
+                                     model_names[-1], report, 'eigenfaces')
 
     print('Done\n')
 
-    utils.plot_error_rates(avgs, model_names)
-    utils.plot_rocs(avgs, model_names)
+    utils.plot_error_rates(avgs, model_names, report=report, name='eigenfaces')
+    utils.plot_rocs(avgs, model_names, report=report, name='eigenfaces')
 
     print('\n' + '-' * 80)
     print('Fisherfaces')
     print('-' * 80)
 
-    test_thresholds = np.linspace(100, 1500, 100)
+    test_thresholds = np.linspace(100, 1500, 100) if not args.auto_thresholds else None
 
     avgs = list()
     model_names = list()
@@ -387,12 +737,18 @@ if __name__ == '__main__':
         face_recognizer = cv.face.FisherFaceRecognizer_create(num_components=nc)
         model_names.append('Fisher with {} comp'.format(nc))
 
-        avgs.append(evaluate_avg_performances(face_recognizer, test_thresholds, k_fold_files))
+        # the folds are trained and matched once for both the evaluations
+        folds = compute_folds(face_recognizer, k_fold_files, coarse_to_fine=coarse_to_fine)
+        avgs.append(evaluate_avg_performances(face_recognizer, test_thresholds, k_fold_files, folds=folds))
+
+        if args.exact:
+            print_exact_performances(evaluate_exact_performances(face_recognizer, k_fold_files, folds=folds),
+                                     model_names[-1], report, 'fisherfaces')
 
     print('Done\n')
 
-    utils.plot_error_rates(avgs, model_names)
-    utils.plot_rocs(avgs, model_names)
+    utils.plot_error_rates(avgs, model_names, report=report, name='fisherfaces')
+    utils.plot_rocs(avgs, model_names, report=report, name='fisherfaces')
 
     print('\n' + '-' * 80)
     print('LBPH')
@@ -403,7 +759,7 @@ if __name__ == '__main__':
     grid = [4, 8]
     models_tot = 24
 
-    test_thresholds = np.linspace(1, 200, 100)
+    test_thresholds = np.linspace(1, 200, 100) if not args.auto_thresholds else None
 
     avgs = list()
     model_names = list()
@@ -417,9 +773,18 @@ if __name__ == '__main__':
         face_recognizer = cv.face.LBPHFaceRecognizer_create(radius=r, neighbors=n, grid_x=g, grid_y=g)
         model_names.append('LBPH with radius {}, {} neighs, {}x{} grid'.format(r, n, g, g))
 
-        avgs.append(evaluate_avg_performances(face_recognizer, test_thresholds, k_fold_files))
+        # the folds are trained and matched once for both the evaluations
+        folds = compute_folds(face_recognizer, k_fold_files, coarse_to_fine=coarse_to_fine)
+        avgs.append(evaluate_avg_performances(face_recognizer, test_thresholds, k_fold_files, folds=folds))
+
+        if args.exact:
+            print_exact_performances(evaluate_exact_performances(face_recognizer, k_fold_files, folds=folds),
+                                     model_names[-1], report, 'lbph')
 
     print('Done\n')
 
-    utils.plot_error_rates(avgs, model_names)
-    utils.plot_rocs(avgs, model_names)
+    utils.plot_error_rates(avgs, model_names, report=report, name='lbph')
+    utils.plot_rocs(avgs, model_names, report=report, name='lbph')
+
+    if report is not None:
+        report.close()
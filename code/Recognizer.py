@@ -12,6 +12,10 @@ from argparse import ArgumentParser
 import numpy as np
 import cv2.cv2 as cv
 import os
+import cache
+import Gallery
+import preprocessing
+import profiling
 import utils
 
 
@@ -40,7 +44,10 @@ def train_recongizer(recognizer: cv.face_BasicFaceRecognizer, csv_filename, resi
                      show_mean=False,
                      save_mean=False,
                      show_faces=False,
-                     save_faces=False):
+                     save_faces=False,
+                     pipeline=None,
+                     memory_limit=None,
+                     randomized=False):
     """
     Trains a face recognizer.
 
@@ -53,15 +60,35 @@ def train_recongizer(recognizer: cv.face_BasicFaceRecognizer, csv_filename, resi
     :param save_mean: if True, the mean image is saved in save_dir.
     :param show_faces: if True, eigenfaces/fisherfaces are shown.
     :param save_faces: if True, eigenfaces/fisherfaces are saved in save_dir.
+    :param pipeline: preprocessing.Pipeline to load the images with (default: preprocessing.default).
+    :param memory_limit: if not None, the images are streamed in chunks and the model is trained within about
+                         this many MB (see Streaming_Trainer); csv_filename may then also be a .npy stack of faces.
+    :param randomized: if True, Eigenfaces are trained through a randomized SVD (see Randomized_Trainer).
     :return: the trained model and the height of the images used for the training.
     """
-    faces, labels = utils.read_csv(csv_filename, resize)
+    if memory_limit is not None:
+        import Streaming_Trainer
 
-    #  print("Total faces: {0}\nTotal labels: {1}".format(len(faces), len(set(labels))))
+        with profiling.stage('train/fit'):
+            recognizer, height, labels = Streaming_Trainer.train_streaming(recognizer, csv_filename, resize, True,
+                                                                           memory_limit, pipeline)
+    else:
+        with profiling.stage('train/read_csv'):
+            faces, labels = utils.read_csv(csv_filename, resize, pipeline=pipeline)
+
+        #  print("Total faces: {0}\nTotal labels: {1}".format(len(faces), len(set(labels))))
 
-    height = faces[0].shape[0]
+        height = faces[0].shape[0]
 
-    recognizer.train(faces, np.array(labels))
+        with profiling.stage('train/fit'):
+            if randomized:
+                import Randomized_Trainer
+                Randomized_Trainer.fit(recognizer, faces, labels)
+            else:
+                recognizer.train(faces, np.array(labels))
+
+    # cached results of the previous model are no longer valid
+    cache.invalidate_model(recognizer)
 
     # print("Train finished")
 
@@ -121,37 +148,102 @@ def train_recongizer(recognizer: cv.face_BasicFaceRecognizer, csv_filename, resi
     return recognizer, height
 
 
+def train_coarse_to_fine(recognizer: cv.face_FaceRecognizer, csv_filename, coarse_recognizer=None, coarse_size=32,
+                         shortlist=5, resize=True, ret_labels=False, pipeline=None):
+    """
+    Trains a face recognizer alongside a low-resolution one, which shortlists the subjects it re-ranks.
+
+    :param recognizer: face recognizer to be trained.
+    :param csv_filename: file containing the images to be used for the training process.
+    :param coarse_recognizer: face recognizer to be trained with the downsampled images
+                              (default: Eigenfaces with 10 components).
+    :param coarse_size: side of the (square) downsampled images.
+    :param shortlist: number of candidate subjects re-ranked at full resolution.
+    :param resize: flag to specify whether images should be resized.
+    :param ret_labels: flag to specify whether the list of labels used for training should be returned.
+    :param pipeline: preprocessing.Pipeline to load the images with (default: preprocessing.default).
+    :return: the Gallery.CoarseToFineGallery, to be passed to predict() as gallery, and the height of the images
+    used for the training.
+    """
+    if coarse_recognizer is None:
+        coarse_recognizer = cv.face.EigenFaceRecognizer_create(num_components=10)
+
+    with profiling.stage('train/read_csv'):
+        faces, labels = utils.read_csv(csv_filename, resize, pipeline=pipeline)
+
+    with profiling.stage('train/fit'):
+        gallery = Gallery.CoarseToFineGallery.train(recognizer, coarse_recognizer, faces, labels, coarse_size,
+                                                    shortlist)
+
+    if ret_labels:
+        return gallery, faces[0].shape[0], set(labels)
+
+    return gallery, faces[0].shape[0]
+
+
 def predict(recognizer: cv.face_BasicFaceRecognizer, height, probe_image, probe_label=None, resize=True,
-            identification=True):
+            identification=True, gallery=None, cohort=None, pipeline=None, result_cache=None):
     """
     Performs a face recognition operation.
 
-    :param recognizer: face recognizer.
+    :param recognizer: face recognizer, or a gallery (e.g. the Gallery.Gallery returned by load_model() for .npz files).
     :param height: height of the images used to train the model.
     :param probe_image: path to the image of the probe.
     :param probe_label: label of the probe.
     :param resize: flag to specify whether the probe image should be resized.
     :param identification: flag to specify the recognition operation
                            to carry out (True: identification, False: verification)
+    :param gallery: if given (a Gallery.Gallery, Gallery.CompactGallery or Gallery.CoarseToFineGallery),
+                    the identification matches the probe against it instead of the recognizer.
+    :param cohort: if given (a Gallery.Cohort of the recognizer's subjects), the identification returns
+                   z-normalized distances, which can share a single threshold across the recognizers.
+    :param pipeline: preprocessing.Pipeline to load the probe with; it should be the one used for the training
+                     (default: preprocessing.default).
+    :param result_cache: cache.ResultCache of the identification results, which are reused
+                         for the same (or a nearly identical) probe face.
     :return: the result of the prediction.
     """
     if not os.path.exists(probe_image):
         raise RuntimeError("File {} does not exist!".format(probe_image))
 
-    input_face = cv.imread(probe_image, 0)
+    profiling.count('predict/probes')
+
+    # e.g. a .npz gallery returned by load_model()
+    if not isinstance(recognizer, cv.face_FaceRecognizer):
+        gallery = gallery if gallery is not None else recognizer
+
+    pipeline = pipeline or preprocessing.default
+
+    with profiling.stage('predict/preprocess'):
+        input_face = pipeline.load([probe_image], height if resize else None)[0]
+
+    if identification and result_cache is not None:
+        version = cache.fingerprint(gallery if gallery is not None else recognizer, cohort, pipeline.config,
+                                    height if resize else None)
 
-    if resize:
-        # input_face = utils.resize_image(input_face, 100, 100)
-        input_face = utils.resize_image(input_face, height, height)
+        with profiling.stage('predict/cache'):
+            results, face_hash = result_cache.get(input_face, version)
+
+        if results is not None:
+            return results
 
     if identification:
-        coll: cv.face_StandardCollector = cv.face.StandardCollector_create()
-        recognizer.predict_collect(input_face, coll)
+        with profiling.stage('predict/match'):
+            if gallery is not None:
+                results = gallery.predict(input_face)
+            else:
+                coll: cv.face_StandardCollector = cv.face.StandardCollector_create()
+                recognizer.predict_collect(input_face, coll)
+                results = sorted(coll.getResults(), key=lambda x: x[1])
         # print(coll.getResults())
         # print(coll.getMinDist())
         # print(coll.getMinLabel())
 
-        results = sorted(coll.getResults(), key=lambda x: x[1])
+        if cohort is not None:
+            results = cohort.normalize(results)
+
+        if result_cache is not None:
+            result_cache.put(face_hash, results, version)
 
         # print(results)
 
@@ -163,7 +255,10 @@ def predict(recognizer: cv.face_BasicFaceRecognizer, height, probe_image, probe_
 
         return results
 
-    prediction = recognizer.predict(input_face)
+    if not isinstance(recognizer, cv.face_FaceRecognizer):
+        prediction = recognizer.predict(input_face)[0]
+    else:
+        prediction = recognizer.predict(input_face)
 
     if probe_label is not None:
         print("Predicted class = {0} ({1}) with confidence = {2}; Actual class = {3} ({4}).\n\t Outcome: {5}"
@@ -172,14 +267,21 @@ def predict(recognizer: cv.face_BasicFaceRecognizer, height, probe_image, probe_
                       "Success!" if prediction[0] == probe_label else "Failure!"))
 
 
-def save_model(recognizer_model: cv.face_BasicFaceRecognizer, save_dir, height, uid=0):
+def save_model(recognizer_model: cv.face_BasicFaceRecognizer, save_dir, height, uid=0, precision=None):
     """
     Saves a recognizer model to file.
     :param recognizer_model: model to be saved.
     :param save_dir: path where the model should be saved.
     :param height: height of the images used for the training.
     :param uid: identifier of the model to save.
+    :param precision: if given (one of Gallery.precisions), the model is saved as a .npz gallery in that precision.
     """
+    if precision is not None:
+        file_name = os.path.join(save_dir, "model_{0}_{1}.npz".format(uid, height))
+        print("Saving {} gallery to: ".format(precision), file_name)
+        Gallery.Gallery(recognizer_model, precision).save(file_name, height=height)
+        return
+
     file_name = os.path.join(save_dir, "model_{0}_{1}.xml".format(uid, height))
     print("Saving model to: ", file_name)
     recognizer_model.save(file_name)
@@ -190,9 +292,14 @@ def load_model(recognizer_model: cv.face_BasicFaceRecognizer, file_name):
     Loads a previously-saved model from file.
     :param recognizer_model: empty model the file should be loaded into.
     :param file_name: the file where the model is stored.
-    :return: the loaded model.
+    :return: the loaded model (a Gallery.Gallery for .npz files) and the height of the training images.
     """
+    if file_name.endswith(".npz"):
+        gallery, metadata = Gallery.Gallery.load(file_name)
+        return gallery, metadata["height"]
+
     recognizer_model.read(file_name)
+    cache.invalidate_model(recognizer_model)
     height = file_name.split("_")[-1].split(".")[0]
 
     return recognizer_model, int(height)
@@ -210,12 +317,17 @@ def parse_args():
     parser = ArgumentParser()
     parser.add_argument('input_dataset', help='The path of the input dataset')
     parser.add_argument('-r', '--recognizer', help='The recognizer to use', type=int, choices=range(3), required=True)
+    preprocessing.add_arguments(parser)
+    profiling.add_argument(parser, '../test/profile/recognizer')
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     args = parse_args()
 
+    profiling.start(args.profile)
+    preprocessing.configure(args)
+
     if args.recognizer == 0:
         model: cv.face_BasicFaceRecognizer = cv.face.EigenFaceRecognizer_create(num_components=10)
 
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module provides a local identification service, which keeps the cascades and a trained recognizer in
+memory and serves identification requests over HTTP (on localhost or on a Unix socket).
+
+Concurrent requests are grouped into micro-batches, waiting at most a bounded time for a batch to fill up,
+and each batch goes through detection and matching at once.
+
+Endpoints:
+    POST /identify[?top=k]  body: an image file; returns the ranked (label, name, distance) list
+    GET /stats              queue depth, batch sizes, cache hit rate and p50/p99 latencies
+    GET /health
+
+Authors:
+    Pg96, dsforza96
+"""
+
+from argparse import ArgumentParser
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import cv2.cv2 as cv
+import json
+import numpy as np
+from os import path
+import time
+from urllib.parse import parse_qs, urlsplit
+
+import cache
+import Detector
+import Gallery
+import preprocessing
+import profiling
+import Recognizer
+import utils
+
+# maximum size of an uploaded image
+max_body_size = 32 * 1024 * 1024
+
+# number of latencies kept to compute the percentiles
+latency_window = 10000
+
+_reasons = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 413: 'Payload Too Large',
+            500: 'Internal Server Error'}
+
+
+class IdentificationService:
+    """
+    Micro-batching identification service.
+    """
+
+    def __init__(self, recognizer, height, detector=0, scale_factor=1.05, min_neighbors=2, detect=True,
+                 max_batch=8, max_wait=0.01, precision='float64', compact=0, compact_method='centroids', rerank=0,
+                 znorm=False, cache_size=0, cache_radius=4):
+        """
+        :param recognizer: trained face recognizer, or an already built Gallery.Gallery.
+        :param height: height of the images used to train the recognizer.
+        :param detector: index of the cascade used to detect the faces, as in Detector.detect_cat_face.
+        :param scale_factor: scale factor value the detector should use.
+        :param min_neighbors: min neighbors value the detector should use.
+        :param detect: if False, uploaded images are assumed to be already cropped faces.
+        :param max_batch: maximum number of requests in a batch.
+        :param max_wait: maximum time (in seconds) to wait for a batch to fill up.
+        :param precision: precision of the gallery built from the recognizer, one of Gallery.precisions.
+        :param compact: if not 0, probes are matched against at most these representative templates per subject
+                        (see Gallery.CompactGallery).
+        :param compact_method: 'centroids' or 'medoids'.
+        :param rerank: number of top subjects to re-rank against all their templates, with compact.
+        :param znorm: if True, the distances are z-normalized with the impostor statistics of each subject.
+        :param cache_size: if not 0, the results of up to these recent faces are cached (see cache.ResultCache).
+        :param cache_radius: maximum Hamming distance between the perceptual hashes of two faces
+                             considered the same probe by the cache.
+        """
+        self.recognizer = recognizer
+        self.height = height
+        self.gallery = recognizer if isinstance(recognizer, Gallery.Gallery) else Gallery.Gallery(recognizer, precision)
+        self.cohort = Gallery.Cohort.from_gallery(self.gallery) if znorm else None
+        if compact != 0:
+            self.gallery = Gallery.CompactGallery(self.gallery, compact, compact_method, rerank)
+
+        self.result_cache = cache.ResultCache(cache_size, cache_radius) if cache_size != 0 else None
+        self._cache_version = cache.fingerprint(self.gallery, self.cohort, preprocessing.default.config, height)
+        self.detector = detector
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.detect = detect
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+
+        if detect:
+            # loaded once, here
+            cascade = Detector.load_cascade(path.join(Detector.cascade_models_dir, Detector.cat_cascades[detector]))
+            if cascade.empty():
+                raise RuntimeError('The face classifier was not loaded correctly!')
+
+        # a single worker, so that the cascade and the recognizer are never used concurrently
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._queue = None
+        self._in_flight = 0
+        self._latencies = deque(maxlen=latency_window)
+        self._processed = 0
+        self._batches = 0
+
+    def _prepare(self, data):
+        """
+        Decodes an uploaded image and crops the face.
+
+        :return: the grayscale face, resized as the training images, and whether a face was detected
+        (None, False if the image cannot be decoded).
+        """
+        with profiling.stage('service/decode'):
+            gray = cv.imdecode(np.frombuffer(data, dtype=np.uint8), cv.IMREAD_GRAYSCALE)
+
+        if gray is None:
+            return None, False
+
+        detected = False
+        if self.detect:
+            face = Detector.crop_cat_face(gray, self.detector, self.scale_factor, self.min_neighbors)
+
+            if face is not None:
+                gray = face
+                detected = True
+
+        with profiling.stage('service/preprocess'):
+            return preprocessing.default.transform([gray], self.height)[0], detected
+
+    def identify_batch(self, images):
+        """
+        Identifies a batch of uploaded images.
+
+        :param images: encoded images.
+        :return: for each image, the (label, distance) results and whether a face was detected,
+        or None if the image cannot be decoded.
+        """
+        prepared = [self._prepare(data) for data in images]
+        faces = [face for face, _ in prepared if face is not None]
+
+        cached = [(None, None)] * len(faces)
+        if self.result_cache is not None:
+            with profiling.stage('service/cache'):
+                cached = [self.result_cache.get(face, self._cache_version) for face in faces]
+
+        missing = [face for face, (results, _) in zip(faces, cached) if results is None]
+
+        with profiling.stage('service/match'):
+            matched = self.gallery.predict_many(missing)
+            matched = iter(matched if self.cohort is None else [self.cohort.normalize(r) for r in matched])
+
+        results = []
+        for hit, face_hash in cached:
+            if hit is None:
+                hit = next(matched)
+                if self.result_cache is not None:
+                    self.result_cache.put(face_hash, hit, self._cache_version)
+            results.append(hit)
+
+        results = iter(results)
+
+        return [(next(results), detected) if face is not None else None for face, detected in prepared]
+
+    async def _batcher(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            self._in_flight = len(batch)
+            profiling.count('service/batches')
+
+            try:
+                outcomes = await loop.run_in_executor(self._executor, self.identify_batch,
+                                                      [data for data, _ in batch])
+            except Exception as e:
+                outcomes = [e] * len(batch)
+
+            self._in_flight = 0
+            self._batches += 1
+            self._processed += len(batch)
+
+            for (_, future), outcome in zip(batch, outcomes):
+                if future.cancelled():
+                    continue
+                if isinstance(outcome, Exception):
+                    future.set_exception(outcome)
+                else:
+                    future.set_result(outcome)
+
+    async def identify(self, data):
+        """
+        Queues an image for identification.
+
+        :return: the (label, distance) results and whether a face was detected, None if the image is not valid.
+        """
+        future = asyncio.get_running_loop().create_future()
+        start = time.perf_counter()
+
+        await self._queue.put((data, future))
+        outcome = await future
+
+        self._latencies.append(time.perf_counter() - start)
+
+        return outcome
+
+    def stats(self):
+        """
+        :return: dictionary with the queue depth, the number of processed requests and batches,
+        the cache metrics and the latency percentiles (in ms).
+        """
+        latencies = np.array(self._latencies) * 1000
+
+        return dict([("queue_depth", self._queue.qsize() + self._in_flight),
+                     ("processed", self._processed),
+                     ("batches", self._batches),
+                     ("mean_batch_size", self._processed / self._batches if self._batches else 0),
+                     ("cache", self.result_cache.stats() if self.result_cache is not None else None),
+                     ("latency_ms", dict([("p50", float(np.percentile(latencies, 50)) if len(latencies) else None),
+                                          ("p99", float(np.percentile(latencies, 99)) if len(latencies) else None),
+                                          ("samples", len(latencies))]))])
+
+    async def _respond(self, writer, status, body):
+        payload = json.dumps(body).encode()
+
+        writer.write("HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n"
+                     "Connection: close\r\n\r\n".format(status, _reasons[status], len(payload)).encode())
+        writer.write(payload)
+
+        await writer.drain()
+        writer.close()
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = (await reader.readline()).decode('latin-1').split()
+            if len(request_line) < 2:
+                writer.close()
+                return
+
+            method, target = request_line[0], request_line[1]
+
+            headers = dict()
+            while True:
+                line = (await reader.readline()).decode('latin-1')
+                if line in ('\r\n', '\n', ''):
+                    break
+                name, _, value = line.partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            url = urlsplit(target)
+
+            if url.path == '/health':
+                await self._respond(writer, 200, dict([("status", "ok")]))
+
+            elif url.path == '/stats':
+                await self._respond(writer, 200, self.stats())
+
+            elif url.path == '/identify':
+                if method != 'POST':
+                    await self._respond(writer, 405, dict([("error", "use POST")]))
+                    return
+
+                length = int(headers.get('content-length', 0))
+                if length > max_body_size:
+                    await self._respond(writer, 413, dict([("error", "image too big")]))
+                    return
+
+                data = await reader.readexactly(length)
+                outcome = await self.identify(data)
+
+                if outcome is None:
+                    await self._respond(writer, 400, dict([("error", "the image cannot be decoded")]))
+                    return
+
+                results, detected = outcome
+
+                top = parse_qs(url.query).get('top')
+                if top is not None:
+                    results = results[:int(top[0])]
+
+                await self._respond(writer, 200, dict([
+                    ("face_detected", detected),
+                    ("results", [(label, utils.get_subject_name(label), distance) for label, distance in results])]))
+
+            else:
+                await self._respond(writer, 404, dict([("error", "unknown path")]))
+
+        except (ConnectionError, asyncio.IncompleteReadError):
+            writer.close()
+
+        except ValueError as e:
+            await self._respond(writer, 400, dict([("error", str(e))]))
+
+        except Exception as e:
+            await self._respond(writer, 500, dict([("error", repr(e))]))
+
+    async def serve(self, host='127.0.0.1', port=8000, unix_socket=None):
+        """
+        Serves requests forever, on host:port or on unix_socket if given.
+        """
+        self._queue = asyncio.Queue()
+        batcher = asyncio.ensure_future(self._batcher())
+
+        if unix_socket is not None:
+            server = await asyncio.start_unix_server(self._handle, path=unix_socket)
+            print("Serving on", unix_socket)
+        else:
+            server = await asyncio.start_server(self._handle, host=host, port=port)
+            print("Serving on http://{}:{}".format(host, port))
+
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('-r', '--recognizer', help='The recognizer to use', type=int, choices=range(3), required=True)
+    parser.add_argument('-t', '--train', help='The csv file of the images to train the recognizer with',
+                        default='../dataset_info/complete.csv')
+    parser.add_argument('-m', '--model', help='A previously saved model (.xml) or gallery (.npz) to load instead of '
+                                              'training one', default=None)
+    parser.add_argument('-p', '--precision', help='The precision of the in-memory gallery', default='float64',
+                        choices=Gallery.precisions)
+    parser.add_argument('-d', '--detector', default=0, type=int, choices=range(len(Detector.cat_cascades)))
+    parser.add_argument('-s', '--scalefactor', default=1.05, type=float)
+    parser.add_argument('-n', '--minneighbors', default=2, type=int)
+    parser.add_argument('--no-detect', help='Uploaded images are already cropped faces', action='store_true')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--unix', help='Serve on this Unix socket instead of TCP', default=None)
+    parser.add_argument('-b', '--max-batch', help='The maximum number of requests in a batch', default=8, type=int)
+    parser.add_argument('-w', '--max-wait', help='The maximum time (in ms) to wait for a batch to fill up',
+                        default=10, type=float)
+    parser.add_argument('-c', '--compact', help='Match against at most this number of templates per subject first',
+                        default=0, type=int)
+    parser.add_argument('--compact-method', default='centroids', choices=['centroids', 'medoids'])
+    parser.add_argument('--rerank', help='The number of top subjects to re-rank against all their templates',
+                        default=0, type=int)
+    parser.add_argument('-z', '--znorm', help='Return z-normalized distances', action='store_true')
+    parser.add_argument('--cache', help='The number of recent results to cache', default=0, type=int)
+    parser.add_argument('--cache-radius', help='The maximum Hamming distance between the perceptual hashes '
+                                               'of two faces considered the same probe', default=4, type=int)
+    preprocessing.add_arguments(parser)
+    profiling.add_argument(parser, '../test/profile/service')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    profiling.start(args.profile)
+    preprocessing.configure(args)
+
+    if args.recognizer == 0:
+        model: cv.face_BasicFaceRecognizer = cv.face.EigenFaceRecognizer_create(num_components=10)
+
+    elif args.recognizer == 1:
+        model: cv.face_BasicFaceRecognizer = cv.face.FisherFaceRecognizer_create(num_components=80)
+
+    elif args.recognizer == 2:
+        model: cv.face_BasicFaceRecognizer = cv.face.LBPHFaceRecognizer_create(radius=2, neighbors=16)
+
+    if args.model is not None:
+        mod, hei = Recognizer.load_model(model, args.model)
+    else:
+        mod, hei = Recognizer.train_recongizer(model, args.train)
+
+    service = IdentificationService(mod, hei, detector=args.detector, scale_factor=args.scalefactor,
+                                    min_neighbors=args.minneighbors, detect=not args.no_detect,
+                                    max_batch=args.max_batch, max_wait=args.max_wait / 1000,
+                                    precision=args.precision, compact=args.compact,
+                                    compact_method=args.compact_method, rerank=args.rerank, znorm=args.znorm,
+                                    cache_size=args.cache, cache_radius=args.cache_radius)
+
+    try:
+        asyncio.run(service.serve(args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
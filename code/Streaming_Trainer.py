@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module provides a memory-bounded trainer for the face recognizers, for galleries too large to be loaded
+(and copied by OpenCV into its data matrix) at once.
+
+Faces are read in chunks, from a csv file or from a memory-mapped stack of faces (see write_stack()).
+Eigenfaces are computed through an incremental PCA, Fisherfaces through an incremental PCA followed by an LDA
+in the (small) PCA space, and LBPH histograms are added chunk by chunk through update(). The chunk size and,
+if needed, the number of PCA components are chosen to stay within a memory limit. The limit does not apply to
+the LBPH histograms, which OpenCV keeps for every face (2^neighbors * grid_x * grid_y floats each, e.g. 16 MB at
+16 neighbors and an 8 x 8 grid): only the decoded faces are bounded, and a warning is printed when the histograms
+will not fit.
+
+The trained model is loaded into an ordinary OpenCV recognizer, so it can be used (and saved) as any other one.
+
+Authors:
+    Pg96, dsforza96
+"""
+
+from argparse import ArgumentParser
+import cv2.cv2 as cv
+import numpy as np
+import os
+import sys
+import tempfile
+
+import cache
+import preprocessing
+import profiling
+import utils
+
+# default memory limit (in MB)
+default_memory_limit = 512
+
+
+def csv_entries(csv_filename):
+    """
+    :return: the images of a csv file and their labels.
+    """
+    label_to_file, files = utils.read_csv(csv_filename, mapping=True)
+    file_to_label = dict((file, label) for label, label_files in label_to_file.items() for file in label_files)
+
+    return files, np.array([file_to_label[file] for file in files], dtype=np.int32)
+
+
+def labels_file(stack_file):
+    """
+    :return: the file where the labels of a stack of faces are stored.
+    """
+    return stack_file[:-len('.npy')] + '.labels.npy'
+
+
+def write_stack(csv_filename, stack_file, size=100, chunk_size=256, pipeline=None):
+    """
+    Preprocesses the images of a csv file into a stack of faces (a .npy file, which can be memory-mapped),
+    without holding them in memory.
+
+    :param csv_filename: file containing the images.
+    :param stack_file: .npy file where to save the faces; their labels are saved in labels_file(stack_file).
+    :param size: side of the (square) faces.
+    :param chunk_size: number of images preprocessed at once.
+    :param pipeline: preprocessing.Pipeline to load the images with (default: preprocessing.default).
+    """
+    pipeline = pipeline or preprocessing.default
+    files, labels = csv_entries(csv_filename)
+
+    stack = np.lib.format.open_memmap(stack_file, mode='w+', dtype=np.uint8, shape=(len(files), size, size))
+
+    for start in range(0, len(files), chunk_size):
+        stack[start:start + chunk_size] = np.stack(pipeline.load(files[start:start + chunk_size], size,
+                                                                 memoize=False))
+
+    stack.flush()
+    del stack
+
+    np.save(labels_file(stack_file), labels)
+
+
+class FaceSource:
+    """
+    Faces to train with, read in chunks from a csv file or from a memory-mapped stack.
+    """
+
+    def __init__(self, source, resize=True, pipeline=None):
+        """
+        :param source: csv file or .npy stack of faces.
+        :param resize: flag to specify whether the images of a csv file should be resized (as utils.read_csv does).
+        :param pipeline: preprocessing.Pipeline to load the images of a csv file with (default: preprocessing.default).
+        """
+        self._pipeline = pipeline or preprocessing.default
+        self._size = 100 if resize else None
+
+        if source.endswith('.npy'):
+            self._stack = np.load(source, mmap_mode='r')
+            self.labels = np.load(labels_file(source))
+            self.shape = self._stack.shape[1:]
+        else:
+            self._stack = None
+            self._files, self.labels = csv_entries(source)
+            self.shape = self._load(0, 1)[0].shape
+
+    def __len__(self):
+        return len(self.labels)
+
+    def _load(self, start, stop):
+        if self._stack is not None:
+            return list(self._stack[start:stop])
+
+        return self._pipeline.load(self._files[start:stop], self._size, memoize=False)
+
+    def chunks(self, chunk_size):
+        """
+        :return: generator of the (faces, labels) chunks.
+        """
+        for start in range(0, len(self), chunk_size):
+            with profiling.stage('streaming/read'):
+                faces = self._load(start, start + chunk_size)
+
+            yield faces, self.labels[start:start + chunk_size]
+
+    def data(self, chunk_size):
+        """
+        :return: generator of the chunks of the data matrix (one flattened float64 face per row).
+        """
+        for faces, _ in self.chunks(chunk_size):
+            yield np.stack(faces).reshape(len(faces), -1).astype(np.float64)
+
+
+class IncrementalPCA:
+    """
+    PCA updated one chunk of samples at a time, keeping just the principal components and their singular values
+    (as in D. Ross et al., Incremental Learning for Robust Visual Tracking, 2008).
+    """
+
+    def __init__(self, n_components):
+        self.n_components = n_components
+        self.n_samples = 0
+        self.mean = None
+        self.components = None  # one per row
+        self.singular_values = None
+
+    def partial_fit(self, x):
+        """
+        Updates the components with a chunk of samples (one per row).
+        """
+        n = len(x)
+        chunk_mean = x.mean(axis=0)
+
+        if self.n_samples == 0:
+            matrix = x - chunk_mean
+            mean = chunk_mean
+        else:
+            total = self.n_samples + n
+            mean = (self.n_samples * self.mean + n * chunk_mean) / total
+
+            # the old components, the new centered samples and the correction for the shift of the mean
+            correction = np.sqrt(self.n_samples * n / total) * (self.mean - chunk_mean)
+            matrix = np.vstack([self.singular_values.reshape(-1, 1) * self.components, x - chunk_mean,
+                                correction.reshape(1, -1)])
+
+        with profiling.stage('streaming/svd'):
+            _, s, vt = np.linalg.svd(matrix, full_matrices=False)
+
+        self.n_samples += n
+        self.mean = mean
+        self.components = vt[:self.n_components]
+        self.singular_values = s[:self.n_components]
+
+    def eigenvalues(self):
+        """
+        :return: the eigenvalues of the covariance matrix (scaled by the number of samples, as cv.PCA does).
+        """
+        return self.singular_values ** 2 / self.n_samples
+
+    def project(self, x):
+        return (x - self.mean) @ self.components.T
+
+
+def plan(dimensions, n_components, memory_limit):
+    """
+    Chooses the chunk size and the number of PCA components that fit a memory limit.
+
+    The incremental PCA decomposes a matrix of (components + chunk + 1) rows, taking about 4 times its size.
+
+    :param dimensions: number of pixels of the faces.
+    :param n_components: number of requested components.
+    :param memory_limit: memory limit, in MB.
+    :return: the chunk size and the number of components.
+    """
+    rows = int(memory_limit * 2 ** 20 / (8 * dimensions) / 4)
+
+    if rows < 16:
+        raise ValueError('A memory limit of {} MB is too small for faces of {} pixels'.format(memory_limit,
+                                                                                             dimensions))
+
+    n_components = min(n_components, rows // 2)
+
+    return rows - n_components - 1, n_components
+
+
+def fit_pca(source, n_components, memory_limit):
+    """
+    :return: the incremental PCA of the faces of a source and the chunk size used.
+    """
+    chunk_size, kept = plan(int(np.prod(source.shape)), n_components, memory_limit)
+
+    if kept < n_components:
+        print("Keeping {} components out of {}, within the memory limit".format(kept, n_components))
+
+    pca = IncrementalPCA(kept)
+    for x in source.data(chunk_size):
+        pca.partial_fit(x)
+
+    return pca, chunk_size
+
+
+def lda(projections, labels, n_components):
+    """
+    LDA of the PCA projections, as cv.LDA computes it (the between-class scatter is not weighted by the class sizes).
+
+    :return: the eigenvalues and the eigenvectors (one per column) of the LDA, by decreasing eigenvalue.
+    """
+    classes = np.unique(labels)
+    total_mean = projections.mean(axis=0)
+
+    within = np.zeros((projections.shape[1], projections.shape[1]))
+    between = np.zeros_like(within)
+
+    for c in classes:
+        samples = projections[labels == c]
+        class_mean = samples.mean(axis=0)
+
+        within += (samples - class_mean).T @ (samples - class_mean)
+        between += np.outer(class_mean - total_mean, class_mean - total_mean)
+
+    eigenvalues, eigenvectors = np.linalg.eig(np.linalg.solve(within, between))
+    order = np.argsort(-eigenvalues.real, kind='stable')[:n_components]
+
+    return eigenvalues.real[order], eigenvectors.real[:, order]
+
+
+def write_model(file_name, name, n_components, mean, eigenvalues, eigenvectors, projections, labels):
+    """
+    Writes an Eigenfaces/Fisherfaces model in the format of cv.face_BasicFaceRecognizer.write().
+
+    :param name: 'opencv_eigenfaces' or 'opencv_fisherfaces'.
+    """
+    fs = cv.FileStorage(file_name, cv.FILE_STORAGE_WRITE)
+
+    fs.startWriteStruct(name, cv.FILE_NODE_MAP)
+    fs.write('threshold', sys.float_info.max)
+    fs.write('num_components', int(n_components))
+    fs.write('mean', mean.reshape(1, -1))
+    fs.write('eigenvalues', eigenvalues)
+    fs.write('eigenvectors', eigenvectors)
+
+    fs.startWriteStruct('projections', cv.FILE_NODE_SEQ)
+    for projection in projections:
+        fs.write('', projection.reshape(1, -1))
+    fs.endWriteStruct()
+
+    fs.write('labels', labels.reshape(-1, 1).astype(np.int32))
+    fs.startWriteStruct('labelsInfo', cv.FILE_NODE_SEQ)
+    fs.endWriteStruct()
+
+    fs.endWriteStruct()
+    fs.release()
+
+
+def read_model(recognizer, name, *model):
+    """
+    Loads a model into an Eigenfaces/Fisherfaces recognizer (see write_model() for the arguments).
+    """
+    fd, file_name = tempfile.mkstemp(suffix='.yml')
+    os.close(fd)
+
+    try:
+        with profiling.stage('streaming/load_model'):
+            write_model(file_name, name, *model)
+            recognizer.read(file_name)
+    finally:
+        os.remove(file_name)
+
+
+def train_streaming(recognizer: cv.face_FaceRecognizer, source, resize=True, ret_labels=False,
+                    memory_limit=default_memory_limit, pipeline=None):
+    """
+    Trains a face recognizer reading its training faces in chunks.
+
+    :param recognizer: face recognizer to be trained (its number of components is the requested one).
+    :param source: csv file or .npy stack of faces (see write_stack()).
+    :param resize: flag to specify whether the images of a csv file should be resized.
+    :param ret_labels: flag to specify whether the set of labels used for training should be returned.
+    :param memory_limit: approximate memory (in MB) the decomposition may take; for LBPH, it bounds the decoded faces
+                         only, not the histograms of the model.
+    :param pipeline: preprocessing.Pipeline to load the images of a csv file with (default: preprocessing.default).
+    :return: the trained model and the height of the images used for the training, as Recognizer.train_recongizer.
+    """
+    faces = FaceSource(source, resize, pipeline)
+    labels = faces.labels
+    n_classes = len(np.unique(labels))
+
+    if type(recognizer) is cv.face_LBPHFaceRecognizer:
+        # histograms are computed one image at a time anyway: chunks just bound the decoded faces in memory
+        chunk_size = max(1, int(memory_limit * 2 ** 20 / np.prod(faces.shape)))
+
+        # the histograms of all the faces are kept by OpenCV, as 32-bit floats
+        histograms_size = (len(faces) * 2 ** recognizer.getNeighbors() * recognizer.getGridX() *
+                           recognizer.getGridY() * 4 / 2 ** 20)
+        if histograms_size > memory_limit:
+            print("Warning: the LBPH histograms take about {:.0f} MB, beyond the memory limit of {} MB "
+                  "(which only bounds the decoded faces)".format(histograms_size, memory_limit))
+
+        for i, (chunk, chunk_labels) in enumerate(faces.chunks(chunk_size)):
+            with profiling.stage('streaming/lbph'):
+                if i == 0:
+                    recognizer.train(chunk, chunk_labels)
+                else:
+                    recognizer.update(chunk, chunk_labels)
+
+    elif type(recognizer) is cv.face_EigenFaceRecognizer:
+        requested = recognizer.getNumComponents()
+        n_components = requested if 0 < requested <= len(faces) else len(faces)
+
+        pca, chunk_size = fit_pca(faces, n_components, memory_limit)
+
+        with profiling.stage('streaming/project'):
+            projections = np.vstack([pca.project(x) for x in faces.data(chunk_size)])
+
+        read_model(recognizer, 'opencv_eigenfaces', len(pca.components), pca.mean,
+                   pca.eigenvalues().reshape(-1, 1), pca.components.T, projections, labels)
+
+    elif type(recognizer) is cv.face_FisherFaceRecognizer:
+        requested = recognizer.getNumComponents()
+        n_components = requested if 0 < requested <= n_classes - 1 else n_classes - 1
+
+        # as cv.face.FisherFaceRecognizer: PCA to N - C dimensions, then LDA
+        pca, chunk_size = fit_pca(faces, len(faces) - n_classes, memory_limit)
+
+        with profiling.stage('streaming/project'):
+            pca_projections = np.vstack([pca.project(x) for x in faces.data(chunk_size)])
+
+        with profiling.stage('streaming/lda'):
+            eigenvalues, lda_vectors = lda(pca_projections, labels, n_components)
+
+        read_model(recognizer, 'opencv_fisherfaces', n_components, pca.mean, eigenvalues.reshape(1, -1),
+                   pca.components.T @ lda_vectors, pca_projections @ lda_vectors, labels)
+
+    else:
+        raise ValueError('Unsupported recognizer {}'.format(type(recognizer).__name__))
+
+    cache.invalidate_model(recognizer)
+
+    height = faces.shape[0]
+
+    if ret_labels:
+        return recognizer, height, set(labels.tolist())
+
+    return recognizer, height
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('source', help='The csv file of the training images, or a .npy stack of faces')
+    parser.add_argument('-r', '--recognizer', help='The recognizer to train', type=int, choices=range(3))
+    parser.add_argument('-c', '--components', help='The number of components (0: all)', type=int, default=None)
+    parser.add_argument('-m', '--memory', help='The memory limit (in MB); for LBPH, it bounds the decoded faces, '
+                        'not the histograms of the model', type=float, default=default_memory_limit)
+    parser.add_argument('-o', '--output', help='The directory where to save the model', default='../models')
+    parser.add_argument('-u', '--uid', help='The identifier of the saved model', type=int, default=0)
+    parser.add_argument('--stack', help='Just preprocess the csv file into this .npy stack of faces', default=None)
+    preprocessing.add_arguments(parser)
+    profiling.add_argument(parser, '../test/profile/streaming_trainer')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    import Recognizer
+
+    args = parse_args()
+
+    profiling.start(args.profile)
+    preprocessing.configure(args)
+
+    if args.stack is not None:
+        write_stack(args.source, args.stack)
+        print("Faces saved to {} (labels in {})".format(args.stack, labels_file(args.stack)))
+
+    elif args.recognizer is None:
+        print("Choose the recognizer to train with -r")
+
+    else:
+        if args.recognizer == 0:
+            model = cv.face.EigenFaceRecognizer_create(num_components=10 if args.components is None
+                                                       else args.components)
+
+        elif args.recognizer == 1:
+            model = cv.face.FisherFaceRecognizer_create(num_components=80 if args.components is None
+                                                        else args.components)
+
+        else:
+            model = cv.face.LBPHFaceRecognizer_create(radius=2, neighbors=16)
+
+        mod, hei = train_streaming(model, args.source, memory_limit=args.memory)
+
+        os.makedirs(args.output, exist_ok=True)
+        Recognizer.save_model(mod, args.output, hei, args.uid)
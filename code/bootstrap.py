@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module provides bootstrap confidence intervals for the FAR, the FRR, the EER and the DIR at rank 1,
+computed from the cached rank-1 scores of every probe of a k-fold evaluation.
+
+Each resample draws the probes (or the subjects, with all their probes) with replacement. It is represented
+by how many times each probe was drawn, so that a whole chunk of resamples is a matrix of weights and all of
+them are evaluated at once through cumulative sums over the probes sorted by score.
+Chunks of resamples run in parallel processes.
+
+Authors:
+    Pg96, dsforza96
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import cv2.cv2 as cv
+import glob
+import numpy as np
+import os
+from os import path
+
+import profiling
+
+statistics_names = ['FAR', 'FRR', 'EER', 'DIR1']
+
+
+def probe_scores(distance_matrix, gallery_labels):
+    """
+    :param distance_matrix: distance matrix, as returned by Recognition_Tests.compute_distance_matrix().
+    :param gallery_labels: labels of the subjects the recognizer was trained with.
+    :return: dictionary with, for each probe, its subject, whether it is a genuine one, its rank-1 distance
+    and whether the rank-1 subject is the right one.
+    """
+    probes = list(distance_matrix.items())
+
+    return dict([("subjects", np.array([label for (_, label), _ in probes], dtype=np.int64)),
+                 ("genuine", np.array([label in gallery_labels for (_, label), _ in probes], dtype=bool)),
+                 ("distances", np.array([results[0][1] for _, results in probes], dtype=np.float64)),
+                 ("correct", np.array([results[0][0] == label for (_, label), results in probes], dtype=bool))])
+
+
+def fold_scores(recognizer, files, use_eyes=False):
+    """
+    Evaluates a recognizer on the k-fold files and pools the scores of the probes of all the folds.
+
+    :param recognizer: model to be used.
+    :param files: iterable containing couples of training and testing files.
+    :param use_eyes: flag to specify whether to employ the eyes recognition routine.
+    :return: the pooled scores, as returned by probe_scores(), with the fold of each probe.
+    """
+    # imported here, as it is needed just to compute the scores
+    import Recognition_Tests
+
+    folds = [probe_scores(*Recognition_Tests.compute_fold(recognizer, train_f, test_f, use_eyes=use_eyes))
+             for train_f, test_f in files]
+
+    scores = dict((key, np.concatenate([fold[key] for fold in folds])) for key in folds[0])
+    scores["folds"] = np.concatenate([np.full(len(fold["subjects"]), i) for i, fold in enumerate(folds)])
+
+    return scores
+
+
+def save_scores(file_name, scores):
+    np.savez(file_name, **scores)
+
+
+def load_scores(file_name):
+    with np.load(file_name) as data:
+        return dict((key, data[key]) for key in data.files)
+
+
+def resample_weights(scores, n, rng, unit='probes'):
+    """
+    Draws bootstrap resamples.
+
+    :param scores: probe scores.
+    :param n: number of resamples.
+    :param rng: numpy random Generator.
+    :param unit: 'probes' to resample the probes, 'subjects' to resample the subjects (with all their probes).
+    :return: n x probes matrix with the number of times each probe is in each resample.
+    """
+    if unit == 'probes':
+        groups = np.arange(len(scores["subjects"]))
+        n_groups = len(groups)
+    else:
+        _, groups = np.unique(scores["subjects"], return_inverse=True)
+        n_groups = groups.max() + 1
+
+    draws = rng.integers(0, n_groups, size=(n, n_groups))
+    counts = np.bincount((draws + np.arange(n).reshape(-1, 1) * n_groups).ravel(), minlength=n * n_groups)
+
+    return counts.reshape(n, n_groups)[:, groups].astype(np.int32)
+
+
+def _reorder(scores, order):
+    return dict((key, value[order]) for key, value in scores.items())
+
+
+def weighted_statistics(scores, weights, threshold):
+    """
+    Computes the statistics of some (weighted) resamples of the probes.
+
+    :param scores: probe scores.
+    :param weights: resamples x probes matrix of weights, as returned by resample_weights().
+    :param threshold: threshold where to compute the FAR and the FRR.
+    :return: dictionary with an array of values for each statistic (NaN where it is not defined, e.g. the FAR
+    of a resample without impostors).
+    """
+    order = np.argsort(scores["distances"], kind='stable')
+    if np.any(order != np.arange(len(order))):
+        scores = _reorder(scores, order)
+        weights = weights[:, order]
+
+    distances = scores["distances"]
+    genuine = scores["genuine"]
+    correct = genuine & scores["correct"]
+    accepted = np.flatnonzero(correct & np.isfinite(distances))
+    impostor = np.flatnonzero(~genuine)
+
+    # the last probe of each distinct score, and how many accepted genuine and impostor probes are up to it
+    last = np.flatnonzero(np.append(distances[1:] != distances[:-1], True) & np.isfinite(distances))
+    accepted_upto = np.searchsorted(accepted, last, side='right')
+    impostor_upto = np.searchsorted(impostor, last, side='right')
+
+    rows = np.arange(len(weights))
+    n_scores = len(last)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n_genuine = weights[:, genuine].sum(axis=1, dtype=np.int64)
+
+        # accepted genuine and impostor attempts at each score, as the threshold (the first column is for none)
+        accepted_genuine = np.zeros((len(weights), len(accepted) + 1), dtype=weights.dtype)
+        np.cumsum(weights[:, accepted], axis=1, out=accepted_genuine[:, 1:])
+        accepted_impostor = np.zeros((len(weights), len(impostor) + 1), dtype=weights.dtype)
+        np.cumsum(weights[:, impostor], axis=1, out=accepted_impostor[:, 1:])
+        n_impostor = accepted_impostor[:, -1]
+
+        def far_frr(j):
+            # rates of each resample at its j-th distinct score
+            j = np.minimum(j, n_scores - 1)
+            return (accepted_impostor[rows, impostor_upto[j]] / n_impostor,
+                    1 - accepted_genuine[rows, accepted_upto[j]] / n_genuine)
+
+        # FAR - FRR is non decreasing: the EER is at its first non negative value (found by bisection on every
+        # resample at once), interpolated with the previous one
+        low = np.zeros(len(weights), dtype=np.int64)
+        high = np.full(len(weights), n_scores, dtype=np.int64)
+        while np.any(low < high):
+            mid = (low + high) // 2
+            far, frr = far_frr(mid)
+            above = far - frr >= 0
+            searching = low < high
+            high = np.where(searching & above, mid, high)
+            low = np.where(searching & ~above, mid + 1, low)
+
+        first = low
+        far1, frr1 = far_frr(first)
+        far0, frr0 = far_frr(np.maximum(first - 1, 0))
+        d0, d1 = far0 - frr0, far1 - frr1
+        crossed = (first < n_scores) & ((first > 0) | (d1 == 0))
+
+        t = np.where(d1 == 0, 1, d0 / (d0 - d1))
+        eer = far0 + t * (far1 - far0)
+
+        n = np.searchsorted(distances, threshold, side='right')
+        far = accepted_impostor[:, np.searchsorted(impostor, n)] / n_impostor
+        frr = 1 - accepted_genuine[:, np.searchsorted(accepted, n)] / n_genuine
+
+        dir1 = weights[:, correct].sum(axis=1, dtype=np.int64) / n_genuine
+
+    far[n_impostor == 0] = np.nan
+    frr[n_genuine == 0] = np.nan
+    eer[~crossed | (n_impostor == 0) | (n_genuine == 0)] = np.nan
+
+    return dict([("FAR", far), ("FRR", frr), ("EER", eer), ("DIR1", dir1)])
+
+
+def _run_chunk(chunk):
+    """
+    :return: the statistics of a chunk of resamples, for the scores and for the other ones.
+    """
+    scores, others, size, seed_seq, unit, threshold = chunk
+    weights = resample_weights(scores, size, np.random.default_rng(seed_seq), unit)
+
+    return (weighted_statistics(scores, weights, threshold),
+            [weighted_statistics(other, weights, threshold) for other in others])
+
+
+def eer_threshold(scores):
+    """
+    :return: the threshold where the EER of the (whole) scores is reached, None if the curves do not cross.
+    """
+    import utils
+    import Recognition_Tests
+
+    genuine = np.where(scores["correct"][scores["genuine"]], scores["distances"][scores["genuine"]], np.inf)
+    rates = Recognition_Tests.exact_rates(genuine, scores["distances"][~scores["genuine"]])
+    err_t, _ = utils.equal_error_rate(rates["thresholds"], rates["FAR"], rates["FRR"])
+
+    return float(err_t[0]) if len(err_t) != 0 else None
+
+
+def bootstrap(scores, n_resamples=10000, unit='probes', threshold=None, alpha=0.05, chunk_size=256, workers=None,
+              seed=0, others=()):
+    """
+    Computes bootstrap confidence intervals (percentile method).
+
+    :param scores: probe scores, as returned by fold_scores() or load_scores().
+    :param n_resamples: number of resamples.
+    :param unit: 'probes' or 'subjects', the unit to resample.
+    :param threshold: threshold where to compute the FAR and the FRR, None to use the EER one.
+    :param alpha: the intervals have 1 - alpha confidence.
+    :param chunk_size: number of resamples evaluated at once.
+    :param workers: number of processes evaluating the chunks, None to use all the CPUs.
+    :param seed: seed of the random generator (given the seed and the chunk size, the results are reproducible).
+    :param others: scores of other models on the same probes; each of them gets the intervals of the differences
+    of its statistics from the ones of scores, computed on the same resamples (paired bootstrap).
+    :return: dictionary "statistic: (point estimate, lower bound, upper bound)", and a list of such dictionaries
+    for the differences with the other models.
+    """
+    if threshold is None:
+        threshold = eer_threshold(scores)
+        if threshold is None:
+            threshold = float(np.median(scores["distances"][np.isfinite(scores["distances"])]))
+
+    for other in others:
+        if not np.array_equal(other["subjects"], scores["subjects"]):
+            raise ValueError('The scores to compare do not belong to the same probes')
+
+    # sorted once, so that the resamples are drawn directly in the order of the distances
+    # (the other scores keep the same order of the probes, to be paired with them)
+    order = np.argsort(scores["distances"], kind='stable')
+    scores = _reorder(scores, order)
+    others = [_reorder(other, order) for other in others]
+
+    sizes = [min(chunk_size, n_resamples - start) for start in range(0, n_resamples, chunk_size)]
+    chunks = [(scores, others, size, seed_seq, unit, threshold)
+              for size, seed_seq in zip(sizes, np.random.SeedSequence(seed).spawn(len(sizes)))]
+    workers = workers or os.cpu_count()
+
+    with profiling.stage('bootstrap/resample'):
+        if workers == 1 or len(chunks) == 1:
+            results = [_run_chunk(chunk) for chunk in chunks]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(_run_chunk, chunks))
+
+    ones = np.ones((1, len(scores["subjects"])), dtype=np.int32)
+    point = weighted_statistics(scores, ones, threshold)
+    lower, upper = 100 * alpha / 2, 100 * (1 - alpha / 2)
+
+    def intervals(estimates, samples):
+        return dict((name, (float(estimates[name][0]),
+                            float(np.nanpercentile(samples[name], lower)),
+                            float(np.nanpercentile(samples[name], upper))))
+                    for name in statistics_names)
+
+    base = dict((name, np.concatenate([res[0][name] for res in results])) for name in statistics_names)
+    cis = intervals(point, base)
+    cis["threshold"] = threshold
+
+    differences = list()
+    for i, other in enumerate(others):
+        other_point = weighted_statistics(other, ones, threshold)
+        other_samples = dict((name, np.concatenate([res[1][i][name] for res in results])) for name in statistics_names)
+
+        differences.append(intervals(dict((name, other_point[name] - point[name]) for name in statistics_names),
+                                     dict((name, other_samples[name] - base[name]) for name in statistics_names)))
+
+    return cis, differences
+
+
+def print_intervals(cis, alpha, title):
+    print('{} ({:.0%} confidence intervals):'.format(title, 1 - alpha))
+
+    for name in statistics_names:
+        estimate, low, high = cis[name]
+        print('\t{:<5} {:8.4f}  [{:8.4f}, {:8.4f}]'.format(name, estimate, low, high))
+
+
+def k_fold_files(folds_dir):
+    """
+    :return: the couples of training and testing files of a k-fold directory, as saved by Recognition_Tests.
+    """
+    trains = sorted(glob.glob(path.join(folds_dir, '*_train.csv')),
+                    key=lambda x: int(path.basename(x).split('_')[0]))
+
+    return [(train_f, train_f[:-len('_train.csv')] + '_test.csv') for train_f in trains]
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('scores', nargs='+', help='The .npz files of the cached probe scores; from the second on, '
+                                                  'the differences from the first one are reported')
+    parser.add_argument('-f', '--folds', help='The directory of the k-fold csv files, to compute the scores '
+                                              'that are not cached yet', default='../test/k_fold/complete/csv')
+    parser.add_argument('-r', '--recognizer', help='The recognizer to compute the missing scores with', type=int,
+                        choices=range(3), default=None)
+    parser.add_argument('-e', '--eyes', help='Compute the missing scores with the eyes recognition routine',
+                        action='store_true')
+    parser.add_argument('-n', '--resamples', help='The number of resamples', type=int, default=10000)
+    parser.add_argument('-u', '--unit', help='What to resample', choices=['probes', 'subjects'], default='probes')
+    parser.add_argument('-t', '--threshold', help='The threshold of the FAR and FRR (default: the EER one)',
+                        type=float, default=None)
+    parser.add_argument('-a', '--alpha', help='The intervals have 1 - alpha confidence', type=float, default=0.05)
+    parser.add_argument('-w', '--workers', help='The number of processes', type=int, default=None)
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    profiling.add_argument(parser, '../test/profile/bootstrap')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    profiling.start(args.profile)
+
+    all_scores = list()
+    for scores_file in args.scores:
+        if not path.exists(scores_file):
+            if args.recognizer == 0:
+                model: cv.face_BasicFaceRecognizer = cv.face.EigenFaceRecognizer_create(num_components=10)
+
+            elif args.recognizer == 1:
+                model: cv.face_BasicFaceRecognizer = cv.face.FisherFaceRecognizer_create(num_components=80)
+
+            elif args.recognizer == 2:
+                model: cv.face_BasicFaceRecognizer = cv.face.LBPHFaceRecognizer_create(radius=2, neighbors=16)
+
+            else:
+                raise SystemExit('{} does not exist: choose a recognizer (-r) to compute it'.format(scores_file))
+
+            save_scores(scores_file, fold_scores(model, k_fold_files(args.folds), use_eyes=args.eyes))
+            print('Scores saved to', scores_file)
+
+        all_scores.append(load_scores(scores_file))
+
+    intervals, diffs = bootstrap(all_scores[0], n_resamples=args.resamples, unit=args.unit, threshold=args.threshold,
+                                 alpha=args.alpha, workers=args.workers, seed=args.seed, others=all_scores[1:])
+
+    print('{} resamples of the {}, FAR and FRR at threshold {}\n'.format(args.resamples, args.unit,
+                                                                        intervals["threshold"]))
+    print_intervals(intervals, args.alpha, args.scores[0])
+
+    for scores_file, diff in zip(args.scores[1:], diffs):
+        print()
+        print_intervals(diff, args.alpha, '{} - {}'.format(scores_file, args.scores[0]))
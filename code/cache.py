@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module provides a cache of recent identification results, keyed by a perceptual hash of the probe faces,
+so that the same or nearly identical frames (burst shots, resent uploads) are not matched over and over.
+
+Hashes within a Hamming radius are found through a BK-tree. The cache is bounded (least recently used entries
+are evicted first) and it is emptied when the version of what produced the results (model or gallery, cohort,
+preprocessing) changes.
+
+Usage:
+    result_cache = cache.ResultCache(max_entries=1024, radius=4)
+    Recognizer.predict(model, height, probe_image, result_cache=result_cache)
+    print(result_cache.stats())
+
+Authors:
+    Pg96, dsforza96
+"""
+
+from collections import OrderedDict
+import cv2.cv2 as cv
+import hashlib
+import numpy as np
+import threading
+import uuid
+
+import profiling
+
+
+def perceptual_hash(face, hash_size=8):
+    """
+    Computes the DCT perceptual hash of a face: the signs of its lowest frequencies with respect to their median.
+
+    :param face: grayscale image.
+    :param hash_size: side of the block of frequencies used (the hash has hash_size^2 bits).
+    :return: the hash, as an integer.
+    """
+    small = cv.resize(face, (hash_size * 4, hash_size * 4), interpolation=cv.INTER_AREA).astype(np.float32)
+    low = cv.dct(small)[:hash_size, :hash_size].ravel()
+
+    # the DC term is left out of the median, as it just reflects the mean brightness
+    bits = low > np.median(low[1:])
+
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def hamming(a, b):
+    """
+    :return: the number of different bits of two hashes.
+    """
+    return bin(a ^ b).count('1')
+
+
+def new_version():
+    """
+    :return: a unique version token, for objects (e.g. galleries) which do not change after being built.
+    """
+    return uuid.uuid4().hex
+
+
+_model_versions = dict()  # id of an OpenCV face recognizer -> (recognizer, version)
+_models_lock = threading.Lock()
+
+
+def model_version(recognizer):
+    """
+    OpenCV face recognizers cannot carry a version attribute and hashing their whole model would cost more than
+    matching a probe, so they get a version token the first time they are seen (they are kept alive, so that their
+    id is not reused), which stays the same until invalidate_model() is called.
+
+    :return: the version of an OpenCV face recognizer.
+    """
+    with _models_lock:
+        known = _model_versions.get(id(recognizer))
+
+        if known is None:
+            known = (recognizer, new_version())
+            _model_versions[id(recognizer)] = known
+
+        return known[1]
+
+
+def invalidate_model(recognizer):
+    """
+    Gives an OpenCV face recognizer a new version, as it has been retrained or loaded in place
+    (Recognizer.train_recongizer(), Recognizer.load_model() and the trainers of Streaming_Trainer and
+    Randomized_Trainer do it; it has to be called after training a recognizer directly).
+    """
+    with _models_lock:
+        _model_versions.pop(id(recognizer), None)
+
+
+def fingerprint(*parts):
+    """
+    Computes a version of what identification results depend on.
+
+    :param parts: objects with a version attribute (e.g. Gallery.Gallery, Gallery.Cohort), OpenCV face recognizers
+                  (see model_version()), arrays or other values (hashed through their repr).
+    :return: the version, as a string.
+    """
+    sha = hashlib.sha1()
+
+    for part in parts:
+        if hasattr(part, 'version'):
+            sha.update(str(part.version).encode())
+        elif isinstance(part, cv.face_FaceRecognizer):
+            sha.update(model_version(part).encode())
+        elif isinstance(part, np.ndarray):
+            sha.update(np.ascontiguousarray(part).tobytes())
+        else:
+            sha.update(repr(part).encode())
+
+        sha.update(b'|')
+
+    return sha.hexdigest()
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree of hashes under the Hamming distance, with lazy removal.
+    """
+
+    def __init__(self):
+        self._root = None  # [hash, key, {distance: child}]
+        self._removed = set()
+        self._size = 0
+
+    def __len__(self):
+        return self._size - len(self._removed)
+
+    def add(self, hash_value, key):
+        """
+        Adds a hash, identified by a (unique) key.
+        """
+        self._size += 1
+        node = [hash_value, key, dict()]
+
+        if self._root is None:
+            self._root = node
+            return
+
+        current = self._root
+        while True:
+            d = hamming(hash_value, current[0])
+            child = current[2].get(d)
+
+            if child is None:
+                current[2][d] = node
+                return
+
+            current = child
+
+    def remove(self, key):
+        """
+        Removes a hash by its key; the tree is rebuilt when most of its nodes are removed ones.
+        """
+        self._removed.add(key)
+
+        if len(self._removed) > max(64, self._size // 2):
+            live = [(h, k) for h, k in self._nodes() if k not in self._removed]
+
+            self._root = None
+            self._removed = set()
+            self._size = 0
+
+            for h, k in live:
+                self.add(h, k)
+
+    def _nodes(self):
+        stack = [self._root] if self._root is not None else []
+
+        while len(stack) != 0:
+            node = stack.pop()
+            yield node[0], node[1]
+            stack.extend(node[2].values())
+
+    def search(self, hash_value, radius):
+        """
+        :return: (distance, key) couples of the hashes within the radius, sorted by distance.
+        """
+        found = []
+        stack = [self._root] if self._root is not None else []
+
+        while len(stack) != 0:
+            node = stack.pop()
+            d = hamming(hash_value, node[0])
+
+            if d <= radius and node[1] not in self._removed:
+                found.append((d, node[1]))
+
+            # by the triangle inequality, matches can only be in the children at distance d +- radius
+            stack.extend(child for distance, child in node[2].items() if d - radius <= distance <= d + radius)
+
+        return sorted(found, key=lambda x: x[0])
+
+
+class ResultCache:
+    """
+    Size-bounded LRU cache of identification results, with near-duplicate lookup.
+    """
+
+    def __init__(self, max_entries=1024, radius=4, hash_size=8):
+        """
+        :param max_entries: maximum number of cached results.
+        :param radius: maximum Hamming distance between the hashes of two faces considered the same probe.
+        :param hash_size: side of the block of frequencies of the perceptual hash.
+        """
+        self.max_entries = max_entries
+        self.radius = radius
+        self.hash_size = hash_size
+        self.version = None
+
+        self._entries = OrderedDict()  # key -> (hash, results)
+        self._tree = BKTree()
+        self._next_key = 0
+        self._lock = threading.Lock()
+        self._metrics = dict([("hits", 0), ("near_hits", 0), ("misses", 0), ("evictions", 0), ("invalidations", 0)])
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _validate(self, version):
+        # called with the lock held
+        if version != self.version:
+            if len(self._entries) != 0:
+                self._metrics["invalidations"] += 1
+                profiling.count('cache/invalidations')
+
+            self._entries.clear()
+            self._tree = BKTree()
+            self.version = version
+
+    def get(self, face, version):
+        """
+        Looks up the results of a face, or of a nearly identical one.
+
+        :param face: grayscale probe face, as it is matched.
+        :param version: version of what the results depend on (see fingerprint()); a new one empties the cache.
+        :return: the cached results and the hash of the face (None and the hash, if they are not cached).
+        """
+        hash_value = perceptual_hash(face, self.hash_size)
+
+        with self._lock:
+            self._validate(version)
+            found = self._tree.search(hash_value, self.radius)
+
+            if len(found) == 0:
+                self._metrics["misses"] += 1
+                profiling.count('cache/misses')
+                return None, hash_value
+
+            distance, key = found[0]
+            self._entries.move_to_end(key)
+
+            self._metrics["hits"] += 1
+            if distance != 0:
+                self._metrics["near_hits"] += 1
+            profiling.count('cache/hits')
+
+            return list(self._entries[key][1]), hash_value
+
+    def put(self, hash_value, results, version):
+        """
+        Caches the results of a face.
+
+        :param hash_value: hash of the face, as returned by get().
+        :param results: the results to cache.
+        :param version: version of what the results depend on.
+        """
+        with self._lock:
+            self._validate(version)
+
+            key = self._next_key
+            self._next_key += 1
+
+            self._entries[key] = (hash_value, results)
+            self._tree.add(hash_value, key)
+
+            while len(self._entries) > self.max_entries:
+                old_key, _ = self._entries.popitem(last=False)
+                self._tree.remove(old_key)
+                self._metrics["evictions"] += 1
+
+    def clear(self):
+        """
+        Empties the cache (e.g. after retraining a model in place).
+        """
+        with self._lock:
+            self.version = None
+            self._validate(new_version())
+
+    def stats(self):
+        """
+        :return: dictionary with the number of entries, hits (and near-duplicate ones), misses, evictions,
+        invalidations and the hit rate.
+        """
+        with self._lock:
+            lookups = self._metrics["hits"] + self._metrics["misses"]
+
+            ret = dict([("entries", len(self._entries))])
+            ret.update(self._metrics)
+            ret["hit_rate"] = self._metrics["hits"] / lookups if lookups else None
+
+            return ret
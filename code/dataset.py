@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module provides an incremental manifest of the dataset, from which the CSV file needed to train the
+recognizers is created.
+
+The subject directories (sN, where N is the label) are scanned in parallel; the size, modification time and hash
+of each image are recorded in a binary index, so that a rerun hashes again only the new or modified images
+and rewrites the CSV file only if something changed. Directories which are not subject ones are skipped.
+
+Authors:
+    Pg96, dsforza96
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import numpy as np
+import os
+from os import path
+import re
+
+import profiling
+
+csv_name = 'subjects.csv'
+index_suffix = '.index.npz'
+
+_subject_dir = re.compile(r's(\d+)')
+_leading_number = re.compile(r'(\d+)')
+
+
+def file_hash(file_name):
+    """
+    :return: the SHA-1 hex digest of the contents of a file.
+    """
+    sha = hashlib.sha1()
+
+    with open(file_name, 'rb') as fl:
+        for block in iter(lambda: fl.read(1 << 20), b''):
+            sha.update(block)
+
+    return sha.hexdigest()
+
+
+def subject_dirs(base_path):
+    """
+    :return: (label, path) of the subject directories of the dataset, sorted by label.
+    """
+    subjects = []
+
+    with os.scandir(base_path) as it:
+        for entry in it:
+            if not entry.is_dir():
+                continue
+
+            match = _subject_dir.fullmatch(entry.name)
+            if match is None:
+                print("Skipping {}: not a subject directory".format(entry.path))
+                continue
+
+            subjects.append((int(match.group(1)), entry.path))
+
+    return sorted(subjects)
+
+
+def scan_subject(label, subject_path, previous):
+    """
+    Lists the images of a subject, hashing just the ones which are new or changed since the previous scan.
+
+    :param label: label of the subject.
+    :param subject_path: directory of the subject.
+    :param previous: dictionary path -> (size, mtime_ns, hash) of the previous scan.
+    :return: (path, label, size, mtime_ns, hash) of each image and the number of hashed images.
+    """
+    entries = []
+    hashed = 0
+
+    with os.scandir(subject_path) as it:
+        for entry in it:
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+
+            file = "{}/{}".format(subject_path, entry.name)
+            st = entry.stat()
+            old = previous.get(file)
+
+            if old is not None and old[0] == st.st_size and old[1] == st.st_mtime_ns:
+                digest = old[2]
+            else:
+                with profiling.stage('dataset/hash'):
+                    digest = file_hash(entry.path)
+                hashed += 1
+
+            entries.append((file, label, st.st_size, st.st_mtime_ns, digest))
+
+    return entries, hashed
+
+
+def _sort_key(entry):
+    """
+    Sorts the images by label, then by the number their name starts with (e.g. 11 for 11_cropped_aligned.jpg).
+    """
+    name = path.basename(entry[0])
+    number = _leading_number.match(name)
+
+    return entry[1], int(number.group(1)) if number else float('inf'), name
+
+
+def load_index(index_file):
+    """
+    Loads a binary index.
+
+    :return: dictionary with the arrays of the paths, labels, sizes, modification times and hashes of the images
+    (empty if the index does not exist).
+    """
+    if not path.exists(index_file):
+        return dict([("paths", np.array([], dtype=str)), ("labels", np.array([], dtype=np.int32)),
+                     ("sizes", np.array([], dtype=np.int64)), ("mtimes", np.array([], dtype=np.int64)),
+                     ("hashes", np.array([], dtype='S40'))])
+
+    with np.load(index_file) as data:
+        return dict((key, data[key]) for key in data.files)
+
+
+def _save_index(index_file, entries):
+    # np.savez appends .npz to names without it
+    tmp_file = index_file[:-len('.npz')] + '.tmp.npz'
+
+    np.savez(tmp_file, paths=np.array([e[0] for e in entries], dtype=str),
+             labels=np.array([e[1] for e in entries], dtype=np.int32),
+             sizes=np.array([e[2] for e in entries], dtype=np.int64),
+             mtimes=np.array([e[3] for e in entries], dtype=np.int64),
+             hashes=np.array([e[4] for e in entries], dtype='S40'))
+
+    os.replace(tmp_file, index_file)
+
+
+def build_manifest(base_path, output_dir, name=csv_name, workers=None):
+    """
+    Updates the manifest of the dataset: the CSV file (path;label lines) and its binary index.
+
+    :param base_path: directory where all the training images are stored, one sN directory per subject.
+    :param output_dir: directory where to save the CSV file and the index.
+    :param name: name of the CSV file; the index is saved as <name>.index.npz.
+    :param workers: number of subjects scanned in parallel (default: chosen by ThreadPoolExecutor).
+    :return: dictionary with the number of images and of the added, modified and removed ones.
+    """
+    csv_file = path.join(output_dir, name)
+    index_file = csv_file + index_suffix
+
+    index = load_index(index_file)
+    previous = dict(zip(index["paths"].tolist(), zip(index["sizes"].tolist(), index["mtimes"].tolist(),
+                                                     index["hashes"].astype(str).tolist())))
+
+    with profiling.stage('dataset/scan'):
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            scans = list(executor.map(lambda subject: scan_subject(*subject, previous), subject_dirs(base_path)))
+
+    entries = sorted([entry for subject_entries, _ in scans for entry in subject_entries], key=_sort_key)
+    current = set(entry[0] for entry in entries)
+
+    added = sum(entry[0] not in previous for entry in entries)
+    modified = sum(entry[0] in previous and previous[entry[0]][2] != entry[4] for entry in entries)
+    removed = sum(file not in current for file in previous)
+
+    # the lines change only if images are added or removed, the index also if they are modified (or touched)
+    csv_changed = added != 0 or removed != 0 or not path.exists(csv_file)
+    index_changed = csv_changed or any(previous[entry[0]] != entry[2:] for entry in entries)
+
+    if csv_changed:
+        lines = ["{};{}".format(entry[0], entry[1]) for entry in entries]
+
+        tmp_file = csv_file + '.tmp'
+        with open(tmp_file, "w+") as fl:
+            fl.write(str.join("\n", lines))
+            fl.write("\n")
+        os.replace(tmp_file, csv_file)
+
+    if index_changed:
+        _save_index(index_file, entries)
+
+    return dict([("images", len(entries)), ("added", added), ("modified", modified), ("removed", removed),
+                 ("hashed", sum(hashed for _, hashed in scans)), ("written", index_changed)])
+
+
+def parse_args():
+    parser = ArgumentParser()
+    parser.add_argument('base_path', help='The directory of the dataset images', nargs='?',
+                        default='../images/dataset/cropped')
+    parser.add_argument('-o', '--output', help='The directory where to save the CSV file and its index',
+                        default='../dataset_info/')
+    parser.add_argument('-n', '--name', help='The name of the CSV file', default=csv_name)
+    parser.add_argument('-w', '--workers', help='The number of subjects scanned in parallel', type=int, default=None)
+    profiling.add_argument(parser, '../test/profile/dataset')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    profiling.start(args.profile)
+
+    stats = build_manifest(args.base_path, args.output, args.name, args.workers)
+
+    print("{} images: {} added, {} modified, {} removed ({} hashed); {}".format(
+        stats["images"], stats["added"], stats["modified"], stats["removed"], stats["hashed"],
+        "manifest updated" if stats["written"] else "nothing changed"))
@@ -1,5 +1,4 @@
 import numpy as np
-import matplotlib.pyplot as plt
 """
 Sukhbinder
 5 April 2017
@@ -29,28 +28,47 @@ SOFTWARE.
 Based on:
 """
 
-def _rect_inter_inner(x1,x2):
-    n1=x1.shape[0]-1
-    n2=x2.shape[0]-1
-    X1=np.c_[x1[:-1],x1[1:]]
-    X2=np.c_[x2[:-1],x2[1:]]
-    S1=np.tile(X1.min(axis=1),(n2,1)).T
-    S2=np.tile(X2.max(axis=1),(n1,1))
-    S3=np.tile(X1.max(axis=1),(n2,1)).T
-    S4=np.tile(X2.min(axis=1),(n1,1))
-    return S1,S2,S3,S4
+# maximum number of segment pairs compared at once (bounds the memory of the candidate search)
+chunk_pairs=1<<22
 
-def _rectangle_intersection_(x1,y1,x2,y2):
-    S1,S2,S3,S4=_rect_inter_inner(x1,x2)
-    S5,S6,S7,S8=_rect_inter_inner(y1,y2)
-
-    C1=np.less_equal(S1,S2)
-    C2=np.greater_equal(S3,S4)
-    C3=np.less_equal(S5,S6)
-    C4=np.greater_equal(S7,S8)
+def _segment_bounds(x):
+    X=np.c_[x[:-1],x[1:]]
+    return X.min(axis=1),X.max(axis=1)
 
-    ii,jj=np.nonzero(C1 & C2 & C3 & C4)
-    return ii,jj
+def _rectangle_intersection_(x1,y1,x2,y2):
+    # segments whose bounding boxes overlap, searched in chunks of segments of the first curve
+    x1min,x1max=_segment_bounds(x1)
+    y1min,y1max=_segment_bounds(y1)
+    x2min,x2max=_segment_bounds(x2)
+    y2min,y2max=_segment_bounds(y2)
+
+    step=max(1,chunk_pairs//max(1,len(x2min)))
+    ii=[]
+    jj=[]
+    for start in range(0,len(x1min),step):
+        s=slice(start,start+step)
+        C=(np.less_equal(x1min[s,None],x2max[None,:]) & np.greater_equal(x1max[s,None],x2min[None,:]) &
+           np.less_equal(y1min[s,None],y2max[None,:]) & np.greater_equal(y1max[s,None],y2min[None,:]))
+        i,j=np.nonzero(C)
+        ii.append(i+start)
+        jj.append(j)
+
+    if len(ii)==0:
+        return np.zeros(0,dtype=np.intp),np.zeros(0,dtype=np.intp)
+    return np.concatenate(ii),np.concatenate(jj)
+
+def _solve(AA,BB):
+    # all the systems at once; the singular ones (NaN) are only found solving them one by one
+    try:
+        return np.linalg.solve(AA,BB[...,None])[...,0]
+    except np.linalg.LinAlgError:
+        T=np.empty(BB.shape)
+        for i in range(len(AA)):
+            try:
+                T[i]=np.linalg.solve(AA[i],BB[i])
+            except np.linalg.LinAlgError:
+                T[i]=np.nan
+        return T
 
 def intersection(x1,y1,x2,y2):
     """
@@ -83,24 +101,19 @@ x,y=intersection(x1,y1,x2,y2)
     dxy1=np.diff(np.c_[x1,y1],axis=0)
     dxy2=np.diff(np.c_[x2,y2],axis=0)
 
-    T=np.zeros((4,n))
-    AA=np.zeros((4,4,n))
-    AA[0:2,2,:]=-1
-    AA[2:4,3,:]=-1
-    AA[0::2,0,:]=dxy1[ii,:].T
-    AA[1::2,1,:]=dxy2[jj,:].T
+    AA=np.zeros((n,4,4))
+    AA[:,0:2,2]=-1
+    AA[:,2:4,3]=-1
+    AA[:,0::2,0]=dxy1[ii,:]
+    AA[:,1::2,1]=dxy2[jj,:]
 
-    BB=np.zeros((4,n))
-    BB[0,:]=-x1[ii].ravel()
-    BB[1,:]=-x2[jj].ravel()
-    BB[2,:]=-y1[ii].ravel()
-    BB[3,:]=-y2[jj].ravel()
+    BB=np.zeros((n,4))
+    BB[:,0]=-x1[ii].ravel()
+    BB[:,1]=-x2[jj].ravel()
+    BB[:,2]=-y1[ii].ravel()
+    BB[:,3]=-y2[jj].ravel()
 
-    for i in range(n):
-        try:
-            T[:,i]=np.linalg.solve(AA[:,:,i],BB[:,i])
-        except:
-            T[:,i]=np.NaN
+    T=_solve(AA,BB).T if n!=0 else np.zeros((4,0))
 
 
     in_range= (T[0,:] >=0) & (T[1,:] >=0) & (T[0,:] <=1) & (T[1,:] <=1)
@@ -111,6 +124,7 @@ x,y=intersection(x1,y1,x2,y2)
 
 
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
 
     # a piece of a prolate cycloid, and am going to find
     a, b = 1, 2
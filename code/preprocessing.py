@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module provides the preprocessing stage shared by training and probing: grayscale conversion, crop margins,
+resize and optional illumination normalization (histogram equalization or CLAHE).
+
+Batches of images are processed together: once resized to the same size, they are equalized in a single vectorized
+pass. The outputs of load() are memoized by (hash of the file contents, pipeline configuration, size), so training
+and probing get the very same (read-only) arrays for the same image.
+
+The default pipeline, used by utils.read_csv and by the predict functions, can be configured from the command line:
+    preprocessing.add_arguments(parser)
+    ...
+    preprocessing.configure(args)
+
+Authors:
+    Pg96, dsforza96
+"""
+
+from collections import OrderedDict
+import cv2.cv2 as cv
+import hashlib
+import numpy as np
+import threading
+
+import profiling
+
+equalizations = ['hist', 'clahe']
+
+# maximum number of memoized images
+memo_size = 4096
+
+_memo = OrderedDict()  # (file hash, config, size) -> image
+_memo_lock = threading.Lock()
+
+
+def equalize_hist(stack):
+    """
+    Equalizes the histograms of a stack of grayscale images at once, as cv.equalizeHist does for each of them.
+
+    :param stack: n x height x width uint8 array.
+    :return: the equalized stack.
+    """
+    n = len(stack)
+    pixels = stack.reshape(n, -1)
+    total = pixels.shape[1]
+
+    hist = np.bincount((pixels + (np.arange(n, dtype=np.int64) * 256).reshape(-1, 1)).ravel(),
+                       minlength=256 * n).reshape(n, 256)
+
+    # the first non-empty bin of each image is mapped to 0, the others are scaled to [0, 255]
+    first = (hist != 0).argmax(axis=1)
+    first_count = hist[np.arange(n), first]
+    cumulative = hist.cumsum(axis=1) - first_count.reshape(-1, 1)
+
+    scale = np.float32(255) / np.maximum(total - first_count, 1).astype(np.float32)
+    luts = np.clip(np.rint(cumulative.astype(np.float32) * scale.reshape(-1, 1)), 0, 255).astype(np.uint8)
+    luts[np.arange(256).reshape(1, -1) <= first.reshape(-1, 1)] = 0
+
+    # images with a single gray level are left as they are
+    flat = first_count == total
+    luts[flat] = np.arange(256, dtype=np.uint8)
+
+    return np.take_along_axis(luts, pixels.astype(np.int64), axis=1).reshape(stack.shape)
+
+
+class Pipeline:
+    """
+    Grayscale, crop margins, resize and illumination normalization of face images.
+    """
+
+    def __init__(self, equalization=None, clip_limit=2.0, tile_grid=8, margin=0.0, interpolation=cv.INTER_AREA):
+        """
+        :param equalization: None, 'hist' (histogram equalization) or 'clahe'.
+        :param clip_limit: contrast limit of CLAHE.
+        :param tile_grid: number of CLAHE tiles per side.
+        :param margin: fraction of the width (height) to crop from the left and right (top and bottom) sides.
+        :param interpolation: interpolation used to resize the images.
+        """
+        if equalization is not None and equalization not in equalizations:
+            raise ValueError('Unknown equalization {}, choose one of {}'.format(equalization, equalizations))
+
+        if not 0 <= margin < 0.5:
+            raise ValueError('The margin must be in [0, 0.5)')
+
+        self.equalization = equalization
+        self.clip_limit = clip_limit
+        self.tile_grid = tile_grid
+        self.margin = margin
+        self.interpolation = interpolation
+
+        self.config = (equalization, clip_limit if equalization == 'clahe' else None,
+                       tile_grid if equalization == 'clahe' else None, margin, interpolation)
+
+        self._clahe = cv.createCLAHE(clip_limit, (tile_grid, tile_grid)) if equalization == 'clahe' else None
+
+    def _crop(self, img):
+        if self.margin == 0:
+            return img
+
+        dy = int(round(img.shape[0] * self.margin))
+        dx = int(round(img.shape[1] * self.margin))
+
+        return img[dy:img.shape[0] - dy, dx:img.shape[1] - dx]
+
+    def _equalize(self, stack):
+        """
+        :param stack: n x height x width uint8 array.
+        :return: the equalized stack.
+        """
+        if self.equalization == 'hist':
+            return equalize_hist(stack)
+
+        # CLAHE works on a tile grid of each image
+        return np.stack([self._clahe.apply(img) for img in stack])
+
+    def transform(self, images, size=None):
+        """
+        Preprocesses a batch of images.
+
+        :param images: grayscale or BGR images.
+        :param size: side of the (square) output images, None to keep their size.
+        :return: the preprocessed grayscale images.
+        """
+        with profiling.stage('preprocess/resize'):
+            gray = [cv.cvtColor(img, cv.COLOR_BGR2GRAY) if img.ndim == 3 else img for img in images]
+            gray = [self._crop(img) for img in gray]
+
+            if size is not None:
+                gray = [cv.resize(img, (size, size), interpolation=self.interpolation) for img in gray]
+
+        if self.equalization is None or len(gray) == 0:
+            return gray
+
+        with profiling.stage('preprocess/equalize'):
+            if len(set(img.shape for img in gray)) == 1:
+                return list(self._equalize(np.stack(gray)))
+
+            return [self._equalize(img[np.newaxis])[0] for img in gray]
+
+    def load(self, files, size=None, memoize=True):
+        """
+        Reads and preprocesses a batch of image files, reusing the memoized outputs.
+
+        :param files: paths of the images.
+        :param size: side of the (square) output images, None to keep their size.
+        :param memoize: if False, the outputs are neither looked up nor stored in the memo
+                        (e.g. when streaming more images than the memo can hold).
+        :return: the preprocessed grayscale images (read-only arrays, if memoized).
+        """
+        if not memoize:
+            with profiling.stage('preprocess/decode'):
+                decoded = [cv.imread(file, cv.IMREAD_GRAYSCALE) for file in files]
+
+            for file, img in zip(files, decoded):
+                if img is None:
+                    raise RuntimeError("File {} cannot be decoded!".format(file))
+
+            return self.transform(decoded, size)
+
+        keys = []
+        found = dict()  # key -> image, the outputs of this batch
+        missing = dict()  # key -> encoded image
+
+        for file in files:
+            with profiling.stage('preprocess/read'):
+                with open(file, 'rb') as fl:
+                    data = fl.read()
+
+            key = (hashlib.sha1(data).hexdigest(), self.config, size)
+            keys.append(key)
+
+            if key in found or key in missing:
+                continue
+
+            # the memo is just a cache: the hits are kept here, as other loads may evict them at any time
+            with _memo_lock:
+                img = _memo.get(key)
+                if img is not None:
+                    _memo.move_to_end(key)
+
+            if img is not None:
+                profiling.count('preprocess/memo_hits')
+                found[key] = img
+            else:
+                missing[key] = (file, data)
+
+        if len(missing) != 0:
+            with profiling.stage('preprocess/decode'):
+                decoded = [cv.imdecode(np.frombuffer(data, dtype=np.uint8), cv.IMREAD_GRAYSCALE)
+                           for _, data in missing.values()]
+
+            for (file, _), img in zip(missing.values(), decoded):
+                if img is None:
+                    raise RuntimeError("File {} cannot be decoded!".format(file))
+
+            for key, img in zip(missing.keys(), self.transform(decoded, size)):
+                img = np.ascontiguousarray(img)
+                img.flags.writeable = False
+                found[key] = img
+                _store(key, img)
+
+        return [found[key] for key in keys]
+
+
+def _store(key, img):
+    with _memo_lock:
+        _memo[key] = img
+
+        while len(_memo) > memo_size:
+            _memo.popitem(last=False)
+
+
+def clear():
+    """
+    Empties the memo of the preprocessed images.
+    """
+    with _memo_lock:
+        _memo.clear()
+
+
+default = Pipeline()
+
+
+def add_arguments(parser):
+    """
+    Adds the options of the default pipeline to an ArgumentParser.
+    """
+    parser.add_argument('--equalization', help='Normalize the illumination of the faces', default=None,
+                        choices=equalizations)
+    parser.add_argument('--clip-limit', help='The contrast limit of CLAHE', default=2.0, type=float)
+    parser.add_argument('--margin', help='The fraction of each side of the faces to crop', default=0.0, type=float)
+
+
+def configure(args):
+    """
+    Sets the default pipeline from the parsed options.
+    """
+    global default
+
+    default = Pipeline(equalization=args.equalization, clip_limit=args.clip_limit, margin=args.margin)
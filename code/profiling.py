@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module provides a lightweight instrumentation layer to measure how long each stage of the pipeline takes.
+
+Stages are recorded only after enable() is called; otherwise stage() returns a shared no-op context manager,
+so that instrumented code pays just a function call. Recorded data can be exported as JSON
+(latency histograms and counters per stage) and as a Chrome trace (chrome://tracing, Perfetto).
+
+Usage:
+    with profiling.stage('predict/match'):
+        ...
+    profiling.count('predict/probes')
+
+Authors:
+    Pg96, dsforza96
+"""
+
+import atexit
+import json
+import os
+from os import path
+import threading
+import time
+
+enabled = False
+
+# maximum number of events kept for the Chrome trace
+max_trace_events = 1000000
+
+_lock = threading.Lock()
+_start_ns = time.perf_counter_ns()
+_stages = dict()  # stage name -> _StageStats
+_counters = dict()  # counter name -> value
+_events = []  # (name, start ns, duration ns, thread id)
+
+
+class _StageStats:
+    """
+    Latency statistics of a stage, with a histogram of power-of-two buckets (in microseconds).
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = None
+        self.max_ns = 0
+        self.buckets = dict()  # bucket -> count; bucket b holds durations shorter than 2^b microseconds
+
+    def add(self, duration_ns):
+        self.count += 1
+        self.total_ns += duration_ns
+        self.min_ns = duration_ns if self.min_ns is None else min(self.min_ns, duration_ns)
+        self.max_ns = max(self.max_ns, duration_ns)
+
+        bucket = max(0, (duration_ns // 1000).bit_length())
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, p):
+        """
+        :return: an upper bound (in ms) of the p-th percentile, based on the histogram.
+        """
+        target = p / 100 * self.count
+        seen = 0
+
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= target:
+                return min(2 ** bucket / 1000, self.max_ns / 1e6)
+
+        return self.max_ns / 1e6
+
+    def to_dict(self):
+        return dict([("count", self.count),
+                     ("total_ms", self.total_ns / 1e6),
+                     ("mean_ms", self.total_ns / 1e6 / self.count),
+                     ("min_ms", self.min_ns / 1e6),
+                     ("max_ms", self.max_ns / 1e6),
+                     ("p50_ms", self.percentile(50)),
+                     ("p90_ms", self.percentile(90)),
+                     ("p99_ms", self.percentile(99)),
+                     ("histogram_us", dict(("<{}".format(2 ** b), self.buckets[b]) for b in sorted(self.buckets)))])
+
+
+class _NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _Stage:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter_ns()
+        record(self.name, self.start, end - self.start)
+        return False
+
+
+_null_stage = _NullStage()
+
+
+def stage(name):
+    """
+    :param name: name of the stage.
+    :return: a context manager timing the code it wraps as the given stage.
+    """
+    if not enabled:
+        return _null_stage
+
+    return _Stage(name)
+
+
+def record(name, start_ns, duration_ns):
+    """
+    Records an execution of a stage.
+
+    :param name: name of the stage.
+    :param start_ns: start time, as given by time.perf_counter_ns().
+    :param duration_ns: duration in nanoseconds.
+    """
+    with _lock:
+        if name not in _stages:
+            _stages[name] = _StageStats()
+        _stages[name].add(duration_ns)
+
+        if len(_events) < max_trace_events:
+            _events.append((name, start_ns, duration_ns, threading.get_ident()))
+
+
+def count(name, n=1):
+    """
+    Increments a counter (if profiling is enabled).
+    """
+    if not enabled:
+        return
+
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def enable():
+    global enabled
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+def reset():
+    """
+    Discards everything recorded so far.
+    """
+    global _start_ns
+
+    with _lock:
+        _stages.clear()
+        _counters.clear()
+        del _events[:]
+        _start_ns = time.perf_counter_ns()
+
+
+def summary():
+    """
+    :return: dictionary with the statistics of each stage and the counters.
+    """
+    with _lock:
+        return dict([("stages", dict((name, st.to_dict()) for name, st in sorted(_stages.items()))),
+                     ("counters", dict(sorted(_counters.items())))])
+
+
+def export_json(file_name):
+    """
+    Saves the statistics of each stage and the counters to a JSON file.
+    """
+    with open(file_name, "w+") as fl:
+        json.dump(summary(), fl, indent=2)
+
+
+def export_chrome_trace(file_name):
+    """
+    Saves the recorded stages as a Chrome trace file.
+    """
+    pid = os.getpid()
+
+    with _lock:
+        events = [dict([("name", name), ("cat", name.split("/")[0]), ("ph", "X"),
+                        ("ts", (start - _start_ns) / 1000), ("dur", duration / 1000),
+                        ("pid", pid), ("tid", tid)])
+                  for name, start, duration, tid in _events]
+        events += [dict([("name", name), ("ph", "C"), ("ts", (time.perf_counter_ns() - _start_ns) / 1000),
+                         ("pid", pid), ("args", dict([("value", value)]))])
+                   for name, value in _counters.items()]
+
+    with open(file_name, "w+") as fl:
+        json.dump(dict([("traceEvents", events), ("displayTimeUnit", "ms")]), fl)
+
+
+def export(prefix):
+    """
+    Saves the recorded data as <prefix>.json and <prefix>.trace.json.
+    """
+    if path.dirname(prefix):
+        os.makedirs(path.dirname(prefix), exist_ok=True)
+
+    export_json(prefix + ".json")
+    export_chrome_trace(prefix + ".trace.json")
+
+    print("Profiling data saved to {0}.json and {0}.trace.json".format(prefix))
+
+
+def add_argument(parser, default_prefix):
+    """
+    Adds the --profile option to a command line parser.
+
+    :param parser: ArgumentParser of an entry point.
+    :param default_prefix: where to save the profiling data if no path is given.
+    """
+    parser.add_argument('--profile', nargs='?', const=default_prefix, default=None, metavar='PREFIX',
+                        help='Record per-stage timings and save them to PREFIX.json and PREFIX.trace.json')
+
+
+def start(prefix):
+    """
+    Enables profiling and saves the recorded data at exit, if prefix is not None.
+    """
+    if prefix is None:
+        return
+
+    reset()
+    enable()
+    atexit.register(export, prefix)
@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+""" This module provides a non-interactive report of the performance evaluations, for unattended (headless) runs.
+
+Figures are rendered to PNG files on a background thread, without a GUI backend, so that the evaluation goes on
+while they are drawn; the EER of each model and its performance summary are saved to a JSON file.
+
+Usage:
+    report = reports.Report('../test/report')
+    utils.plot_error_rates(avgs, model_names, report=report, name='eigenfaces')
+    utils.plot_rocs(avgs, model_names, report=report, name='eigenfaces')
+    report.close()
+
+Authors:
+    Pg96, dsforza96
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+from os import path
+
+import utils
+
+report_file_name = 'report.json'
+
+
+def _summary(performances, threshold):
+    """
+    :return: the values print_avg_performances shows, as a dictionary.
+    """
+    return dict([("threshold", float(threshold)),
+                 ("FAR", float(performances[threshold]['AVG_FAR'])),
+                 ("FRR", float(performances[threshold]['AVG_FRR'])),
+                 ("GRR", float(performances[threshold]['AVG_GRR'])),
+                 ("DIR_rank_1", float(performances[threshold]['AVG_DIR'][1]))])
+
+
+def _render_error_rates(file_name, curves):
+    from matplotlib.figure import Figure
+
+    fig = Figure()
+    ax = fig.add_subplot(1, 1, 1)
+
+    for model_name, thresholds, fars, frrs, err_t, err in curves:
+        ax.plot(thresholds, fars, label=model_name + ': FAR')
+        ax.plot(thresholds, frrs, label=model_name + ': FRR')
+
+        if err_t is not None:
+            ax.scatter(err_t, err, color='gray')
+            ax.axvline(x=err_t, color='gray', linestyle='--')
+            ax.annotate('ERR', (err_t, err))
+
+    ax.set_xlabel('Tolerance Threshold')
+    ax.set_ylabel('Error Rate')
+    ax.grid()
+    ax.legend()
+
+    fig.savefig(file_name)
+
+
+def _render_rocs(file_name, curves):
+    from matplotlib.figure import Figure
+
+    fig = Figure()
+    ax = fig.add_subplot(1, 1, 1)
+    ax.set_title('Watchlist ROC')
+
+    for model_name, fars, dirs in curves:
+        ax.plot(fars, dirs, linewidth=2, label=model_name)
+
+    ax.set_xlabel('False Alarm Rate')
+    ax.set_ylabel('Detect and Identify Rate')
+    ax.grid()
+    ax.legend()
+
+    fig.savefig(file_name)
+
+
+class Report:
+    """
+    Collects the figures, the EERs and the summaries of an evaluation into a directory.
+    """
+
+    def __init__(self, out_dir):
+        """
+        :param out_dir: directory where to save the figures and the JSON report.
+        """
+        self.out_dir = out_dir
+        self.file_name = path.join(out_dir, report_file_name)
+        self.data = dict([("eer", []), ("exact_eer", []), ("summaries", []), ("figures", [])])
+
+        os.makedirs(out_dir, exist_ok=True)
+
+        # a single worker, as matplotlib is not meant to draw several figures concurrently
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending = []
+
+    def _render(self, fn, name, curves):
+        file_name = path.join(self.out_dir, name + '.png')
+
+        self._pending.append(self._executor.submit(fn, file_name, curves))
+        self.data["figures"].append(file_name)
+
+    def error_rates(self, performancies, model_names, name, normalize_threshols=False):
+        """
+        Saves the FAR/FRR curves of some models as <name>_error_rates.png and records their EERs.
+
+        :param performancies: average performances per threshold of each model.
+        :param model_names: names of the models.
+        :param name: name of the group of models.
+        :param normalize_threshols: flag to normalize the thresholds in [0, 1].
+        """
+        curves = []
+
+        for avg_per_threshold, model_name in zip(performancies, model_names):
+            thresholds, fars, frrs = utils.error_rate_curves(avg_per_threshold, normalize_threshols)
+            err_t, err = utils.equal_error_rate(thresholds, fars, frrs)
+
+            print('{}: ERR of {} reached at threshold {}'.format(model_name, err, err_t))
+
+            err_t = float(err_t[0]) if len(err) != 0 else None
+            err = float(err[0]) if len(err) != 0 else None
+            curves.append((model_name, thresholds, fars, frrs, err_t, err))
+
+            self.data["eer"].append(dict([("group", name), ("model", model_name), ("eer", err),
+                                          ("threshold", err_t)]))
+
+            # summary at the evaluated threshold closest to the EER one
+            keys = list(avg_per_threshold.keys())
+            closest = keys[int(abs(thresholds - err_t).argmin())] if err_t is not None else keys[0]
+            self.summary(avg_per_threshold, closest, model_name, name)
+
+        self._render(_render_error_rates, name + '_error_rates', curves)
+        self.save()
+
+    def rocs(self, performancies, model_names, name):
+        """
+        Saves the watchlist ROC curves of some models as <name>_roc.png.
+
+        :param performancies: average performances per threshold of each model.
+        :param model_names: names of the models.
+        :param name: name of the group of models.
+        """
+        curves = [(model_name,
+                   [performs['AVG_FAR'] for performs in avg_per_threshold.values()],
+                   [performs['AVG_DIR'][1] for performs in avg_per_threshold.values()])
+                  for avg_per_threshold, model_name in zip(performancies, model_names)]
+
+        self._render(_render_rocs, name + '_roc', curves)
+        self.save()
+
+    def exact(self, performances, model_name, name):
+        """
+        Records the exact EER of a model, as returned by Recognition_Tests.evaluate_exact_performances().
+        """
+        self.data["exact_eer"].append(dict([("group", name), ("model", model_name), ("eer", performances["EER"]),
+                                            ("threshold", performances["EER_threshold"]),
+                                            ("rank1", float(performances["CMC"][0]))]))
+        self.save()
+
+    def summary(self, performances, threshold, model_name=None, name=None):
+        """
+        Records the performances of a model at a threshold.
+        """
+        entry = dict([("group", name), ("model", model_name)])
+        entry.update(_summary(performances, threshold))
+
+        self.data["summaries"].append(entry)
+
+    def save(self):
+        """
+        Saves the JSON report (figures may still be being rendered).
+        """
+        tmp_file = self.file_name + '.tmp'
+
+        with open(tmp_file, 'w+') as fl:
+            json.dump(self.data, fl, indent=2)
+
+        os.replace(tmp_file, self.file_name)
+
+    def close(self):
+        """
+        Waits for the figures to be rendered and saves the JSON report.
+        """
+        for future in self._pending:
+            future.result()
+
+        self._executor.shutdown()
+        self.save()
+
+        print('Report saved to', self.out_dir)
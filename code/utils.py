@@ -10,12 +10,10 @@ Authors:
 
 import cv2.cv2 as cv
 import math
-import matplotlib.pyplot as plt
 import numpy as np
-import os
-from os import path
 
-from ext.intersection import intersection
+import preprocessing
+import profiling
 
 
 subject_to_name_file = '../dataset_info/subject-to-name.txt'
@@ -33,7 +31,9 @@ def show_image(im, matplot=True):
     :param matplot: flag to select the library to be used to display the image.
     """
     if matplot:
-        # show image using matplotlib
+        # show image using matplotlib (imported on first use, as it is slow to load)
+        import matplotlib.pyplot as plt
+
         plt.figure()
         plt.imshow(cv.cvtColor(im, cv.COLOR_BGR2RGB))
         plt.show()
@@ -53,6 +53,8 @@ def show_images(images):
     Shows a set of images in the same window.
     :param images: images to show.
     """
+    import matplotlib.pyplot as plt
+
     if len(images) < 4:
         size = (len(images), 1)
     else:
@@ -96,72 +98,33 @@ def resize_image(img, width=None, height=None, inter=cv.INTER_AREA):
 
 def create_csv(base_path, output_dir):
     """
-    Creates the CSV file needed to train the recognizers.
+    Creates the CSV file needed to train the recognizers (see dataset.build_manifest).
 
     :param base_path:
         directory where all the training images are stored.
     :param output_dir:
         directory where to save CSV files.
     """
-    separator = ";"
+    import dataset
 
     print("Creating CSV file...")
 
-    lines = []
-    # lines_aligned = []
-
-    for dir_name, dir_names, file_names in os.walk(base_path):
-        dir_names.sort(key=lambda l: int(l.replace('s', '')))
-        for subdir_name in dir_names:
-
-            label = int(subdir_name.replace('s', ''))
-
-            if subdir_name == "test":
-                continue
-
-            subject_path = path.join(dir_name, subdir_name)
-            for filename in os.listdir(subject_path):
-
-                if not path.isfile(path.join(subject_path, filename)):
-                    continue
-
-                abs_path = "%s/%s" % (subject_path, filename)
-                s = "%s%s%d" % (abs_path, separator, label)
-                # if "aligned" in s:
-                #     # lines_aligned.append(s)
-                #     pass
-                # else:
-                #     lines.append(s)
-                lines.append(s)
-            # label = label + 1
-
-    # lines_aligned.sort(key=lambda l: (int(l.split("/")[-2].replace('s', '')), int(l.split("/")[-1].split("_")[0])))
-    lines.sort(key=lambda l: (int(l.split("/")[-2].replace('s', '')), int(l.split("/")[-1].split(".")[0])))
-
-    fname = "subjects.csv"
-    # fname_al = "subjects_aligned.csv"
-
-    # print(base_path)
-
-    with open(path.join(output_dir, fname), "w+") as fl:
-        fl.write(str.join("\n", lines))
-        fl.write("\n")
-    # with open(path.join(output_dir, fname_al), "w+") as fl:
-    #     fl.write(str.join("\n", lines_aligned))
-    #     fl.write("\n")
+    dataset.build_manifest(base_path, output_dir)
 
 
-def read_csv(filename, resize=False, mapping=False):
+def read_csv(filename, resize=False, mapping=False, pipeline=None):
     """
     Parses a csv file containing the path to the images to be used for the recognition operations.
     :param filename: location of the csv file.
     :param resize: flag to specify whether images
     :param mapping: flag to switch the output type.
+    :param pipeline: preprocessing.Pipeline to load the images with (default: preprocessing.default).
     :return: if mapping = False: a list of loaded images alongside a list of their respective labels.
     If mapping = True: a list with just the files' names and a label -> filename mapping is returned.
     """
     labels = []
     faces = []
+    im_files = []
 
     with open(filename, "r+") as file:
         if mapping:
@@ -193,12 +156,7 @@ def read_csv(filename, resize=False, mapping=False):
                 files.append(im_file)
 
             else:
-                photo = cv.imread(im_file, 0)
-
-                if resize:
-                    photo = resize_image(photo, 100, 100)
-
-                faces.append(photo)
+                im_files.append(im_file)
                 labels.append(label)
 
     # print(dic)
@@ -206,6 +164,9 @@ def read_csv(filename, resize=False, mapping=False):
     if mapping:
         return label_to_file, files
 
+    with profiling.stage('read_csv/preprocess'):
+        faces = (pipeline or preprocessing.default).load(im_files, 100 if resize else None)
+
     return faces, labels
 
 
@@ -259,7 +220,10 @@ def parse_identification_results(result):
     return sorted(list(dict(sorted(result, key=lambda x: int(x[1]), reverse=True)).items()), key=lambda x: int(x[1]))
 
 
-def print_avg_performances(performances, threshold):
+def print_avg_performances(performances, threshold, report=None, model_name=None):
+    if report is not None:
+        report.summary(performances, threshold, model_name)
+
     print('SUMMARY at threshold {}:'.format(threshold))
     print('\tFAR:', performances[threshold]['AVG_FAR'])
     print('\tFRR:', performances[threshold]['AVG_FRR'])
@@ -267,26 +231,79 @@ def print_avg_performances(performances, threshold):
     print('\tDIR at rank 1:', performances[threshold]['AVG_DIR'][1], '\n')
 
 
-def plot_error_rates(performancies, model_names, normalize_threshols=False):
+def error_rate_curves(avg_per_threshold, normalize_threshols=False):
+    """
+    :param avg_per_threshold: average performances per threshold of a model.
+    :param normalize_threshols: flag to normalize the thresholds in [0, 1].
+    :return: the thresholds and the FAR and FRR at each of them, as arrays.
+    """
+    thresholds = np.array(list(avg_per_threshold.keys()), dtype=np.float64)
+    fars = np.array([performs['AVG_FAR'] for performs in avg_per_threshold.values()], dtype=np.float64)
+    frrs = np.array([performs['AVG_FRR'] for performs in avg_per_threshold.values()], dtype=np.float64)
+
+    if normalize_threshols:
+        thresholds = (thresholds - np.min(thresholds)) / (np.max(thresholds) - np.min(thresholds))
+
+    return thresholds, fars, frrs
+
+
+def equal_error_rate(thresholds, fars, frrs):
+    """
+    Finds the equal error rate, where the FAR and FRR curves (both evaluated at the same sorted thresholds) cross.
+    As the curves are monotonic, the crossing is the first sign change of FAR - FRR, found in a single pass
+    and linearly interpolated between the two thresholds around it.
+
+    :return: the threshold and the error rate of the crossing, as arrays with one element (empty if there is none).
+    """
+    thresholds = np.asarray(thresholds, dtype=np.float64)
+    fars = np.asarray(fars, dtype=np.float64)
+    frrs = np.asarray(frrs, dtype=np.float64)
+
+    sign = np.sign(fars - frrs)
+    equal = np.flatnonzero(sign == 0)
+    change = np.flatnonzero(sign[:-1] * sign[1:] < 0)
+
+    if len(equal) != 0 and (len(change) == 0 or equal[0] <= change[0]):
+        i = equal[0]
+        return thresholds[i:i + 1], fars[i:i + 1]
+
+    if len(change) == 0:
+        return np.zeros(0), np.zeros(0)
+
+    i = change[0]
+    d0 = fars[i] - frrs[i]
+    d1 = fars[i + 1] - frrs[i + 1]
+    t = d0 / (d0 - d1)
+
+    return (np.array([thresholds[i] + t * (thresholds[i + 1] - thresholds[i])]),
+            np.array([fars[i] + t * (fars[i + 1] - fars[i])]))
+
+
+def plot_error_rates(performancies, model_names, normalize_threshols=False, report=None, name='models'):
+    """
+    Plots the FAR and FRR curves of some models, marking their EERs.
+
+    :param performancies: average performances per threshold of each model.
+    :param model_names: names of the models.
+    :param normalize_threshols: flag to normalize the thresholds in [0, 1].
+    :param report: if not None, the reports.Report to save the figure to, instead of showing it.
+    :param name: name of the group of models in the report.
+    """
+    if report is not None:
+        report.error_rates(performancies, model_names, name, normalize_threshols)
+        return
+
+    import matplotlib.pyplot as plt
+
     plt.figure()
 
     for avg_per_threshold, model_name in zip(performancies, model_names):
-        thresholds = list()
-        fars = list()
-        frrs = list()
-        for t, performs in avg_per_threshold.items():
-            thresholds.append(t)
-            fars.append(performs['AVG_FAR'])
-            frrs.append(performs['AVG_FRR'])
-
-        if normalize_threshols:
-            thresholds = np.array(thresholds)
-            thresholds = (thresholds - np.min(thresholds)) / (np.max(thresholds) - np.min(thresholds))
+        thresholds, fars, frrs = error_rate_curves(avg_per_threshold, normalize_threshols)
 
         plt.plot(thresholds, fars, label=model_name + ': FAR')
         plt.plot(thresholds, frrs, label=model_name + ': FRR')
 
-        err_t, err = intersection(np.array(thresholds), np.array(fars), np.array(thresholds), np.array(frrs))
+        err_t, err = equal_error_rate(thresholds, fars, frrs)
 
         print('{}: ERR of {} reached at threshold {}'.format(model_name, err, err_t))
 
@@ -302,7 +319,21 @@ def plot_error_rates(performancies, model_names, normalize_threshols=False):
     plt.show()
 
 
-def plot_rocs(performancies, model_names):
+def plot_rocs(performancies, model_names, report=None, name='models'):
+    """
+    Plots the watchlist ROC curves of some models.
+
+    :param performancies: average performances per threshold of each model.
+    :param model_names: names of the models.
+    :param report: if not None, the reports.Report to save the figure to, instead of showing it.
+    :param name: name of the group of models in the report.
+    """
+    if report is not None:
+        report.rocs(performancies, model_names, name)
+        return
+
+    import matplotlib.pyplot as plt
+
     plt.figure()
     plt.title('Watchlist ROC')
 
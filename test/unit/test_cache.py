@@ -0,0 +1,55 @@
+import os
+import sys
+
+import cv2.cv2 as cv
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'code'))
+
+import cache  # noqa: E402
+import Eyes_Recognizer  # noqa: E402
+
+
+def _train(recognizer, flip=False):
+    rng = np.random.RandomState(0)
+    faces = [rng.randint(0, 256, (20, 20), dtype=np.uint8) for _ in range(6)]
+    if flip:
+        faces = [face[:, ::-1].copy() for face in faces]
+
+    recognizer.train(faces, np.array([1, 1, 2, 2, 3, 3]))
+
+    return recognizer
+
+
+def test_fingerprint_changes_with_the_model():
+    first = _train(cv.face.LBPHFaceRecognizer_create(1, 4))
+    second = _train(cv.face.LBPHFaceRecognizer_create(1, 4))
+
+    # the model is not hashed at each lookup: its version only changes when it is invalidated
+    version = cache.fingerprint(first)
+    assert cache.fingerprint(first) == version
+    assert cache.fingerprint(second) != version
+
+    # retrained in place with other images of the same subjects
+    _train(first, flip=True)
+    cache.invalidate_model(first)
+    assert cache.fingerprint(first) != version
+
+
+def test_fingerprint_changes_with_the_eyes_index(tmp_path):
+    file_name = str(tmp_path / 'eyes.txt')
+    with open(file_name, 'w') as fl:
+        fl.write("a  s1  Brown\nb  s2  Blue")
+
+    index = Eyes_Recognizer.EyesColorIndex(file_name)
+    version = cache.fingerprint(index)
+    assert cache.fingerprint(index) == version
+
+    index.enroll(3, 'c', 'Green')
+    assert cache.fingerprint(index) != version
+
+    # changed by another process
+    version = cache.fingerprint(index)
+    with open(file_name, 'a') as fl:
+        fl.write("\nd  s4  Green")
+    assert cache.fingerprint(index) != version
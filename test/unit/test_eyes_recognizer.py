@@ -0,0 +1,15 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'code'))
+
+import Eyes_Recognizer  # noqa: E402
+
+
+def test_count_eye_pixels_of_a_crop_with_just_the_pupil():
+    # every pixel is discarded as pupil
+    eye = np.zeros((10, 10, 3), dtype=np.uint8)
+
+    assert Eyes_Recognizer._count_eye_pixels(eye) == [0] * len(Eyes_Recognizer.class_name)
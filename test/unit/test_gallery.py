@@ -0,0 +1,71 @@
+import os
+import sys
+
+import cv2.cv2 as cv
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'code'))
+
+import Gallery  # noqa: E402
+
+
+def _faces_with_duplicates():
+    rng = np.random.RandomState(0)
+    faces = [rng.randint(0, 256, (20, 20), dtype=np.uint8) for _ in range(5)]
+
+    # subject 1 has two identical images
+    faces.append(faces[0].copy())
+
+    return faces, np.array([1, 2, 2, 3, 3, 1])
+
+
+def test_k_medoids_with_duplicates():
+    dists = np.array([[0, 0, 5], [0, 0, 5], [5, 5, 0]], dtype=np.float64)
+
+    clusters = Gallery._k_medoids(dists, 3)
+
+    assert len(clusters) == 2
+    assert sorted(np.concatenate([members for _, members in clusters]).tolist()) == [0, 1, 2]
+
+    # all the templates identical: a single cluster
+    clusters = Gallery._k_medoids(np.zeros((2, 2)), 2)
+    assert len(clusters) == 1 and clusters[0][1].tolist() == [0, 1]
+
+
+def test_compact_gallery_with_duplicate_templates():
+    faces, labels = _faces_with_duplicates()
+
+    for recognizer in [cv.face.EigenFaceRecognizer_create(num_components=3),
+                       cv.face.LBPHFaceRecognizer_create(radius=1, neighbors=4)]:
+        recognizer.train(faces, labels)
+
+        for method in ['centroids', 'medoids']:
+            compact = Gallery.CompactGallery(Gallery.Gallery(recognizer), per_subject=2, method=method, rerank=1)
+
+            assert len(compact) == 5
+            assert compact.predict(faces[0])[0][0] == 1
+
+
+def test_int8_lbph_histograms_are_exact():
+    faces, labels = _faces_with_duplicates()
+    recognizer = cv.face.LBPHFaceRecognizer_create(radius=1, neighbors=4)
+    recognizer.train(faces, labels)
+
+    exact = Gallery.Gallery(recognizer, 'float32')
+    int8 = Gallery.Gallery(recognizer, 'int8')
+
+    for face in faces:
+        assert np.allclose([d for _, d in int8.predict(face)], [d for _, d in exact.predict(face)])
+
+
+def test_coarse_to_fine_tail_has_no_coarse_distances():
+    faces, labels = _faces_with_duplicates()
+    matcher = Gallery.CoarseToFineGallery.train(cv.face.EigenFaceRecognizer_create(),
+                                                cv.face.EigenFaceRecognizer_create(), faces, labels,
+                                                coarse_size=8, shortlist=1)
+
+    results = matcher.predict(faces[1])
+
+    assert sorted(label for label, _ in results) == sorted(labels)
+    assert all(np.isfinite(d) == (label == 2) for label, d in results)
+    assert results[0][0] == 2
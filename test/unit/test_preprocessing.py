@@ -0,0 +1,28 @@
+import os
+import sys
+
+import cv2.cv2 as cv
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'code'))
+
+import preprocessing  # noqa: E402
+
+
+def test_load_more_images_than_the_memo(tmp_path, monkeypatch):
+    monkeypatch.setattr(preprocessing, 'memo_size', 5)
+    preprocessing.clear()
+
+    rng = np.random.RandomState(0)
+    files = []
+    for i in range(12):
+        file = str(tmp_path / '{}.png'.format(i))
+        cv.imwrite(file, rng.randint(0, 256, (30, 30), dtype=np.uint8))
+        files.append(file)
+
+    first = preprocessing.default.load(files, 20)
+    second = preprocessing.default.load(files + files[:3], 20)
+
+    assert len(first) == 12 and len(second) == 15
+    assert len(preprocessing._memo) == 5
+    assert all((a == b).all() for a, b in zip(first + first[:3], second))
@@ -0,0 +1,26 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'code'))
+
+import Recognition_Tests  # noqa: E402
+
+
+def test_cmc_counts_a_match_at_position_p_at_rank_p_plus_1():
+    distance_matrix = dict([(("a.jpg", 1), [(1, 1.0), (2, 3.0), (3, 4.0)]),
+                            (("b.jpg", 2), [(1, 2.0), (2, 3.0), (3, 5.0)]),
+                            (("c.jpg", 3), [(1, 1.5), (2, 2.5), (3, 4.5)]),
+                            (("d.jpg", 3), [(3, 6.0), (1, 7.0), (2, 8.0)]),
+                            (("e.jpg", 9), [(2, 1.2), (1, 2.0), (3, 3.0)])])
+
+    rates = Recognition_Tests.compute_rates(distance_matrix, {1, 2, 3}, [1.0, 2.0, 10.0])
+
+    assert np.allclose(rates[1.0]["CMC"], [0.25, 0.25, 0.25])
+    assert np.allclose(rates[2.0]["CMC"], [0.25, 0.5, 0.75])
+    assert np.allclose(rates[10.0]["CMC"], [0.5, 0.75, 1.0])
+
+    # the legacy DIR dictionary is unchanged: position p >= 1 counts at rank p
+    assert np.isclose(rates[1.0]["DIR"][1], 0.25 + 0.25)
+    assert np.isclose(rates[10.0]["DIR"][1], 0.5 + 0.25)